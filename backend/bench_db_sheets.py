@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark di db_sheets su fake_sheets
+
+Per ogni dimensione (righe di workdays) crea un foglio sintetico in memoria,
+lo collega a db_sheets e misura ogni funzione: tempo (ms) e numero di
+chiamate remote. Il report è JSON, da confrontare prima/dopo una modifica.
+
+    python bench_db_sheets.py --sizes 1000 10000 100000 --latency-ms 0 --output bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Any, Callable, Dict, List
+
+# Il fake non ha quote: il benchmark non deve essere rallentato dal token bucket
+os.environ.setdefault("SHEETS_READ_QUOTA", "1000000")
+os.environ.setdefault("SHEETS_WRITE_QUOTA", "1000000")
+
+import db_sheets
+import fake_sheets
+
+USERS = 50
+CITIES = ["Verona", "Modena", "Reggio Emilia", "Parma", "Piacenza", "Mantova"]
+
+
+def _workday(user_id: str, day: date, city_id: str) -> Dict[str, Any]:
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "date": day.isoformat(),
+        "city": city_id,
+        "is_custom_city": False,
+        "travel_minutes_outbound": 60,
+        "travel_minutes_return": 60,
+        "work_minutes": 540,
+        "arrival_time": "10:00",
+        "departure_home": "09:00",
+        "exit_time": "19:00",
+        "return_home": "20:00",
+        "status": "completed",
+        "created_at": datetime.now().isoformat(),
+    }
+
+
+def build_spreadsheet(rows: int, latency_ms: float, seed: int = 42) -> Dict[str, Any]:
+    """Synthetic spreadsheet: USERS users, 6 cities, `rows` workdays spread over users and days"""
+    rng = random.Random(seed)
+    fake = fake_sheets.FakeSpreadsheet(latency_ms=latency_ms)
+    config = db_sheets.SHEETS_CONFIG
+
+    users = [{
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "username": f"user{i}",
+        "email": f"user{i}@mediaworld.it",
+        "password_hash": "x",
+        "role": "sales",
+        "blocked": False,
+        "created_at": datetime.now().isoformat(),
+    } for i in range(USERS)]
+    cities = [{
+        "id": str(uuid.UUID(int=rng.getrandbits(128))),
+        "name": name,
+        "travel_minutes": 10 * i,
+        "created_at": datetime.now().isoformat(),
+    } for i, name in enumerate(CITIES)]
+
+    start = date(2020, 1, 1)
+    workdays = [
+        _workday(users[i % USERS]["id"], start + timedelta(days=i // USERS), cities[i % len(CITIES)]["id"])
+        for i in range(rows)
+    ]
+
+    fake.load("users", config["users"], [db_sheets._user_row(u) for u in users])
+    fake.load("cities", config["cities"], [db_sheets._city_row(c) for c in cities])
+    fake.load("workdays", config["workdays"], [db_sheets._workday_row(w) for w in workdays])
+    fake.load("roles", config["roles"], [])
+    return {"fake": fake, "users": users, "cities": cities, "workdays": workdays}
+
+
+def measure(fake: fake_sheets.FakeSpreadsheet, fn: Callable[[], Any], repeat: int) -> Dict[str, Any]:
+    """Run fn `repeat` times, return best/mean wall time and remote calls per run"""
+    timings: List[float] = []
+    calls: Dict[str, int] = {}
+    for _ in range(repeat):
+        fake.reset_calls()
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+        calls = dict(fake.calls)
+    return {
+        "best_ms": round(min(timings), 3),
+        "mean_ms": round(sum(timings) / len(timings), 3),
+        "remote_calls": sum(calls.values()),
+        "calls": calls,
+    }
+
+
+def run_size(rows: int, latency_ms: float, repeat: int) -> Dict[str, Any]:
+    data = build_spreadsheet(rows, latency_ms)
+    fake, users, workdays = data["fake"], data["users"], data["workdays"]
+    db_sheets.use_spreadsheet(fake)
+
+    user = users[len(users) // 2]
+    target = workdays[len(workdays) // 2]
+    next_day = date.fromisoformat(workdays[-1]["date"]) + timedelta(days=1)
+    counter = iter(range(10 ** 9))
+
+    def cold(fn: Callable[[], Any]) -> Callable[[], Any]:
+        def run():
+            db_sheets.invalidate_cache()
+            fn()
+        return run
+
+    def new_workday() -> Dict[str, Any]:
+        return _workday(user["id"], next_day + timedelta(days=next(counter)), data["cities"][0]["id"])
+
+    def create_then_delete():
+        wd = new_workday()
+        db_sheets.create_workday(wd)
+        db_sheets.delete_workday(wd["user_id"], wd["date"])
+
+    operations = {
+        "get_all_users (cold)": cold(db_sheets.get_all_users),
+        "get_all_users (warm)": db_sheets.get_all_users,
+        "get_user_by_email (warm)": lambda: db_sheets.get_user_by_email(user["email"]),
+        "update_user": lambda: db_sheets.update_user(user["id"], {"blocked": next(counter) % 2 == 0}),
+        "get_all_cities (warm)": db_sheets.get_all_cities,
+        "get_all_workdays": db_sheets.get_all_workdays,
+        "get_all_workdays (user)": lambda: db_sheets.get_all_workdays(user["id"]),
+        "get_workday_by_date": lambda: db_sheets.get_workday_by_date(target["user_id"], target["date"]),
+        "update_workday": lambda: db_sheets.update_workday(
+            target["user_id"], target["date"], {"status": ("completed", "in_progress")[next(counter) % 2]}),
+        "create_workday": lambda: db_sheets.create_workday(new_workday()),
+        "create_workdays_batch (100)": lambda: db_sheets.create_workdays_batch([new_workday() for _ in range(100)]),
+        "create_workday + delete_workday": create_then_delete,
+    }
+
+    results = {}
+    for name, fn in operations.items():
+        results[name] = measure(fake, fn, repeat)
+        print(f"   {name:<34} {results[name]['best_ms']:>10.2f} ms  {results[name]['remote_calls']:>3} calls", file=sys.stderr)
+
+    db_sheets.reset_client()
+    return {"rows": rows, "operations": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark db_sheets against an in-memory fake spreadsheet")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                        help="workday rows per run (default: 1000 10000 100000)")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="simulated latency per remote call")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per operation (best and mean are reported)")
+    parser.add_argument("--output", help="write the JSON report here (default: stdout)")
+    args = parser.parse_args()
+
+    report = {
+        "generated_at": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "latency_ms": args.latency_ms,
+        "repeat": args.repeat,
+        "runs": [],
+    }
+    for rows in args.sizes:
+        print(f"🔄 {rows} workday rows", file=sys.stderr)
+        report["runs"].append(run_size(rows, args.latency_ms, args.repeat))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+        print(f"✅ Report written to {args.output}", file=sys.stderr)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+"""
+Bulk month-end PDF reports
+
+GET /api/export/pdf/bulk carica una sola volta workdays, utenti e città del
+mese e poi distribuisce il rendering reportlab (CPU-bound) su un pool di
+processi. Ogni PDF finisce nello ZIP appena è pronto, così la risposta parte
+prima che l'ultimo utente sia renderizzato; l'ultimo file dello ZIP è
+manifest.json con i tempi di rendering di ogni utente.
+
+Il numero di processi è il minimo tra i core disponibili e quanti worker
+stanno nella memoria della macchina (limite del cgroup meno la quota
+riservata al server). Il pool vive solo per la durata di una richiesta e ne
+gira una alla volta: sulla macchina da 512 MB i worker inattivi pesano.
+L'endpoint prende il posto con acquire() prima di caricare i dati (una
+seconda richiesta riceve subito 409) e lo stream lo rilascia quando finisce.
+"""
+
+import asyncio
+import io
+import json
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pdf_report import render_monthly_pdf
+
+logger = logging.getLogger(__name__)
+
+
+def memory_limit_mb() -> Optional[int]:
+    """Memory available to this container (cgroup v2/v1 limit, else physical RAM)"""
+    for path in ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+        except OSError:
+            continue
+        # "max" o un valore enorme = nessun limite
+        if value.isdigit() and int(value) < 1 << 50:
+            return int(value) // (1024 * 1024)
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def available_cores() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def pool_size(max_workers: int, worker_mb: int, reserved_mb: int, memory_mb: Optional[int] = None) -> int:
+    """Worker processes: one per core (or max_workers), capped by what fits in memory"""
+    workers = max_workers if max_workers > 0 else available_cores()
+    memory_mb = memory_mb or memory_limit_mb()
+    if memory_mb:
+        workers = min(workers, (memory_mb - reserved_mb) // worker_mb)
+    return max(1, workers)
+
+
+def archive_name(name: str) -> str:
+    """Safe file name for a ZIP entry (username or e-mail)"""
+    return re.sub(r"[^A-Za-z0-9._-]+", "_", str(name)).strip("._") or "utente"
+
+
+def _render(user_id: str, args: Dict[str, Any]) -> Tuple[str, Optional[bytes], float, Optional[str]]:
+    """Worker side: (user_id, pdf, seconds, error)"""
+    started = time.perf_counter()
+    try:
+        data = render_monthly_pdf(**args)
+        return user_id, data, time.perf_counter() - started, None
+    except Exception as e:
+        return user_id, None, time.perf_counter() - started, str(e)
+
+
+class _ChunkBuffer(io.RawIOBase):
+    """Write-only sink for ZipFile; drain() hands over what was written so far"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class BulkPdfRenderer:
+    """Fans the monthly reports out to a process pool and streams them as a ZIP"""
+
+    def __init__(self, max_workers: int, worker_mb: int, reserved_mb: int, memory_mb: Optional[int] = None):
+        self.memory_mb = memory_mb or memory_limit_mb()
+        self.workers = pool_size(max_workers, worker_mb, reserved_mb, self.memory_mb)
+        self._lock = threading.Lock()
+        self.runs = 0
+        self.last_run: Optional[Dict[str, Any]] = None
+
+    def busy(self) -> bool:
+        return self._lock.locked()
+
+    def acquire(self) -> bool:
+        """Take the export slot without waiting, False if another export is running"""
+        return self._lock.acquire(blocking=False)
+
+    def release(self):
+        if self._lock.locked():
+            self._lock.release()
+
+    async def stream_zip(self, jobs: List[Dict[str, Any]], load_seconds: float = 0.0,
+                         on_rendered: Optional[Callable[[Dict[str, Any], bytes], Awaitable[None]]] = None,
+                         ) -> AsyncIterator[bytes]:
+        """
+        ZIP with one PDF per job plus manifest.json. A job is {"user_id", "username", "filename"}
+        with either "data" (already rendered, e.g. from the cache) or "args" for render_monthly_pdf.
+        The caller holds the slot (acquire()); it is released when the stream ends, fails or is closed.
+        """
+        buffer = _ChunkBuffer()
+        archive = zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED)
+        manifest: List[Dict[str, Any]] = []
+        started = time.perf_counter()
+
+        def add(job: Dict[str, Any], data: Optional[bytes], seconds: float, cached: bool, error: Optional[str]):
+            if data is not None:
+                archive.writestr(job["filename"], data)
+            manifest.append({
+                "user_id": job["user_id"],
+                "username": job["username"],
+                "file": job["filename"] if data is not None else None,
+                "cached": cached,
+                "render_ms": round(seconds * 1000, 1),
+                "bytes": len(data) if data is not None else 0,
+                "error": error,
+            })
+
+        try:
+            for job in jobs:
+                if job.get("data") is not None:
+                    add(job, job["data"], 0.0, True, None)
+            yield buffer.drain()
+
+            pending = {job["user_id"]: job for job in jobs if job.get("data") is None}
+            workers = min(self.workers, len(pending))
+            if pending:
+                loop = asyncio.get_running_loop()
+                # spawn: il server ha thread attivi (pool dello storage), fork non è sicuro
+                pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                try:
+                    futures = [loop.run_in_executor(pool, _render, user_id, job["args"])
+                               for user_id, job in pending.items()]
+                    for future in asyncio.as_completed(futures):
+                        user_id, data, seconds, error = await future
+                        job = pending[user_id]
+                        if error:
+                            logger.error("PDF render failed for user %s: %s", user_id, error)
+                        add(job, data, seconds, False, error)
+                        if data is not None and on_rendered:
+                            await on_rendered(job, data)
+                        yield buffer.drain()
+                finally:
+                    # Anche se il client chiude la connessione a metà
+                    pool.shutdown(wait=False, cancel_futures=True)
+
+            renders = [entry["render_ms"] for entry in manifest if not entry["cached"]]
+            summary = {
+                "users": len(manifest),
+                "rendered": sum(1 for entry in manifest if not entry["cached"] and not entry["error"]),
+                "cached": sum(1 for entry in manifest if entry["cached"]),
+                "failed": sum(1 for entry in manifest if entry["error"]),
+                "workers": workers,
+                "load_ms": round(load_seconds * 1000, 1),
+                "render_ms_total": round(sum(renders), 1),
+                "render_ms_max": max(renders, default=0.0),
+                "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+            }
+            archive.writestr("manifest.json", json.dumps({**summary, "reports": manifest}, ensure_ascii=False, indent=2))
+            archive.close()
+            yield buffer.drain()
+
+            self.runs += 1
+            self.last_run = summary
+            logger.info("Bulk PDF export: %s", summary)
+        finally:
+            self.release()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "memory_mb": self.memory_mb,
+            "busy": self.busy(),
+            "runs": self.runs,
+            "last_run": self.last_run,
+        }
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Confronta il foglio "monthly_stats" con un ricalcolo completo dai workdays
+
+    python check_monthly_aggregates.py          # solo controllo (exit 1 se differiscono)
+    python check_monthly_aggregates.py --fix    # riscrive i totali ricalcolati
+"""
+
+import argparse
+import sys
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import db_sheets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the monthly aggregates against a full recompute")
+    parser.add_argument("--fix", action="store_true", help="rewrite the monthly_stats sheet if it differs")
+    args = parser.parse_args()
+
+    print("🔄 Recomputing monthly aggregates from workdays...")
+    result = db_sheets.verify_monthly_aggregates(fix=args.fix)
+
+    print(f"   Groups (user, year, month): {result['groups']} expected, {result['stored']} stored")
+    if result["duplicates"]:
+        print(f"   ⚠️  {result['duplicates']} duplicated rows in '{db_sheets.AGGREGATES_SHEET}'")
+    for m in result["mismatches"][:20]:
+        print(f"   ❌ {m['user_id']} {m['month']}/{m['year']}: stored {m['stored']} expected {m['expected']}")
+    if len(result["mismatches"]) > 20:
+        print(f"   ... and {len(result['mismatches']) - 20} more")
+
+    if not result["mismatches"] and not result["duplicates"]:
+        print("✅ Aggregates are consistent")
+    elif result["fixed"]:
+        print("🔧 Aggregates rewritten from the recompute")
+    else:
+        print("👉 Run with --fix to rewrite them")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
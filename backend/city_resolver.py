@@ -0,0 +1,178 @@
+"""
+City name resolver
+
+Le città arrivano scritte in tanti modi: "REGGIO EMILIA" dal vecchio CSV,
+"Reggio  Emilia", "reggio-emilia", "Vicenza" per la città "Padova/Vicenza",
+l'id dal frontend. CityResolver costruisce una volta sola, dal foglio
+cities, una tabella di chiavi normalizzate (minuscole, senza accenti, spazi
+e punteggiatura compressi) che porta alla città:
+
+- il nome intero e ogni alias separato da "/"
+- l'id della città
+- ogni prefisso di almeno MIN_PREFIX caratteri di un nome o alias, se
+  appartiene a una sola città ("reggio em", "piacen")
+
+Un nome che non è né una chiave né un prefisso viene accettato solo come
+errore di battitura: al massimo MAX_TYPOS modifiche (lettere tolte, aggiunte
+o cambiate, "modenaa", "regio emilia") da una sola città. Un nome diverso,
+anche se comincia come una città ("Roma Nord", "Padova Est"), resta
+sconosciuto e non viene riscritto.
+
+Risolvere un nome costa una normalizzazione e qualche lookup in un dict;
+gli ultimi MEMO_SIZE nomi visti sono memorizzati, così un import di migliaia
+di righe con poche città distinte normalizza ogni città una volta. Gli
+storage tengono il resolver e lo ricostruiscono solo dopo
+create_city/update_city/delete_city.
+"""
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+
+MIN_PREFIX = 4
+# Modifiche ammesse per un errore di battitura: 1, 2 da TYPO_LONG_NAME caratteri
+MAX_TYPOS = 2
+TYPO_LONG_NAME = 8
+MEMO_SIZE = 1024
+
+_SEPARATORS = re.compile(r"[^a-z0-9]+")
+
+
+def normalize(name: Any) -> str:
+    """Case, accent and whitespace insensitive key: "  Forlì-Cesena " -> "forli cesena\""""
+    text = unicodedata.normalize("NFKD", str(name or "")).encode("ascii", "ignore").decode("ascii")
+    return _SEPARATORS.sub(" ", text.casefold()).strip()
+
+
+def aliases(name: Any) -> List[str]:
+    """Normalized keys of a city name: the whole name and each "/" alias"""
+    keys = [normalize(name)]
+    if "/" in str(name):
+        keys.extend(normalize(part) for part in str(name).split("/"))
+    return [key for key in dict.fromkeys(keys) if key]
+
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Levenshtein distance of two keys, limit + 1 as soon as it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, char in enumerate(a, start=1):
+        current = [i]
+        for j, other in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+
+class CityResolver:
+    """Precomputed lookup from any spelling of a city (or its id) to the city record"""
+
+    def __init__(self, cities: Iterable[Dict[str, Any]], version: int = 0):
+        self.version = version
+        self.cities: List[Dict[str, Any]] = list(cities)
+        self._by_id: Dict[str, Dict[str, Any]] = {}
+        self._exact: Dict[str, Dict[str, Any]] = {}
+        # Prefisso -> città, None se il prefisso è di più città
+        self._prefixes: Dict[str, Optional[Dict[str, Any]]] = {}
+        # Ultimi nomi risolti, il meno recente esce per primo
+        self._memo: "OrderedDict[str, Optional[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        for city in self.cities:
+            self._by_id[str(city.get("id", ""))] = city
+            for key in aliases(city.get("name")):
+                self._exact.setdefault(key, city)
+                for end in range(MIN_PREFIX, len(key)):
+                    prefix = key[:end]
+                    if self._prefixes.get(prefix, city) is not city:
+                        self._prefixes[prefix] = None
+                    else:
+                        self._prefixes[prefix] = city
+
+    def lookup(self, name: Any) -> Optional[Dict[str, Any]]:
+        """Exact match only (id, name or alias), no prefixes: for duplicate checks"""
+        return self._by_id.get(str(name or "").strip()) or self._exact.get(normalize(name))
+
+    def _resolve(self, name: str) -> Optional[Dict[str, Any]]:
+        city = self.lookup(name)
+        if city is not None:
+            return city
+        key = normalize(name)
+        if len(key) < MIN_PREFIX:
+            return None
+        # Nome troncato ("reggio em")
+        city = self._prefixes.get(key)
+        if city is not None:
+            return city
+        return self._typo(key)
+
+    def _typo(self, key: str) -> Optional[Dict[str, Any]]:
+        """The only city within MAX_TYPOS edits of the key ("modenaa"), None if none or several"""
+        limit = 1 if len(key) < TYPO_LONG_NAME else MAX_TYPOS
+        best, matches = limit + 1, []
+        for name, city in self._exact.items():
+            distance = edit_distance(key, name, min(limit, best))
+            if distance < best:
+                best, matches = distance, [city]
+            elif distance == best and distance <= limit and city not in matches:
+                matches.append(city)
+        return matches[0] if len(matches) == 1 else None
+
+    def resolve(self, name: Any) -> Optional[Dict[str, Any]]:
+        """The city for any spelling of its name (or its id), None if unknown or ambiguous"""
+        raw = str(name or "").strip()
+        if not raw:
+            return None
+        with self._lock:
+            if raw in self._memo:
+                self.hits += 1
+                self._memo.move_to_end(raw)
+                return self._memo[raw]
+        city = self._resolve(raw)
+        with self._lock:
+            self.misses += 1
+            self._memo[raw] = city
+            if len(self._memo) > MEMO_SIZE:
+                self._memo.popitem(last=False)
+        return city
+
+    def canonical_name(self, name: Any) -> str:
+        """The city's name as on the sheet, or the input unchanged if unknown"""
+        city = self.resolve(name)
+        return city["name"] if city else str(name or "").strip()
+
+    def travel_minutes(self, names: Iterable[Any]) -> np.ndarray:
+        """Travel minutes of each city, NaN if unknown"""
+        minutes = []
+        for name in names:
+            city = self.resolve(name)
+            try:
+                minutes.append(float(city.get("travel_minutes") or 0) if city else np.nan)
+            except (TypeError, ValueError):
+                minutes.append(np.nan)
+        return np.array(minutes, dtype=float)
+
+    def names(self) -> Dict[str, str]:
+        """City id -> name"""
+        return {city_id: city.get("name", "") for city_id, city in self._by_id.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "version": self.version,
+                "cities": len(self.cities),
+                "keys": len(self._exact),
+                "prefixes": len(self._prefixes),
+                "memo": len(self._memo),
+                "hits": self.hits,
+                "misses": self.misses,
+            }
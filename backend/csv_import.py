@@ -0,0 +1,230 @@
+"""
+Streaming CSV import for workdays
+
+Il CSV esportato dal vecchio foglio (colonne "Giorno", "Città", "Minuti andata",
+...) viene letto a pezzi dal file caricato, senza mai tenerlo tutto in memoria:
+le righe sono prodotte da un generatore, validate e normalizzate a blocchi di
+`chunk_size`, e ogni blocco viene salvato con una sola scrittura batch. La
+lettura e la preparazione di ogni blocco girano in un thread, non sull'event
+loop.
+
+Un blocco che fallisce non annulla quelli già salvati: l'errore viene
+riportato nel risultato del blocco e l'import prosegue con il successivo.
+Con `start_chunk` i primi blocchi vengono saltati senza salvarli: è così che
+un job di import (import_jobs.py) riprende dopo un riavvio.
+"""
+
+import asyncio
+import csv
+import inspect
+import io
+import itertools
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from city_resolver import CityResolver
+from schedule import fill_schedules
+
+# Parole nella colonna "Città" che indicano una giornata senza trasferta
+SPECIAL_STATUSES = ['Riposo', 'Festivo', 'Compleanno', 'Riunione', 'Ferie', 'Malattia']
+
+Row = Tuple[int, Dict[str, str]]
+
+# Colonne lette da parse_row(), nello stesso ordine le scrive format_row() per l'export
+CSV_COLUMNS = [
+    'Giorno', 'Città', 'Stato Giornata', 'Minuti andata', 'Minuti ritorno', 'Minuti lavoro in VIS',
+    'Partenza da casa', 'Arrivo VIS', 'Uscita VIS', 'Rientro a casa',
+]
+
+
+def iter_csv_rows(binary: BinaryIO) -> Iterator[Row]:
+    """Yield (row number, row) from an uploaded CSV, decoding it incrementally"""
+    # utf-8-sig toglie il BOM; il reader incrementale non carica tutto il file
+    text = io.TextIOWrapper(binary, encoding="utf-8-sig", newline="")
+    try:
+        header = text.readline()
+        if not header:
+            return
+        # Detect delimiter
+        delimiter = ';' if ';' in header else ','
+        reader = csv.DictReader(itertools.chain([header], text), delimiter=delimiter)
+        for number, row in enumerate(reader, start=1):
+            yield number, row
+    finally:
+        # Il file appartiene a UploadFile: non chiuderlo insieme al wrapper
+        text.detach()
+
+
+def iter_chunks(rows: Iterable[Row], size: int) -> Iterator[List[Row]]:
+    """Group rows in lists of at most `size`"""
+    rows = iter(rows)
+    while True:
+        chunk = list(itertools.islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def parse_row(row: Dict[str, str], user_id: str) -> Optional[Dict[str, Any]]:
+    """Normalize one CSV row into a workday, None for rows without a date"""
+    date_str = (row.get('Giorno') or '').strip()
+    city = (row.get('Città') or '').strip()
+
+    if not date_str:
+        return None
+
+    # Parse date (format: DD/MM/YYYY)
+    day, month, year = date_str.split('/')
+    date_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
+
+    status = (row.get('Stato Giornata') or '').strip()
+
+    # Check for special statuses in city field
+    if city and any(keyword in city for keyword in SPECIAL_STATUSES):
+        status = city
+        city = ''
+
+    return {
+        "id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "date": date_iso,
+        "city": city,
+        "is_custom_city": False,
+        "custom_city_name": "",
+        "custom_distance_km": "",
+        "custom_travel_minutes": "",
+        "travel_minutes_outbound": int(row.get('Minuti andata', 0) or 0),
+        "travel_minutes_return": int(row.get('Minuti ritorno', 0) or 0),
+        "work_minutes": int(row.get('Minuti lavoro in VIS', 0) or 0),
+        "arrival_time": (row.get('Arrivo VIS') or '').strip(),
+        "departure_home": (row.get('Partenza da casa') or '').strip(),
+        "exit_time": (row.get('Uscita VIS') or '').strip(),
+        "return_home": (row.get('Rientro a casa') or '').strip(),
+        "actual_arrival_at_store": "",
+        "actual_exit_from_store": "",
+        "actual_return_home": "",
+        "status": status,
+        "created_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def format_row(workday: Dict[str, Any], city_names: Optional[Dict[str, str]] = None) -> List[Any]:
+    """CSV row of a workday in the CSV_COLUMNS layout, so the export can be imported again"""
+    date = str(workday.get("date") or "")
+    if "-" in date:
+        year, month, day = date.split("-")
+        date = f"{day}/{month}/{year}"
+    if str(workday.get("is_custom_city", "")).lower() == "true":
+        city = workday.get("custom_city_name") or ""
+    else:
+        city = (city_names or {}).get(workday.get("city"), workday.get("city")) or ""
+    return [
+        date,
+        city,
+        workday.get("status") or "",
+        workday.get("travel_minutes_outbound") or 0,
+        workday.get("travel_minutes_return") or 0,
+        workday.get("work_minutes") or 0,
+        workday.get("departure_home") or "",
+        workday.get("arrival_time") or "",
+        workday.get("exit_time") or "",
+        workday.get("return_home") or "",
+    ]
+
+
+def prepare_chunk(chunk: List[Row], user_id: str, existing_dates: Set[str],
+                  resolver: Optional[CityResolver] = None) -> Tuple[List[Dict[str, Any]], List[str]]:
+    """
+    Parse a chunk, skipping dates already saved (or repeated in the chunk); returns (workdays, errors).
+    With a city resolver the cities get their sheet name ("REGGIO EMILIA" -> "Reggio Emilia")
+    and the missing minutes and times are computed for the whole chunk at once.
+    """
+    workdays = []
+    errors = []
+    seen = set()
+    for number, row in chunk:
+        try:
+            workday = parse_row(row, user_id)
+        except Exception as e:
+            errors.append(f"Riga {number}: {str(e)}")
+            continue
+        if workday is None or workday["date"] in existing_dates or workday["date"] in seen:
+            continue
+        seen.add(workday["date"])
+        workdays.append(workday)
+    if resolver is not None:
+        for workday in workdays:
+            if workday["city"]:
+                workday["city"] = resolver.canonical_name(workday["city"])
+        fill_schedules(workdays, resolver)
+    return workdays, errors
+
+
+async def import_csv_stream(binary: BinaryIO, user_id: str, existing_dates: Set[str],
+                            save: Callable[[List[Dict[str, Any]]], Awaitable[Any]],
+                            chunk_size: int, max_errors: int = 10, start_chunk: int = 0,
+                            on_chunk: Optional[Callable[[Dict[str, Any], List[str]], Any]] = None,
+                            resolver: Optional[CityResolver] = None) -> Dict[str, Any]:
+    """
+    Import a CSV chunk by chunk, calling `save` once per chunk with the new workdays.
+    `existing_dates` is updated with every date saved; only the first `max_errors`
+    messages are kept (the per-chunk results still count all of them).
+
+    Chunks up to `start_chunk` are skipped (already imported). `on_chunk(result,
+    messages)`, plain or async, is called after each chunk is committed, saved or
+    failed. With `resolver` the cities are normalized and the schedule of every
+    row is filled in (schedule.fill_schedules).
+    """
+    rows_read = 0
+    rows_saved = 0
+    errors: List[str] = []
+    chunks = []
+
+    chunk_iter = enumerate(iter_chunks(iter_csv_rows(binary), chunk_size), start=1)
+    while True:
+        # Decodifica, parsing e preparazione (numpy) girano in un thread: sull'event
+        # loop resta solo l'await di save
+        item = await asyncio.to_thread(next, chunk_iter, None)
+        if item is None:
+            break
+        index, chunk = item
+        if index <= start_chunk:
+            continue
+        rows_read += len(chunk)
+        workdays, chunk_errors = await asyncio.to_thread(prepare_chunk, chunk, user_id, existing_dates, resolver)
+        result = {
+            "chunk": index,
+            "first_row": chunk[0][0],
+            "last_row": chunk[-1][0],
+            "rows": len(chunk),
+            "saved": 0,
+            "errors": len(chunk_errors),
+            "error": None,
+        }
+        errors.extend(chunk_errors[:max_errors - len(errors)])
+
+        if workdays:
+            try:
+                await save(workdays)
+                result["saved"] = len(workdays)
+                rows_saved += len(workdays)
+                existing_dates.update(w["date"] for w in workdays)
+            except Exception as e:
+                result["error"] = str(e)
+                message = f"Errore batch insert (righe {result['first_row']}-{result['last_row']}): {str(e)}"
+                chunk_errors.append(message)
+                if len(errors) < max_errors:
+                    errors.append(message)
+        chunks.append(result)
+        if on_chunk is not None:
+            outcome = on_chunk(result, chunk_errors)
+            if inspect.isawaitable(outcome):
+                await outcome
+
+    return {
+        "rows_read": rows_read,
+        "rows_saved": rows_saved,
+        "errors": errors,
+        "chunks": chunks,
+    }
@@ -0,0 +1,130 @@
+"""
+Data version counters
+
+Un contatore per ogni chiave (es. ("workdays", user_id, anno, mese)) che
+aumenta a ogni scrittura: chi mette in cache qualcosa calcolato dai dati
+(i PDF mensili) lo salva insieme alla versione e lo considera valido finché
+la versione non cambia, senza rileggere il foglio.
+
+Le versioni partono da una base presa dall'orologio all'avvio, così dopo un
+riavvio non tornano mai a valori già usati. Con un file i contatori
+sopravvivono a un riavvio insieme alla cache su disco: il file è riscritto al
+massimo ogni save_delay secondi (non a ogni incremento) e a close(). Dal primo
+incremento fino a close() il file è segnato come non chiuso: se il processo si
+ferma prima di salvare, al riavvio si riparte da una base nuova. Le modifiche
+fatte a mano sul foglio le trova db_sheets.note_read() alla lettura completa
+successiva, che aumenta le versioni delle righe lette.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Hashable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def _name(key: Hashable) -> str:
+    return "|".join(str(part) for part in key) if isinstance(key, tuple) else str(key)
+
+
+def _new_base() -> int:
+    return time.time_ns() // 1000
+
+
+class DataVersions:
+    """Thread-safe counters bumped on every write, optionally persisted to a JSON file"""
+
+    def __init__(self, path: Optional[str] = None, save_delay: float = 1.0):
+        self.path = path
+        self.save_delay = save_delay
+        self._base = _new_base()
+        self._versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._timer: Optional[threading.Timer] = None
+        self._loaded = False
+        # Il file dice "non chiuso" da prima che venga usata una versione non salvata
+        self._marked = False
+        self.bumps = 0
+        self.saves = 0
+
+    def _load(self):
+        """Read the file on first use (caller holds the lock)"""
+        self._loaded = True
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                saved = json.load(f)
+            if saved.get("clean"):
+                self._base = int(saved["base"])
+                self._versions = {str(k): int(v) for k, v in saved["versions"].items()}
+            else:
+                logger.warning("Data versions file %s was not closed cleanly, starting from a new base", self.path)
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            logger.warning("Ignoring unreadable data versions file %s", self.path)
+
+    def get(self, key: Hashable) -> int:
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            return self._base + self._versions.get(_name(key), 0)
+
+    def bump(self, keys: Iterable[Hashable]):
+        """Increment every key once (duplicates count once)"""
+        names = {_name(key) for key in keys}
+        if not names:
+            return
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            for name in names:
+                self._versions[name] = self._versions.get(name, 0) + 1
+            self.bumps += 1
+            mark = bool(self.path) and not self._marked
+            self._marked = True
+            # Un solo salvataggio per tutti gli incrementi dei prossimi save_delay secondi
+            if self.path and not mark and self._timer is None:
+                self._timer = threading.Timer(self.save_delay, self.save)
+                self._timer.daemon = True
+                self._timer.start()
+        if mark:
+            self.save()
+
+    def save(self, clean: bool = False):
+        """Write the counters to the file; clean=True marks a regular shutdown"""
+        if not self.path:
+            return
+        with self._save_lock:
+            with self._lock:
+                self._timer = None
+                if not self._loaded:
+                    self._load()
+                if clean:
+                    self._marked = False
+                snapshot = {"base": self._base, "clean": clean, "versions": dict(self._versions)}
+            tmp_path = self.path + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(snapshot, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self.saves += 1
+            except OSError:
+                logger.exception("Could not save data versions to %s", self.path)
+
+    def close(self):
+        """Cancel the pending save and write the file one last time, marked as closed cleanly"""
+        with self._lock:
+            timer, self._timer = self._timer, None
+        if timer is not None:
+            timer.cancel()
+        self.save(clean=True)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"keys": len(self._versions), "bumps": self.bumps, "saves": self.saves}
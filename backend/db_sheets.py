@@ -5,11 +5,30 @@ Sostituisce MongoDB con Google Sheets come database
 
 import os
 import json
+import time
+import hashlib
+import logging
+import threading
+import itertools
 import gspread
+import requests
 from google.oauth2.service_account import Credentials
-from typing import List, Dict, Optional, Any
+from google.auth.transport.requests import Request
+from typing import List, Dict, Iterator, Optional, Any, Tuple
 from datetime import datetime
 
+from table_cache import TableCache, FIRST_DATA_ROW
+from row_index import RowIndex
+from write_behind import WriteBehindQueue
+from quota_scheduler import QuotaScheduler, ScheduledProxy, BULK, priority
+from monthly_aggregates import MonthlyAggregates, HEADERS as AGGREGATE_HEADERS, decode_record, diff as diff_aggregates
+from stats import contributions as workday_contributions
+from data_versions import DataVersions
+from city_resolver import CityResolver
+import workday_pages
+
+logger = logging.getLogger(__name__)
+
 # ==================== CONFIG ====================
 
 SPREADSHEET_ID = "1oUun7urYjJZeLz8G8Lnbo3g9Eyptt34yGEAhNdZFBeA"
@@ -19,10 +38,178 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive",
 ]
 
+# Connessioni HTTP keep-alive verso sheets.googleapis.com tenute aperte dal pool
+HTTP_POOL_SIZE = int(os.environ.get("SHEETS_HTTP_POOL_SIZE", "10"))
+
+# Quote API Sheets (richieste al minuto per utente, il service account è un utente)
+READ_QUOTA_PER_MINUTE = int(os.environ.get("SHEETS_READ_QUOTA", "60"))
+WRITE_QUOTA_PER_MINUTE = int(os.environ.get("SHEETS_WRITE_QUOTA", "60"))
+QUOTA_MAX_RETRIES = int(os.environ.get("SHEETS_MAX_RETRIES", "5"))
+QUOTA_MAX_WAIT_SECONDS = float(os.environ.get("SHEETS_QUOTA_MAX_WAIT", "30"))
+
+# Cache in memoria di users / cities / roles
+CACHE_TTL_SECONDS = float(os.environ.get("SHEETS_CACHE_TTL", "60"))
+CACHE_MAX_BYTES = int(os.environ.get("SHEETS_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Workdays in un foglio per anno (workdays_2025, workdays_2026, ...) invece di
+# un unico foglio "workdays". Prima di attivarlo: python repartition_workdays.py
+WORKDAYS_PARTITIONED = os.environ.get("SHEETS_WORKDAYS_PARTITIONED", "false").lower() == "true"
+WORKDAYS_SHEET = "workdays"
+
+# Cancellazioni soft: la riga viene marcata nella colonna "deleted" con una sola
+# scrittura (le righe sotto non si spostano) e rimossa fisicamente più tardi da
+# compact_tables(), che il server lancia ogni SHEETS_COMPACT_INTERVAL secondi
+SOFT_DELETE = os.environ.get("SHEETS_SOFT_DELETE", "false").lower() == "true"
+COMPACT_INTERVAL_SECONDS = float(os.environ.get("SHEETS_COMPACT_INTERVAL", "300"))
+DELETED_COLUMN = "deleted"
+
+# Write-behind: create/update finiscono in un journal locale e vengono scritte
+# in blocco ogni SHEETS_WRITE_BEHIND_INTERVAL secondi (o oltre MAX_OPS in coda)
+WRITE_BEHIND = os.environ.get("SHEETS_WRITE_BEHIND", "false").lower() == "true"
+WRITE_BEHIND_JOURNAL = os.environ.get("SHEETS_WRITE_BEHIND_JOURNAL", "sheets_journal.jsonl")
+WRITE_BEHIND_INTERVAL = float(os.environ.get("SHEETS_WRITE_BEHIND_INTERVAL", "2"))
+WRITE_BEHIND_MAX_OPS = int(os.environ.get("SHEETS_WRITE_BEHIND_MAX_OPS", "100"))
+
+# Totali mensili per (user_id, anno, mese) mantenuti a ogni scrittura dei
+# workdays e salvati nel foglio "monthly_stats": le statistiche di un mese si
+# leggono da lì invece di rileggere tutti i workdays
+MONTHLY_AGGREGATES = os.environ.get("SHEETS_MONTHLY_AGGREGATES", "false").lower() == "true"
+AGGREGATES_SHEET = "monthly_stats"
+
+# Contatori di versione per (utente, anno, mese), aumentati a ogni scrittura dei
+# workdays: le cache derivate (PDF mensili) li usano come chiave di validità.
+# Senza file restano in memoria e ripartono da una base nuova a ogni avvio
+DATA_VERSIONS_FILE = os.environ.get("SHEETS_DATA_VERSIONS_FILE", "")
+DATA_VERSIONS_SAVE_SECONDS = float(os.environ.get("SHEETS_DATA_VERSIONS_SAVE_SECONDS", "1"))
+# Le modifiche fatte a mano sul foglio cambiano le versioni quando una lettura
+# completa le trova: users/cities/roles dopo il TTL della cache, i workdays
+# (non in cache) al massimo ogni SHEETS_VERSION_REFRESH secondi
+VERSION_REFRESH_SECONDS = float(os.environ.get("SHEETS_VERSION_REFRESH", "300"))
+
+# Righe lette per chiamata dall'export in streaming dei workdays (iter_workdays)
+EXPORT_CHUNK_ROWS = int(os.environ.get("SHEETS_EXPORT_CHUNK_ROWS", "500"))
+
+SHEETS_CONFIG = {
+    "users": ["id", "username", "email", "password_hash", "role", "blocked", "created_at"],
+    "cities": ["id", "name", "travel_minutes", "created_at"],
+    "workdays": [
+        "id", "user_id", "date", "city", "is_custom_city",
+        "custom_city_name", "custom_distance_km", "custom_travel_minutes",
+        "travel_minutes_outbound", "travel_minutes_return", "work_minutes",
+        "arrival_time", "departure_home", "exit_time", "return_home",
+        "actual_arrival_at_store", "actual_exit_from_store", "actual_return_home",
+        "status", "created_at",
+    ],
+    "roles": ["id", "name", "permissions", "custom", "created_at"],
+}
+
+
+# ==================== QUOTA ====================
+# Ogni chiamata remota passa da _remote(): token bucket letture/scritture,
+# priorità (interattive prima delle bulk) e retry con backoff su 429/5xx.
+# Spreadsheet e worksheet sono avvolti in un proxy che instrada i metodi API.
+
+quota = QuotaScheduler(
+    read_per_minute=READ_QUOTA_PER_MINUTE,
+    write_per_minute=WRITE_QUOTA_PER_MINUTE,
+    max_retries=QUOTA_MAX_RETRIES,
+    max_wait=QUOTA_MAX_WAIT_SECONDS,
+)
+
+# metodo -> (quota, idempotente); i non idempotenti si ritentano solo su 429
+SPREADSHEET_METHODS = {
+    "worksheet": ("read", True),
+    "worksheets": ("read", True),
+    "values_batch_get": ("read", True),
+    "add_worksheet": ("write", False),
+    "del_worksheet": ("write", False),
+    "batch_update": ("write", False),
+}
+WORKSHEET_METHODS = {
+    "get_all_records": ("read", True),
+    "get_all_values": ("read", True),
+    "row_values": ("read", True),
+    "col_values": ("read", True),
+    "get": ("read", True),
+    "batch_get": ("read", True),
+    "update_cell": ("write", True),
+    "update": ("write", True),
+    "batch_update": ("write", True),
+    "append_row": ("write", False),
+    "append_rows": ("write", False),
+    "delete_rows": ("write", False),
+    "add_cols": ("write", False),
+}
+
+
+def _remote(kind: str, fn, *args, idempotent: bool = True, **kwargs):
+    """Run one Sheets API call through the quota scheduler"""
+    return quota.call(kind, fn, *args, idempotent=idempotent, **kwargs)
+
+
+def _scheduled_spreadsheet(spreadsheet) -> ScheduledProxy:
+    return ScheduledProxy(spreadsheet, quota, SPREADSHEET_METHODS)
+
+
+def _scheduled_worksheet(sheet) -> ScheduledProxy:
+    if isinstance(sheet, ScheduledProxy):
+        return sheet
+    return ScheduledProxy(sheet, quota, WORKSHEET_METHODS)
+
+
+def quota_stats() -> Dict[str, Any]:
+    """Token bucket levels, queue wait times and retry counters"""
+    return quota.stats()
+
+
+# ==================== CLIENT POOL ====================
+# Client, spreadsheet e worksheet vengono creati una sola volta per processo
+# e riusati da tutte le funzioni: ogni richiesta paga solo la chiamata dati.
+
+_client_lock = threading.RLock()
+_credentials: Optional[Credentials] = None
+_client: Optional[gspread.Client] = None
+_spreadsheet: Optional[ScheduledProxy] = None
+_worksheets: Dict[str, ScheduledProxy] = {}
+_token_session = requests.Session()
+
+
+def _load_credentials() -> Credentials:
+    """Build service account credentials from SERVICE_ACCOUNT_JSON"""
+    sa_json = os.environ.get("SERVICE_ACCOUNT_JSON")
+    if not sa_json:
+        raise RuntimeError(
+            "Missing SERVICE_ACCOUNT_JSON. "
+            "Set it as an environment variable (Fly secret) with the service account JSON."
+        )
+
+    creds_info = json.loads(sa_json)
+    return Credentials.from_service_account_info(creds_info, scopes=SCOPES)
+
+
+def _mount_http_pool(client: gspread.Client):
+    """Replace the default connection pool of the client session with a larger keep-alive pool"""
+    http_client = getattr(client, "http_client", client)  # gspread >= 6 / < 6
+    session = getattr(http_client, "session", None)
+    if session is None:
+        return
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+    )
+    session.mount("https://", adapter)
+
+
+def _refresh_credentials():
+    """Refresh the access token before it expires (called with _client_lock held)"""
+    if _credentials is not None and not _credentials.valid:
+        _credentials.refresh(Request(session=_token_session))
+        logger.debug("Sheets access token refreshed")
+
 
 def get_sheets_client():
     """
-    Initialize and return gspread client.
+    Return the process-wide gspread client (created on first use).
 
     In produzione (Fly) prende le credenziali da env:
       SERVICE_ACCOUNT_JSON = contenuto JSON del service account
@@ -30,72 +217,338 @@ def get_sheets_client():
     In locale puoi comunque usare lo stesso metodo facendo:
       export SERVICE_ACCOUNT_JSON="$(cat service_account.json)"
     """
-    sa_json = os.environ.get("SERVICE_ACCOUNT_JSON")
-    if not sa_json:
-        raise RuntimeError(
-            "Missing SERVICE_ACCOUNT_JSON. "
-            "Set it as an environment variable (Fly secret) with the service account JSON."
-        )
-
-    creds_info = json.loads(sa_json)
-    creds = Credentials.from_service_account_info(creds_info, scopes=SCOPES)
-    return gspread.authorize(creds)
+    global _client, _credentials
+    with _client_lock:
+        if _client is None:
+            _credentials = _load_credentials()
+            _client = gspread.authorize(_credentials)
+            _mount_http_pool(_client)
+        _refresh_credentials()
+        return _client
 
 
 def get_spreadsheet():
-    """Get the main spreadsheet"""
-    client = get_sheets_client()
-    return client.open_by_key(SPREADSHEET_ID)
+    """Get the main spreadsheet (opened once and cached)"""
+    global _spreadsheet
+    with _client_lock:
+        if _spreadsheet is None:
+            _spreadsheet = _scheduled_spreadsheet(_remote("read", get_sheets_client().open_by_key, SPREADSHEET_ID))
+        elif _client is not None:
+            _refresh_credentials()
+        return _spreadsheet
+
+
+def get_worksheet(title: str) -> gspread.Worksheet:
+    """Get a worksheet handle by title (cached, raises WorksheetNotFound)"""
+    with _client_lock:
+        spreadsheet = get_spreadsheet()
+        sheet = _worksheets.get(title)
+        if sheet is None:
+            sheet = _scheduled_worksheet(spreadsheet.worksheet(title))
+            _worksheets[title] = sheet
+        return sheet
+
+
+def use_spreadsheet(spreadsheet):
+    """Replace the remote spreadsheet with another object (e.g. fake_sheets.FakeSpreadsheet)"""
+    global _spreadsheet
+    reset_client()
+    with _client_lock:
+        _spreadsheet = _scheduled_spreadsheet(spreadsheet)
+    _cache.invalidate()
+
+
+def reset_client():
+    """Drop all cached handles, the next call re-authorizes from scratch"""
+    global _client, _credentials, _spreadsheet
+    with _client_lock:
+        _client = None
+        _credentials = None
+        _spreadsheet = None
+        _worksheets.clear()
+    with _column_maps_lock:
+        _column_maps.clear()
+    with _row_indexes_lock:
+        _row_indexes.clear()
+    with _workdays_write_lock:
+        _partitions.clear()
+        _partitions_loaded.clear()
+        _aggregates.reset()
+    with _reads_lock:
+        _reads.clear()
+
+
+# ==================== TABLE CACHE ====================
+
+def _lower(value: Any) -> str:
+    return str(value).strip().lower()
+
+
+# Indici hash mantenuti sulle tabelle in cache (campo -> normalizzazione chiave)
+CACHE_INDEXES = {
+    "users": {"id": None, "email": _lower, "username": None},
+    "cities": {"id": None},
+}
+
+_cache = TableCache(ttl_seconds=CACHE_TTL_SECONDS, max_bytes=CACHE_MAX_BYTES, indexes=CACHE_INDEXES)
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters and memory usage of the table cache"""
+    stats = _cache.stats()
+    with _row_indexes_lock:
+        stats["row_indexes"] = {title: index.stats() for title, index in _row_indexes.items()}
+    if WRITE_BEHIND:
+        stats["write_behind"] = _write_behind.stats()
+    if MONTHLY_AGGREGATES:
+        stats["monthly_aggregates"] = _aggregates.stats()
+    stats["data_versions"] = _versions.stats()
+    if _city_resolver is not None:
+        stats["city_resolver"] = _city_resolver.stats()
+    return stats
+
+
+def invalidate_cache(table: Optional[str] = None):
+    """Force a reload of one cached table (or all) on next read"""
+    _cache.invalidate(table)
+    with _row_indexes_lock:
+        for title, index in _row_indexes.items():
+            if table is None or title == table:
+                index.invalidate()
+    # Dati forse cambiati a mano sul foglio: ETag e resolver delle città vanno rifatti
+    if table is None:
+        _versions.bump([(name,) for name in SHEETS_CONFIG])
+    else:
+        _versions.bump([("workdays",) if table.startswith(WORKDAYS_SHEET) else (table,)])
+
+
+def _record_from_row(table: str, row: List[Any]) -> Dict[str, Any]:
+    """Build the record get_all_records() would return for a freshly written row"""
+    return dict(zip(SHEETS_CONFIG[table], row))
+
+
+# ==================== ROW WRITES ====================
+# Le modifiche a una riga vengono confrontate con i valori correnti e scritte
+# con una sola chiamata batch_update, invece di un update_cell per colonna.
+
+_column_maps: Dict[str, Dict[str, int]] = {}
+_column_maps_lock = threading.Lock()
+
+
+def get_column_map(title: str) -> Dict[str, int]:
+    """Header -> 1-based column number of a worksheet (cached)"""
+    with _column_maps_lock:
+        col_map = _column_maps.get(title)
+    if col_map is None:
+        headers = get_worksheet(title).row_values(1)
+        col_map = {header: idx for idx, header in enumerate(headers, start=1) if header}
+        with _column_maps_lock:
+            _column_maps[title] = col_map
+    return col_map
+
+
+def _cell_value(value: Any) -> Any:
+    """Value as written to the sheet"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return str(value)
+    return value
+
+
+def diff_row(col_map: Dict[str, int], row: int, current: Dict[str, Any],
+             changes: Dict[str, Any]) -> Tuple[List[Dict[str, Any]], int]:
+    """
+    Build the batch update payload for the changed cells of one row.
+
+    Only keys that exist as columns are considered, and values equal to the
+    current row are skipped. Returns (payload, number of candidate cells).
+    """
+    data = []
+    candidates = 0
+    for key, value in changes.items():
+        if key not in col_map:
+            continue
+        candidates += 1
+        if key in current and str(_cell_value(current[key])) == str(_cell_value(value)):
+            continue
+        data.append({
+            "range": gspread.utils.rowcol_to_a1(row, col_map[key]),
+            "values": [[_cell_value(value)]],
+        })
+    return data, candidates
+
+
+def log_row_write(title: str, row: int, written: int, candidates: int):
+    logger.info(
+        "%s row %d: %d/%d cells changed, %d API call(s) saved",
+        title, row, written, candidates, candidates - (1 if written else 0),
+    )
+
+
+def write_row(title: str, row: int, current: Dict[str, Any], changes: Dict[str, Any]) -> int:
+    """Write the changed cells of one sheet row with a single API call, returns cells written"""
+    data, candidates = diff_row(get_column_map(title), row, current, changes)
+    if data:
+        get_worksheet(title).batch_update(data, value_input_option="USER_ENTERED")
+    log_row_write(title, row, len(data), candidates)
+    return len(data)
+
+
+# ==================== TOMBSTONES ====================
+
+# Scritture su users/cities che dipendono dal numero di riga (la compattazione lo cambia)
+_tables_write_lock = threading.RLock()
+
+
+def _strip_tombstone(record: Dict[str, Any]) -> bool:
+    """Remove the deleted column from a record, True if the row is a tombstone"""
+    return str(record.pop(DELETED_COLUMN, "")).lower() == "true"
+
+
+def _live_records(records: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Records for the table cache: tombstones become {} placeholders to keep row positions"""
+    return [{} if _strip_tombstone(r) else r for r in records]
+
+
+def _deleted_column(title: str) -> int:
+    """Column number of the deleted flag, adding the header on first use"""
+    col_map = get_column_map(title)
+    col = col_map.get(DELETED_COLUMN)
+    if col is None:
+        sheet = get_worksheet(title)
+        col = max(col_map.values(), default=0) + 1
+        if sheet.col_count < col:
+            sheet.add_cols(col - sheet.col_count)
+        sheet.update_cell(1, col, DELETED_COLUMN)
+        with _column_maps_lock:
+            _column_maps[title] = {**col_map, DELETED_COLUMN: col}
+    return col
+
+
+def mark_deleted(title: str, row: int):
+    """Tombstone one sheet row with a single cell write"""
+    get_worksheet(title).update_cell(row, _deleted_column(title), "TRUE")
+
+
+def _row_runs(rows: List[int]) -> List[Tuple[int, int]]:
+    """Contiguous (first, last) row ranges, bottom-up so each delete leaves the others valid"""
+    runs: List[Tuple[int, int]] = []
+    for row in sorted(rows, reverse=True):
+        if runs and runs[-1][0] == row + 1:
+            runs[-1] = (row, runs[-1][1])
+        else:
+            runs.append((row, row))
+    return runs
+
+
+def compact_tables() -> Dict[str, int]:
+    """
+    Physically remove tombstoned rows of users, cities and workdays.
+
+    One values_batch_get reads the deleted column of every table, one
+    spreadsheet.batch_update deletes all marked rows. Row-number dependent
+    writes are blocked meanwhile, caches and row indexes are reloaded after.
+    """
+    flush_writes()
+    titles = ["users", "cities"] + _workdays_titles()
+    with _tables_write_lock, _workdays_write_lock:
+        ranges = {}
+        for title in titles:
+            try:
+                col = get_column_map(title).get(DELETED_COLUMN)
+            except gspread.exceptions.WorksheetNotFound:
+                continue
+            if col:
+                letter = gspread.utils.rowcol_to_a1(1, col)[:-1]
+                ranges[title] = f"'{title}'!{letter}{FIRST_DATA_ROW}:{letter}"
+        if not ranges:
+            return {}
+
+        spreadsheet = get_spreadsheet()
+        value_ranges = spreadsheet.values_batch_get(list(ranges.values())).get("valueRanges", [])
+        requests_body = []
+        removed = {}
+        for title, value_range in zip(ranges, value_ranges):
+            rows = [
+                row for row, values in enumerate(value_range.get("values", []), start=FIRST_DATA_ROW)
+                if values and str(values[0]).lower() == "true"
+            ]
+            if not rows:
+                continue
+            sheet_id = get_worksheet(title).id
+            for first, last in _row_runs(rows):
+                requests_body.append({"deleteDimension": {"range": {
+                    "sheetId": sheet_id, "dimension": "ROWS", "startIndex": first - 1, "endIndex": last,
+                }}})
+            removed[title] = len(rows)
+
+        if requests_body:
+            spreadsheet.batch_update({"requests": requests_body})
+            for title in removed:
+                _cache.invalidate(title)
+                _row_index(title).invalidate()
+            _versions.bump([("workdays",) if title.startswith(WORKDAYS_SHEET) else (title,) for title in removed])
+            logger.info("Compacted %d tombstoned rows: %s", sum(removed.values()), removed)
+        return removed
 
 
 # ==================== USERS ====================
 
-def get_all_users() -> List[Dict[str, Any]]:
-    """Get all users from 'users' sheet"""
+def _normalize_user(record: Dict[str, Any]) -> Dict[str, Any]:
+    # Convert 'blocked' string to boolean
+    if "blocked" in record:
+        record["blocked"] = str(record["blocked"]).lower() == "true"
+    return record
+
+
+def _load_users() -> List[Dict[str, Any]]:
+    version = table_version("users")
     try:
-        sheet = get_spreadsheet().worksheet("users")
-        records = sheet.get_all_records()
-        # Convert 'blocked' string to boolean
-        for record in records:
-            if "blocked" in record:
-                record["blocked"] = str(record["blocked"]).lower() == "true"
-        return records
+        sheet = get_worksheet("users")
+        records = _live_records(sheet.get_all_records())
     except gspread.exceptions.WorksheetNotFound:
-        return []
+        records = []
+    note_read("users", "users", records, version)
+    return [_normalize_user(r) for r in _overlay_pending("users", records)]
+
+
+def get_all_users() -> List[Dict[str, Any]]:
+    """Get all users from 'users' sheet (cached)"""
+    return _cache.get("users", _load_users)
+
+
+def find_user(field: str, value: Any) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Find a user through the id/email/username index, returning (sheet row, user)"""
+    return _cache.lookup("users", field, value, _load_users)
+
+
+def get_user_row(user_id: str) -> Optional[int]:
+    """Sheet row number of a user, or None"""
+    found = find_user("id", user_id)
+    return found[0] if found else None
 
 
 def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
     """Find user by ID"""
-    users = get_all_users()
-    for user in users:
-        if user.get("id") == user_id:
-            return user
-    return None
+    found = find_user("id", user_id)
+    return found[1] if found else None
 
 
 def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
-    """Find user by email"""
-    users = get_all_users()
-    for user in users:
-        if user.get("email") == email:
-            return user
-    return None
+    """Find user by email (case-insensitive)"""
+    found = find_user("email", email)
+    return found[1] if found else None
 
 
 def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
     """Find user by username"""
-    users = get_all_users()
-    for user in users:
-        if user.get("username") == username:
-            return user
-    return None
-
+    found = find_user("username", username)
+    return found[1] if found else None
 
-def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Create new user"""
-    sheet = get_spreadsheet().worksheet("users")
 
-    row = [
+def _user_row(user_data: Dict[str, Any]) -> List[Any]:
+    return [
         user_data.get("id", ""),
         user_data.get("username", ""),
         user_data.get("email", ""),
@@ -104,134 +557,235 @@ def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
         str(user_data.get("blocked", False)),
         user_data.get("created_at", datetime.now().isoformat()),
     ]
-    sheet.append_row(row)
+
+
+def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new user"""
+    sheet = get_worksheet("users")
+
+    row = _user_row(user_data)
+    record = _normalize_user(_record_from_row("users", row))
+    if WRITE_BEHIND:
+        _write_behind.create("users", record["id"], record)
+    else:
+        sheet.append_row(row)
+    _cache.append("users", record)
+    _versions.bump([("users",)])
+    _track_user(record)
     return user_data
 
 
 def update_user(user_id: str, update_data: Dict[str, Any]) -> bool:
     """Update user by ID"""
-    sheet = get_spreadsheet().worksheet("users")
-    records = sheet.get_all_records()
-
-    for idx, record in enumerate(records, start=2):  # row 1 è header
-        if record.get("id") == user_id:
-            for key, value in update_data.items():
-                if key in record:
-                    col_idx = list(record.keys()).index(key) + 1
-                    if key == "blocked":
-                        value = str(value)
-                    sheet.update_cell(idx, col_idx, value)
-            return True
-    return False
+    with _tables_write_lock:
+        found = find_user("id", user_id)
+        if not found:
+            return False
+        idx, record = found
+
+        if WRITE_BEHIND:
+            _write_behind.update("users", user_id, update_data)
+        else:
+            write_row("users", idx, record, update_data)
+        _cache.update("users", "id", user_id, update_data)
+    _versions.bump([("users",)])
+    record.update({k: v for k, v in update_data.items() if k in record})
+    _track_user(record)
+    return True
 
 
 def delete_user(user_id: str) -> bool:
-    """Delete user by ID"""
-    sheet = get_spreadsheet().worksheet("users")
-    records = sheet.get_all_records()
+    """Delete user by ID (tombstone if SOFT_DELETE)"""
+    flush_writes()
+    with _tables_write_lock:
+        idx = get_user_row(user_id)
+        if idx is None:
+            return False
+
+        if SOFT_DELETE:
+            mark_deleted("users", idx)
+            _cache.tombstone("users", "id", user_id)
+        else:
+            get_worksheet("users").delete_rows(idx)
+            _cache.remove("users", "id", user_id)
+    _versions.bump([("users",)])
+    _revoke_user(user_id)
+    return True
+
+
+# ==================== REVOCATIONS ====================
+# Stato minimo per l'autenticazione "claims-only": utenti bloccati/eliminati e
+# ruolo corrente di ogni utente. Aggiornato subito da update_user/delete_user e
+# ricaricato periodicamente dal foglio con refresh_revocations().
+
+_revocation_lock = threading.Lock()
+_revoked_user_ids: set = set()
+_user_roles: Dict[str, str] = {}
+_revocations_loaded = False
 
-    for idx, record in enumerate(records, start=2):
-        if record.get("id") == user_id:
-            sheet.delete_rows(idx)
-            return True
-    return False
+
+def _track_user(user: Dict[str, Any]):
+    with _revocation_lock:
+        if user.get("blocked"):
+            _revoked_user_ids.add(user["id"])
+        else:
+            _revoked_user_ids.discard(user["id"])
+        _user_roles[user["id"]] = user.get("role", "user")
+
+
+def _revoke_user(user_id: str):
+    with _revocation_lock:
+        _revoked_user_ids.add(user_id)
+        _user_roles.pop(user_id, None)
+
+
+def set_revocations(users: List[Dict[str, Any]]):
+    """Replace the revocation state with a fresh copy of the users table"""
+    global _revoked_user_ids, _user_roles, _revocations_loaded
+    with _revocation_lock:
+        _revoked_user_ids = {u["id"] for u in users if u.get("blocked")}
+        _user_roles = {u["id"]: u.get("role", "user") for u in users if not u.get("blocked")}
+        _revocations_loaded = True
+
+
+def revocations_loaded() -> bool:
+    return _revocations_loaded
+
+
+def claims_role(user_id: str) -> Optional[str]:
+    """Current role of a user from the revocation state, None if revoked or unknown"""
+    with _revocation_lock:
+        if user_id in _revoked_user_ids:
+            return None
+        # Utente sconosciuto dopo il caricamento = eliminato (o mai esistito)
+        return _user_roles.get(user_id)
+
+
+def refresh_revocations():
+    """Reload blocked users and roles from the users sheet (also refreshes the cache)"""
+    _cache.invalidate("users")
+    set_revocations(get_all_users())
+
+
+def check_token_claims(user_id: str) -> Optional[str]:
+    """Return the current role of a token's user, or None if the user is revoked"""
+    if not _revocations_loaded:
+        refresh_revocations()
+    return claims_role(user_id)
 
 
 # ==================== CITIES ====================
 
-def get_all_cities() -> List[Dict[str, Any]]:
-    """Get all cities from 'cities' sheet"""
+def _load_cities() -> List[Dict[str, Any]]:
+    version = table_version("cities")
     try:
-        sheet = get_spreadsheet().worksheet("cities")
-        return sheet.get_all_records()
+        sheet = get_worksheet("cities")
+        records = _live_records(sheet.get_all_records())
     except gspread.exceptions.WorksheetNotFound:
-        return []
+        records = []
+    note_read("cities", "cities", records, version)
+    return _overlay_pending("cities", records)
+
+
+def get_all_cities() -> List[Dict[str, Any]]:
+    """Get all cities from 'cities' sheet (cached)"""
+    return _cache.get("cities", _load_cities)
+
+
+def find_city(city_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Find a city by ID, returning (sheet row, city)"""
+    return _cache.lookup("cities", "id", city_id, _load_cities)
 
 
 def get_city_by_id(city_id: str) -> Optional[Dict[str, Any]]:
     """Find city by ID"""
-    cities = get_all_cities()
-    for city in cities:
-        if city.get("id") == city_id:
-            return city
-    return None
+    found = find_city(city_id)
+    return found[1] if found else None
 
 
-def create_city(city_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Create new city"""
-    sheet = get_spreadsheet().worksheet("cities")
-
-    row = [
+def _city_row(city_data: Dict[str, Any]) -> List[Any]:
+    return [
         city_data.get("id", ""),
         city_data.get("name", ""),
         city_data.get("travel_minutes", 0),
         city_data.get("created_at", datetime.now().isoformat()),
     ]
-    sheet.append_row(row)
+
+
+def create_city(city_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new city"""
+    sheet = get_worksheet("cities")
+
+    row = _city_row(city_data)
+    record = _record_from_row("cities", row)
+    if WRITE_BEHIND:
+        _write_behind.create("cities", record["id"], record)
+    else:
+        sheet.append_row(row)
+    _cache.append("cities", record)
+    _versions.bump([("cities",)])
     return city_data
 
 
 def update_city(city_id: str, update_data: Dict[str, Any]) -> bool:
     """Update city by ID"""
-    sheet = get_spreadsheet().worksheet("cities")
-    records = sheet.get_all_records()
-
-    for idx, record in enumerate(records, start=2):
-        if record.get("id") == city_id:
-            for key, value in update_data.items():
-                if key in record:
-                    col_idx = list(record.keys()).index(key) + 1
-                    sheet.update_cell(idx, col_idx, value)
-            return True
-    return False
-
+    with _tables_write_lock:
+        found = find_city(city_id)
+        if not found:
+            return False
+        idx, record = found
 
-def delete_city(city_id: str) -> bool:
-    """Delete city by ID"""
-    sheet = get_spreadsheet().worksheet("cities")
-    records = sheet.get_all_records()
+        if WRITE_BEHIND:
+            _write_behind.update("cities", city_id, update_data)
+        else:
+            write_row("cities", idx, record, update_data)
+        _cache.update("cities", "id", city_id, update_data)
+    _versions.bump([("cities",)])
+    return True
 
-    for idx, record in enumerate(records, start=2):
-        if record.get("id") == city_id:
-            sheet.delete_rows(idx)
-            return True
-    return False
 
+def delete_city(city_id: str) -> bool:
+    """Delete city by ID (tombstone if SOFT_DELETE)"""
+    flush_writes()
+    with _tables_write_lock:
+        found = find_city(city_id)
+        if not found:
+            return False
 
-# ==================== WORKDAYS ====================
+        if SOFT_DELETE:
+            mark_deleted("cities", found[0])
+            _cache.tombstone("cities", "id", city_id)
+        else:
+            get_worksheet("cities").delete_rows(found[0])
+            _cache.remove("cities", "id", city_id)
+    _versions.bump([("cities",)])
+    return True
 
-def get_all_workdays(user_id: Optional[str] = None) -> List[Dict[str, Any]]:
-    """Get all workdays, optionally filtered by user_id"""
-    try:
-        sheet = get_spreadsheet().worksheet("workdays")
-        records = sheet.get_all_records()
 
-        if user_id:
-            records = [r for r in records if r.get("user_id") == user_id]
+_city_resolver: Optional[CityResolver] = None
+_city_resolver_lock = threading.Lock()
 
-        for record in records:
-            if "is_custom_city" in record:
-                record["is_custom_city"] = str(record["is_custom_city"]).lower() == "true"
 
-        return records
-    except gspread.exceptions.WorksheetNotFound:
-        return []
+def city_resolver() -> CityResolver:
+    """Resolver of the cities sheet, rebuilt only after create_city/update_city/delete_city"""
+    global _city_resolver
+    version = _versions.get(("cities",))
+    with _city_resolver_lock:
+        if _city_resolver is None or _city_resolver.version != version:
+            _city_resolver = CityResolver(get_all_cities(), version)
+        return _city_resolver
 
 
-def get_workday_by_date(user_id: str, date: str) -> Optional[Dict[str, Any]]:
-    """Find workday by user_id and date"""
-    workdays = get_all_workdays(user_id)
-    for wd in workdays:
-        if wd.get("date") == date:
-            return wd
-    return None
+# ==================== WORKDAYS ====================
 
+def _normalize_workday(record: Dict[str, Any]) -> Dict[str, Any]:
+    if "is_custom_city" in record:
+        record["is_custom_city"] = str(record["is_custom_city"]).lower() == "true"
+    return record
 
-def create_workday(workday_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Create new workday"""
-    sheet = get_spreadsheet().worksheet("workdays")
 
-    row = [
+def _workday_row(workday_data: Dict[str, Any]) -> List[Any]:
+    return [
         workday_data.get("id", ""),
         workday_data.get("user_id", ""),
         workday_data.get("date", ""),
@@ -253,140 +807,867 @@ def create_workday(workday_data: Dict[str, Any]) -> Dict[str, Any]:
         workday_data.get("status", ""),
         workday_data.get("created_at", datetime.now().isoformat()),
     ]
-    sheet.append_row(row)
+
+
+# Indice (user_id, date) -> riga del foglio, per leggere/scrivere un solo giorno
+# senza scaricare tutto lo storico. Le scritture sui workdays sono serializzate
+# nel processo perché una delete_rows sposta i numeri di riga.
+
+_row_indexes: Dict[str, RowIndex] = {}
+_row_indexes_lock = threading.Lock()
+_workdays_write_lock = threading.RLock()
+
+
+def _workday_key(record: Dict[str, Any]) -> Optional[Tuple[str, str]]:
+    user_id, date = record.get("user_id"), record.get("date")
+    if user_id in (None, "") or date in (None, ""):
+        return None
+    return str(user_id), str(date)
+
+
+def _row_index(title: str) -> RowIndex:
+    with _row_indexes_lock:
+        index = _row_indexes.get(title)
+        if index is None:
+            index = _row_indexes[title] = RowIndex(ttl_seconds=CACHE_TTL_SECONDS)
+        return index
+
+
+def load_workday_index(title: str = WORKDAYS_SHEET) -> RowIndex:
+    """Row index of a workdays sheet, rebuilt from the user_id/date columns only when stale"""
+    index = _row_index(title)
+    if index.fresh():
+        return index
+
+    with _workdays_write_lock:
+        if index.fresh():
+            return index
+        col_map = get_column_map(title)
+        if "user_id" not in col_map or "date" not in col_map:
+            index.load([])  # foglio nuovo o senza intestazioni
+            return index
+        fields = [f for f in ("user_id", "date", DELETED_COLUMN) if f in col_map]
+        columns = [gspread.utils.rowcol_to_a1(1, col_map[f])[:-1] for f in fields]
+        values = dict(zip(fields, get_worksheet(title).batch_get([f"{c}{FIRST_DATA_ROW}:{c}" for c in columns])))
+        length = max(len(v) for v in values.values())
+
+        def row(i: int) -> Dict[str, str]:
+            return {f: str(v[i][0]) if i < len(v) and v[i] else "" for f, v in values.items()}
+
+        index.load(_workday_key(r) if not _strip_tombstone(r) else None for r in map(row, range(length)))
+    return index
+
+
+def _read_row(title: str, row: int) -> Dict[str, Any]:
+    """One sheet row as the record get_all_records() would return"""
+    col_map = get_column_map(title)
+    values = get_worksheet(title).row_values(row)
+    values += [""] * (max(col_map.values(), default=0) - len(values))
+    values = gspread.utils.numericise_all(values)
+    return {header: values[col - 1] for header, col in col_map.items()}
+
+
+def find_workday(user_id: str, date: str, title: str = WORKDAYS_SHEET) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """(sheet row, record) of a workday via the row index, verified against the row read"""
+    key = (str(user_id), str(date))
+    for attempt in range(2):
+        index = load_workday_index(title)
+        row = index.find(key)
+        if row is None:
+            return None
+        record = _read_row(title, row)
+        if not _strip_tombstone(record) and _workday_key(record) == key:
+            return row, record
+        # Il foglio è cambiato fuori dal processo: ricostruisci l'indice e riprova
+        logger.warning("%s row index stale at row %d, rebuilding", title, row)
+        index.invalidate()
+    return None
+
+
+# ---- partizioni per anno ----
+
+_partitions: set = set()
+_partitions_loaded = threading.Event()
+
+
+def workday_period(date: str) -> Optional[Tuple[str, str]]:
+    """(year, month) of a workday date, YYYY-MM-DD or DD/MM/YYYY"""
+    date = str(date or "")
+    try:
+        if "-" in date:
+            year, month, _ = date.split("-")
+        elif "/" in date:
+            _, month, year = date.split("/")
+        else:
+            return None
+    except ValueError:
+        return None
+    return year, month.lstrip("0")
+
+
+def workday_in_period(record: Dict[str, Any], year: Optional[str] = None, month: Optional[str] = None) -> bool:
+    """True if the workday falls in the given year (and month, if set)"""
+    if not year and not month:
+        return True
+    period = workday_period(record.get("date", ""))
+    if period is None:
+        return False
+    if year and period[0] != str(year):
+        return False
+    if month and period[1] != str(month).lstrip("0"):
+        return False
+    return True
+
+
+def partition_title(date: str) -> Optional[str]:
+    """Year partition a workday date belongs to (workdays_YYYY), None if the date has no year"""
+    period = workday_period(date)
+    if period is None or not (len(period[0]) == 4 and period[0].isdigit()):
+        return None
+    return f"{WORKDAYS_SHEET}_{period[0]}"
+
+
+def workdays_title(date: str) -> str:
+    """Worksheet holding the workday for this date"""
+    if not WORKDAYS_PARTITIONED:
+        return WORKDAYS_SHEET
+    title = partition_title(date)
+    if title is None:
+        raise ValueError(f"Data non valida per le partizioni workdays: '{date}'")
+    return title
+
+
+def routable_date(date: str) -> bool:
+    """False if a date cannot be routed to a workdays sheet (malformed, with partitioning on)"""
+    return not WORKDAYS_PARTITIONED or partition_title(date) is not None
+
+
+def workday_partitions() -> List[str]:
+    """Existing year partitions, oldest first (the sheet list is read once per process)"""
+    with _workdays_write_lock:
+        if not _partitions_loaded.is_set():
+            prefix = f"{WORKDAYS_SHEET}_"
+            for ws in get_spreadsheet().worksheets():
+                if ws.title.startswith(prefix) and ws.title[len(prefix):].isdigit():
+                    _partitions.add(ws.title)
+            _partitions_loaded.set()
+        return sorted(_partitions)
+
+
+def _workdays_titles(year: Optional[str] = None) -> List[str]:
+    """Worksheets a query for this year (or all years) has to read"""
+    if not WORKDAYS_PARTITIONED:
+        return [WORKDAYS_SHEET]
+    partitions = workday_partitions()
+    if year:
+        title = f"{WORKDAYS_SHEET}_{year}"
+        return [title] if title in partitions else []
+    return partitions
+
+
+def ensure_workdays_sheet(title: str) -> gspread.Worksheet:
+    """Get a workdays worksheet, creating it with headers if missing"""
+    with _workdays_write_lock:
+        try:
+            return get_worksheet(title)
+        except gspread.exceptions.WorksheetNotFound:
+            headers = SHEETS_CONFIG["workdays"]
+            sheet = _scheduled_worksheet(get_spreadsheet().add_worksheet(title=title, rows=1000, cols=len(headers)))
+            sheet.append_row(headers)
+            with _client_lock:
+                _worksheets[title] = sheet
+            if title != WORKDAYS_SHEET:
+                _partitions.add(title)
+            logger.info("Created workdays partition %s", title)
+            return sheet
+
+
+# ---- CRUD ----
+
+def _read_workdays(title: str) -> List[Dict[str, Any]]:
+    """All records of one workdays sheet (refreshes its row index for free)"""
+    try:
+        sheet = get_worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        return []
+    index = _row_index(title)
+    version = index.version
+    data_version = table_version(WORKDAYS_SHEET)
+    records = _live_records(sheet.get_all_records())
+    # The full read already has every key in sheet order (tombstones are {} and not indexed)
+    index.load((_workday_key(r) for r in records), version=version)
+    records = [r for r in records if r]
+    note_read(title, WORKDAYS_SHEET, records, data_version)
+    return records
+
+
+def get_all_workdays(user_id: Optional[str] = None, year: Optional[str] = None,
+                     month: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Get all workdays, optionally filtered by user_id and period (only the year's partition is read)"""
+    def match(r: Dict[str, Any]) -> bool:
+        return (not user_id or r.get("user_id") == user_id) and workday_in_period(r, year, month)
+
+    result = []
+    for title in _workdays_titles(year):
+        result.extend(r for r in _read_workdays(title) if match(r))
+    return [_normalize_workday(r) for r in _overlay_pending("workdays", result, match)]
+
+
+def _page_titles(date_from: Optional[str], date_to: Optional[str]) -> List[str]:
+    """Worksheets that can hold dates in [date_from, date_to], oldest first"""
+    if not WORKDAYS_PARTITIONED:
+        return [WORKDAYS_SHEET]
+    prefix = f"{WORKDAYS_SHEET}_"
+    return [
+        title for title in workday_partitions()
+        if (not date_from or title[len(prefix):] >= date_from[:4])
+        and (not date_to or title[len(prefix):] <= date_to[:4])
+    ]
+
+
+def get_workdays_page(user_id: Optional[str] = None, date_from: Optional[str] = None,
+                      date_to: Optional[str] = None, after: Optional[Tuple[str, str]] = None,
+                      limit: int = 100, fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """
+    One page of workdays ordered by (date, user_id), returns (items, next cursor).
+    Only the year partitions in the date range (and from the cursor's year) are read,
+    in order, stopping as soon as the page is full; at most limit + 1 rows are kept.
+    """
+    # Le partizioni prima del cursore sono già state lette
+    first_date = max(date_from or "", after[0] if after else "") or None
+
+    def match(r: Dict[str, Any]) -> bool:
+        return workday_pages.matches(r, user_id, date_from, date_to, after)
+
+    candidates: List[Dict[str, Any]] = []
+    for title in _page_titles(first_date, date_to):
+        rows = (r for r in _read_workdays(title) if match(r))
+        candidates = workday_pages.select_page(itertools.chain(candidates, rows), limit)
+        if len(candidates) > limit:
+            # Le partizioni successive hanno solo date maggiori
+            break
+    candidates = workday_pages.select_page(_overlay_pending("workdays", candidates, match), limit)
+    return workday_pages.finish_page([_normalize_workday(r) for r in candidates], limit, fields)
+
+
+def _iter_sheet_records(title: str) -> Iterator[Dict[str, Any]]:
+    """Live records of a sheet in sheet order, read as fixed row ranges of EXPORT_CHUNK_ROWS rows"""
+    try:
+        sheet = get_worksheet(title)
+    except gspread.exceptions.WorksheetNotFound:
+        return
+    col_map = get_column_map(title)
+    if not col_map:
+        return
+    width = max(col_map.values())
+    last_col = gspread.utils.rowcol_to_a1(1, width)[:-1]
+    start = FIRST_DATA_ROW
+    while True:
+        values = sheet.get(f"A{start}:{last_col}{start + EXPORT_CHUNK_ROWS - 1}")
+        for row in values:
+            row = gspread.utils.numericise_all(list(row) + [""] * (width - len(row)))
+            record = {header: row[col - 1] for header, col in col_map.items()}
+            if not _strip_tombstone(record) and record.get("user_id"):
+                yield record
+        # L'API taglia le righe vuote in fondo: un blocco corto è l'ultimo
+        if len(values) < EXPORT_CHUNK_ROWS:
+            return
+        start += EXPORT_CHUNK_ROWS
+
+
+def iter_workdays(user_id: Optional[str] = None, date_from: Optional[str] = None,
+                  date_to: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Workdays for streaming exports, in sheet order within each year partition (oldest year
+    first, not sorted by date): EXPORT_CHUNK_ROWS rows are read per call, so only one
+    chunk is in memory.
+    """
+    # Le scritture in coda finiscono sul foglio prima di leggerlo
+    flush_writes()
+    for title in _page_titles(date_from, date_to):
+        for r in _iter_sheet_records(title):
+            if workday_pages.matches(r, user_id, date_from, date_to):
+                yield _normalize_workday(r)
+
+
+def get_workday_by_date(user_id: str, date: str) -> Optional[Dict[str, Any]]:
+    """Find workday by user_id and date"""
+    if not routable_date(date):
+        return None
+    key = (str(user_id), str(date))
+    if WRITE_BEHIND:
+        pending = _write_behind.pending_create("workdays", key)
+        if pending is not None:
+            return _normalize_workday(pending)
+    try:
+        found = find_workday(user_id, date, workdays_title(date))
+    except gspread.exceptions.WorksheetNotFound:
+        return None
+    if not found:
+        return None
+    record = found[1]
+    if WRITE_BEHIND:
+        record.update(_write_behind.pending_changes("workdays", key))
+    return _normalize_workday(record)
+
+
+def _append_workdays(title: str, workdays: List[Dict[str, Any]]):
+    sheet = ensure_workdays_sheet(title) if WORKDAYS_PARTITIONED else get_worksheet(title)
+    if len(workdays) == 1:
+        sheet.append_row(_workday_row(workdays[0]))
+    else:
+        sheet.append_rows([_workday_row(wd) for wd in workdays])
+    _row_index(title).append(_workday_key(wd) for wd in workdays)
+
+
+def create_workday(workday_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new workday"""
+    if WRITE_BEHIND:
+        _write_behind.create("workdays", _workday_key(workday_data), workday_data)
+        _versions.bump(_workday_keys([workday_data]))
+        return workday_data
+    with _workdays_write_lock:
+        _append_workdays(workdays_title(workday_data.get("date", "")), [workday_data])
+        _track_workdays(added=[workday_data])
     return workday_data
 
 
 def create_workdays_batch(workdays: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Create multiple workdays in batch (optimized for CSV import)"""
+    """Create multiple workdays in batch (one API call per year partition)"""
     if not workdays:
         return []
 
-    sheet = get_spreadsheet().worksheet("workdays")
+    if WRITE_BEHIND:
+        for wd in workdays:
+            _write_behind.create("workdays", _workday_key(wd), wd)
+        _versions.bump(_workday_keys(workdays))
+        return workdays
 
-    rows = []
+    by_title: Dict[str, List[Dict[str, Any]]] = {}
     for wd in workdays:
-        rows.append([
-            wd.get("id", ""),
-            wd.get("user_id", ""),
-            wd.get("date", ""),
-            wd.get("city", ""),
-            str(wd.get("is_custom_city", False)),
-            wd.get("custom_city_name", ""),
-            wd.get("custom_distance_km", ""),
-            wd.get("custom_travel_minutes", ""),
-            wd.get("travel_minutes_outbound", 0),
-            wd.get("travel_minutes_return", 0),
-            wd.get("work_minutes", 0),
-            wd.get("arrival_time", ""),
-            wd.get("departure_home", ""),
-            wd.get("exit_time", ""),
-            wd.get("return_home", ""),
-            wd.get("actual_arrival_at_store", ""),
-            wd.get("actual_exit_from_store", ""),
-            wd.get("actual_return_home", ""),
-            wd.get("status", ""),
-            wd.get("created_at", datetime.now().isoformat()),
-        ])
-
-    sheet.append_rows(rows)
+        by_title.setdefault(workdays_title(wd.get("date", "")), []).append(wd)
+
+    with _workdays_write_lock:
+        for title, rows in by_title.items():
+            _append_workdays(title, rows)
+        _track_workdays(added=workdays)
     return workdays
 
 
+def _delete_workday_row(title: str, row: int, key: Optional[Tuple[str, str]]):
+    if SOFT_DELETE:
+        mark_deleted(title, row)
+        _row_index(title).rekey(row, key, None)
+    else:
+        get_worksheet(title).delete_rows(row)
+        _row_index(title).remove_row(row)
+
+
 def update_workday(user_id: str, date: str, update_data: Dict[str, Any]) -> bool:
     """Update workday by user_id and date"""
-    sheet = get_spreadsheet().worksheet("workdays")
-    records = sheet.get_all_records()
-
-    for idx, record in enumerate(records, start=2):
-        if record.get("user_id") == user_id and record.get("date") == date:
-            for key, value in update_data.items():
-                if key in record:
-                    col_idx = list(record.keys()).index(key) + 1
-                    if key == "is_custom_city":
-                        value = str(value)
-                    sheet.update_cell(idx, col_idx, value if value is not None else "")
+    if not routable_date(date):
+        return False
+    if WRITE_BEHIND:
+        key = (str(user_id), str(date))
+        if _workday_key({"user_id": user_id, "date": date, **update_data}) == key:
+            if not _write_behind.has_pending("workdays", key) and not find_workday(user_id, date, workdays_title(date)):
+                return False
+            _write_behind.update("workdays", key, update_data)
+            _versions.bump(_workday_keys([{"user_id": user_id, "date": date}]))
             return True
-    return False
+        # Cambia la chiave della riga: scrive subito, dopo aver svuotato la coda
+        flush_writes()
+
+    title = workdays_title(date)
+    with _workdays_write_lock:
+        found = find_workday(user_id, date, title)
+        if not found:
+            return False
+        row, record = found
+        merged = {**record, **update_data}
+        new_title = workdays_title(merged.get("date", ""))
+        if new_title != title:
+            # The date moved to another year: move the row to that partition
+            _append_workdays(new_title, [_normalize_workday(merged)])
+            _delete_workday_row(title, row, _workday_key(record))
+        else:
+            write_row(title, row, record, update_data)
+            _row_index(title).rekey(row, _workday_key(record), _workday_key(merged))
+        _track_workdays(removed=[record], added=[merged])
+    return True
 
 
 def delete_workday(user_id: str, date: str) -> bool:
-    """Delete workday by user_id and date"""
-    sheet = get_spreadsheet().worksheet("workdays")
-    records = sheet.get_all_records()
+    """Delete workday by user_id and date (tombstone if SOFT_DELETE)"""
+    if not routable_date(date):
+        return False
+    flush_writes()
+    title = workdays_title(date)
+    with _workdays_write_lock:
+        found = find_workday(user_id, date, title)
+        if not found:
+            return False
+        _delete_workday_row(title, found[0], _workday_key(found[1]))
+        _track_workdays(removed=[found[1]])
+    return True
+
+
+def repartition_workdays(delete_source: bool = False) -> Dict[str, Any]:
+    """
+    Copy the rows of the single "workdays" sheet into year partitions.
+
+    Rows already present in a partition (same user_id and date) are skipped, so
+    the copy can be re-run. With delete_source the data rows of "workdays" are
+    removed afterwards (only if every row could be routed to a partition).
+    """
+    flush_writes()
+    with _workdays_write_lock:
+        try:
+            source = get_worksheet(WORKDAYS_SHEET).get_all_records()
+        except gspread.exceptions.WorksheetNotFound:
+            source = []
+        records = [r for r in _live_records(source) if r]
+        by_title: Dict[str, List[Dict[str, Any]]] = {}
+        unrouted = 0
+        for r in records:
+            title = partition_title(r.get("date", ""))
+            if title is None:
+                unrouted += 1
+                continue
+            by_title.setdefault(title, []).append(_normalize_workday(r))
+
+        copied = {}
+        for title, rows in sorted(by_title.items()):
+            ensure_workdays_sheet(title)
+            existing = {_workday_key(r) for r in _read_workdays(title)}
+            missing = [r for r in rows if _workday_key(r) not in existing]
+            if missing:
+                _append_workdays(title, missing)
+            copied[title] = len(missing)
+
+        deleted = 0
+        if delete_source and source and not unrouted:
+            get_worksheet(WORKDAYS_SHEET).delete_rows(FIRST_DATA_ROW, FIRST_DATA_ROW + len(source) - 1)
+            _row_index(WORKDAYS_SHEET).invalidate()
+            deleted = len(source)
+
+    return {"source_rows": len(records), "copied": copied, "unrouted": unrouted, "deleted": deleted}
+
+
+# ==================== DATA VERSIONS ====================
+# Ogni scrittura aumenta la versione della tabella (("users",), ("cities",),
+# ...). Per i workdays anche quella dell'utente e dei mesi toccati, per
+# l'utente e per "*" (tutti gli utenti). Con WRITE_BEHIND già all'accodamento.
+
+_versions = DataVersions(DATA_VERSIONS_FILE or None, DATA_VERSIONS_SAVE_SECONDS)
+
+
+def _workday_keys(records: List[Dict[str, Any]]) -> List[Tuple[str, ...]]:
+    """Version keys touched by writing these workdays: table, users and their months"""
+    keys = []
+    for record in records:
+        user_id = str(record.get("user_id", ""))
+        keys.append(("workdays", user_id))
+        period = workday_period(record.get("date", ""))
+        if period is not None:
+            keys.append(("workdays", user_id, *period))
+            keys.append(("workdays", "*", *period))
+    if keys:
+        keys.append(("workdays",))
+    return keys
+
 
-    for idx, record in enumerate(records, start=2):
-        if record.get("user_id") == user_id and record.get("date") == date:
-            sheet.delete_rows(idx)
+def table_version(table: str, user_id: Optional[str] = None) -> int:
+    """Version of a table (or of one user's workdays), changes on every write made by this process"""
+    return _versions.get((table, str(user_id)) if user_id else (table,))
+
+
+def workdays_version(user_id: Optional[str], year: str, month: str) -> int:
+    """Version of one user's month (None: every user), changes on every write to it"""
+    return _versions.get(("workdays", str(user_id or "*"), str(year), str(month).lstrip("0")))
+
+
+def close_versions():
+    """Save the version counters at shutdown (with SHEETS_DATA_VERSIONS_FILE)"""
+    _versions.close()
+
+
+# Ultima lettura completa di ogni foglio: impronta del contenuto, versione della
+# tabella prima della lettura, chiavi di versione che copre e quando è avvenuta
+_reads: Dict[str, Dict[str, Any]] = {}
+_reads_lock = threading.Lock()
+
+
+def note_read(title: str, table: str, records: List[Dict[str, Any]], version: int):
+    """
+    Remember a full read of a sheet (version = the table's version before reading). If the
+    content changed while no write of this process bumped the table, the sheet was edited by
+    hand: the versions of the rows read now and last time are bumped.
+    """
+    digest = hashlib.sha1(json.dumps(records, sort_keys=True, default=str).encode()).hexdigest()
+    keys = set(_workday_keys(records)) if table == WORKDAYS_SHEET else set()
+    keys.add((table,))
+    with _reads_lock:
+        previous = _reads.get(title)
+        if previous and previous["digest"] != digest and previous["version"] == version == table_version(table):
+            logger.info("Sheet %s changed outside the API, bumping its data versions", title)
+            _versions.bump(previous["keys"] | keys)
+            version = table_version(table)
+        _reads[title] = {"digest": digest, "version": version, "keys": keys, "at": time.monotonic()}
+
+
+def read_due(title: str, max_age: float) -> bool:
+    """True if the sheet was never fully read, or not in the last max_age seconds"""
+    with _reads_lock:
+        read = _reads.get(title)
+    return read is None or time.monotonic() - read["at"] >= max_age
+
+
+def refresh_version(table: str):
+    """
+    Re-read a table whose last full read is old (cache TTL, VERSION_REFRESH_SECONDS for
+    workdays), so that an edit made by hand on the sheet changes its version and ETags
+    """
+    if table != WORKDAYS_SHEET:
+        # Il loader gira solo se la cache è scaduta
+        {"users": get_all_users, "cities": get_all_cities, "roles": get_all_roles}[table]()
+        return
+    for title in _workdays_titles():
+        if read_due(title, VERSION_REFRESH_SECONDS):
+            _read_workdays(title)
+
+
+# ==================== MONTHLY AGGREGATES ====================
+# Ogni scrittura dei workdays applica un delta ai totali (user_id, anno, mese)
+# e salva i gruppi cambiati nel foglio monthly_stats (una batch_update per le
+# righe esistenti, una append_rows per i gruppi nuovi). Con WRITE_BEHIND il
+# delta si applica quando la riga viene davvero scritta, in flush_writes().
+# Tutto avviene sotto _workdays_write_lock, come le scritture dei workdays.
+
+_aggregates = MonthlyAggregates()
+
+
+def _aggregates_sheet() -> gspread.Worksheet:
+    try:
+        return get_worksheet(AGGREGATES_SHEET)
+    except gspread.exceptions.WorksheetNotFound:
+        sheet = _scheduled_worksheet(get_spreadsheet().add_worksheet(
+            title=AGGREGATES_SHEET, rows=1000, cols=len(AGGREGATE_HEADERS)))
+        sheet.append_row(AGGREGATE_HEADERS)
+        with _client_lock:
+            _worksheets[AGGREGATES_SHEET] = sheet
+        logger.info("Created %s sheet", AGGREGATES_SHEET)
+        return sheet
+
+
+def _recompute_aggregates() -> Dict[Tuple[str, str, str], Dict[str, float]]:
+    """Monthly totals from a full read of every workdays sheet"""
+    workdays = []
+    for title in _workdays_titles():
+        workdays.extend(_read_workdays(title))
+    return workday_contributions(workdays)
+
+
+def load_monthly_aggregates() -> bool:
+    """Load the saved totals once; the first time they are built from the workdays (returns True)"""
+    with _workdays_write_lock:
+        if _aggregates.loaded:
+            return False
+        try:
+            records = get_worksheet(AGGREGATES_SHEET).get_all_records()
+        except gspread.exceptions.WorksheetNotFound:
+            _aggregates_sheet()
+            _aggregates.replace(_recompute_aggregates(), FIRST_DATA_ROW)
+            save_monthly_aggregates()
             return True
-    return False
+        _aggregates.load(records, FIRST_DATA_ROW)
+        return False
+
+
+def save_monthly_aggregates() -> int:
+    """Write the changed totals to the monthly_stats sheet, returns the groups written"""
+    with _workdays_write_lock:
+        updates, appends = _aggregates.pending()
+        if not updates and not appends:
+            return 0
+        sheet = _aggregates_sheet()
+        if updates:
+            col_map = get_column_map(AGGREGATES_SHEET)
+            data = []
+            for row, values in updates:
+                cells, _ = diff_row(col_map, row, {}, dict(zip(AGGREGATE_HEADERS, values)))
+                data.extend(cells)
+            sheet.batch_update(data, value_input_option="USER_ENTERED")
+        if appends:
+            sheet.append_rows([values for _, values in appends])
+        _aggregates.saved([row for row, _ in updates], [key for key, _ in appends])
+        return len(updates) + len(appends)
+
+
+def _track_workdays(removed: List[Dict[str, Any]] = (), added: List[Dict[str, Any]] = (), save: bool = True):
+    """Apply a workday change (already written) to the version counters and monthly totals"""
+    _versions.bump(_workday_keys([*removed, *added]))
+    if not MONTHLY_AGGREGATES or not (removed or added):
+        return
+    try:
+        if load_monthly_aggregates():
+            # Appena ricalcolati dal foglio, che contiene già questa modifica
+            return
+        _aggregates.apply(removed, added)
+        if save:
+            save_monthly_aggregates()
+    except Exception:
+        # Il workday è salvato: i gruppi restano da scrivere al prossimo salvataggio
+        logger.exception("Monthly aggregates update failed")
+
+
+def get_monthly_aggregates(user_id: Optional[str], year: str, month: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Saved (user_id, year, month) totals of a year or month, for one user or all"""
+    load_monthly_aggregates()
+    return _aggregates.get(user_id, year, month)
+
+
+def verify_monthly_aggregates(fix: bool = False) -> Dict[str, Any]:
+    """
+    Compare the monthly_stats sheet with a full recompute from the workdays.
+    With fix the sheet is rewritten from the recompute when they differ.
+    """
+    flush_writes()
+    with _workdays_write_lock:
+        expected = _recompute_aggregates()
+        try:
+            records = get_worksheet(AGGREGATES_SHEET).get_all_records()
+        except gspread.exceptions.WorksheetNotFound:
+            records = []
+        saved = [r for r in records if r.get("user_id")]
+        stored = dict(decode_record(r) for r in saved)
+        mismatches = diff_aggregates(stored, expected)
+        # Lo stesso gruppo su più righe (non dovrebbe succedere)
+        duplicates = len(saved) - len(stored)
+
+        fixed = False
+        if fix and (mismatches or duplicates):
+            sheet = _aggregates_sheet()
+            if records:
+                sheet.delete_rows(FIRST_DATA_ROW, FIRST_DATA_ROW + len(records) - 1)
+            _aggregates.replace(expected, FIRST_DATA_ROW)
+            save_monthly_aggregates()
+            fixed = True
+
+    return {"groups": len(expected), "stored": len(stored), "duplicates": duplicates,
+            "mismatches": mismatches, "fixed": fixed}
 
 
 # ==================== ROLES ====================
 
-def get_all_roles() -> List[Dict[str, Any]]:
-    """Get all roles from 'roles' sheet"""
-    try:
-        sheet = get_spreadsheet().worksheet("roles")
-        records = sheet.get_all_records()
+def _normalize_role(record: Dict[str, Any]) -> Dict[str, Any]:
+    if "custom" in record:
+        record["custom"] = str(record["custom"]).lower() == "true"
+    if "permissions" in record and isinstance(record["permissions"], str):
+        record["permissions"] = [p.strip() for p in record["permissions"].split(",") if p.strip()]
+    return record
 
-        for record in records:
-            if "custom" in record:
-                record["custom"] = str(record["custom"]).lower() == "true"
-            if "permissions" in record and isinstance(record["permissions"], str):
-                record["permissions"] = [p.strip() for p in record["permissions"].split(",") if p.strip()]
 
-        return records
+def _load_roles() -> List[Dict[str, Any]]:
+    version = table_version("roles")
+    try:
+        sheet = get_worksheet("roles")
+        records = sheet.get_all_records()
     except gspread.exceptions.WorksheetNotFound:
-        return []
+        records = []
+    note_read("roles", "roles", records, version)
+    return [_normalize_role(r) for r in _overlay_pending("roles", records)]
 
 
-def create_role(role_data: Dict[str, Any]) -> Dict[str, Any]:
-    """Create new role"""
-    sheet = get_spreadsheet().worksheet("roles")
+def get_all_roles() -> List[Dict[str, Any]]:
+    """Get all roles from 'roles' sheet (cached)"""
+    return _cache.get("roles", _load_roles)
+
 
+def _role_row(role_data: Dict[str, Any]) -> List[Any]:
     permissions_str = ",".join(role_data.get("permissions", []))
 
-    row = [
+    return [
         role_data.get("id", ""),
         role_data.get("name", ""),
         permissions_str,
         str(role_data.get("custom", False)),
         role_data.get("created_at", datetime.now().isoformat()),
     ]
-    sheet.append_row(row)
+
+
+def create_role(role_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new role"""
+    sheet = get_worksheet("roles")
+
+    row = _role_row(role_data)
+    record = _normalize_role(_record_from_row("roles", row))
+    if WRITE_BEHIND:
+        _write_behind.create("roles", record["id"], record)
+    else:
+        sheet.append_row(row)
+    _cache.append("roles", record)
+    _versions.bump([("roles",)])
     return role_data
 
 
+# ==================== WRITE-BEHIND ====================
+# Con WRITE_BEHIND le create/update vengono accodate (journal su disco) e
+# scritte da flush_writes(): una append_rows e una batch_update per foglio.
+# Le delete, la compattazione e i cambi di chiave svuotano prima la coda.
+
+_write_behind = WriteBehindQueue(
+    journal_path=WRITE_BEHIND_JOURNAL,
+    flush_interval=WRITE_BEHIND_INTERVAL,
+    max_ops=WRITE_BEHIND_MAX_OPS,
+)
+_flush_lock = threading.Lock()
+
+_ROW_BUILDERS = {"users": _user_row, "cities": _city_row, "roles": _role_row}
+
+
+def _pending_key(table: str, record: Dict[str, Any]) -> Any:
+    return _workday_key(record) if table == "workdays" else record.get("id")
+
+
+def _overlay_pending(table: str, records: List[Dict[str, Any]], match=None) -> List[Dict[str, Any]]:
+    """Records as they will be once the queued writes are flushed"""
+    if not WRITE_BEHIND:
+        return records
+    return _write_behind.overlay(table, records, lambda r: _pending_key(table, r), match)
+
+
+def _existing_keys(table: str) -> set:
+    """Keys already on the sheet, read directly (no cache, no overlay)"""
+    if table == "workdays":
+        keys = set()
+        for title in _workdays_titles():
+            keys.update(_workday_key(r) for r in _read_workdays(title))
+        return keys
+    try:
+        return {r.get("id") for r in get_worksheet(table).get_all_records()}
+    except gspread.exceptions.WorksheetNotFound:
+        return set()
+
+
+def _flush_creates(table: str, records: List[Dict[str, Any]]):
+    if table == "workdays":
+        by_title: Dict[str, List[Dict[str, Any]]] = {}
+        for wd in records:
+            by_title.setdefault(workdays_title(wd.get("date", "")), []).append(wd)
+        for title, rows in by_title.items():
+            _append_workdays(title, rows)
+        _track_workdays(added=records, save=False)
+    else:
+        # I record sono già nella cache (aggiunti quando sono stati accodati)
+        get_worksheet(table).append_rows([_ROW_BUILDERS[table](r) for r in records])
+
+
+def _flush_updates(table: str, updates: Dict[Any, Dict[str, Any]]):
+    """All queued updates of one table: one batch_update per worksheet"""
+    by_title: Dict[str, List[Dict[str, Any]]] = {}
+    removed, added = [], []
+    for key, changes in updates.items():
+        if table == "workdays":
+            title = workdays_title(key[1])
+            found = find_workday(key[0], key[1], title)
+        else:
+            title = table
+            found = (find_user("id", key) if table == "users" else find_city(key))
+        if not found:
+            logger.warning("Write-behind: %s %s no longer exists, update dropped", table, key)
+            continue
+        # La cache ha già i nuovi valori: si scrivono tutte le colonne modificate
+        data, _ = diff_row(get_column_map(title), found[0], {}, changes)
+        by_title.setdefault(title, []).extend(data)
+        if table == "workdays":
+            removed.append(found[1])
+            added.append({**found[1], **changes})
+    for title, data in by_title.items():
+        if data:
+            get_worksheet(title).batch_update(data, value_input_option="USER_ENTERED")
+    _track_workdays(removed, added, save=False)
+
+
+def flush_writes(dedupe: bool = False) -> int:
+    """
+    Send the queued creates/updates to the sheet, returns the operations written.
+    With dedupe (journal replay) creates already on the sheet are skipped.
+    """
+    if not WRITE_BEHIND:
+        return 0
+    with _flush_lock, _tables_write_lock, _workdays_write_lock:
+        creates, updates = _write_behind.take()
+        count = sum(len(r) for r in creates.values()) + sum(len(r) for r in updates.values())
+        if not count:
+            _write_behind.done(True)
+            return 0
+        try:
+            for table, rows in creates.items():
+                records = list(rows.values())
+                if dedupe:
+                    existing = _existing_keys(table)
+                    records = [r for r in records if _pending_key(table, r) not in existing]
+                if records:
+                    _flush_creates(table, records)
+            for table, rows in updates.items():
+                _flush_updates(table, rows)
+        except Exception:
+            _write_behind.done(False)
+            raise
+        _write_behind.done(True)
+        if MONTHLY_AGGREGATES:
+            try:
+                save_monthly_aggregates()
+            except Exception:
+                logger.exception("Monthly aggregates save failed")
+    logger.info("Write-behind flushed %d operations", count)
+    return count
+
+
+def _background_flush():
+    with priority(BULK):
+        flush_writes()
+
+
+def start_write_behind() -> int:
+    """Replay the journal of a previous run, flush it and start the background flusher"""
+    if not WRITE_BEHIND:
+        return 0
+    replayed = _write_behind.replay()
+    if replayed:
+        flush_writes(dedupe=True)
+    _write_behind.start(_background_flush)
+    return replayed
+
+
+def stop_write_behind():
+    """Stop the background flusher and write everything still queued"""
+    if not WRITE_BEHIND:
+        return
+    _write_behind.stop()
+    flush_writes()
+
+
 # ==================== INITIALIZATION ====================
 
 def initialize_sheets():
     """Initialize all sheets with headers if they don't exist"""
     spreadsheet = get_spreadsheet()
 
-    sheets_config = {
-        "users": ["id", "username", "email", "password_hash", "role", "blocked", "created_at"],
-        "cities": ["id", "name", "travel_minutes", "created_at"],
-        "workdays": [
-            "id", "user_id", "date", "city", "is_custom_city",
-            "custom_city_name", "custom_distance_km", "custom_travel_minutes",
-            "travel_minutes_outbound", "travel_minutes_return", "work_minutes",
-            "arrival_time", "departure_home", "exit_time", "return_home",
-            "actual_arrival_at_store", "actual_exit_from_store", "actual_return_home",
-            "status", "created_at",
-        ],
-        "roles": ["id", "name", "permissions", "custom", "created_at"],
-    }
-
-    for sheet_name, headers in sheets_config.items():
+    for sheet_name, headers in SHEETS_CONFIG.items():
         try:
-            sheet = spreadsheet.worksheet(sheet_name)
+            sheet = get_worksheet(sheet_name)
             existing_headers = sheet.row_values(1)
             if not existing_headers:
                 sheet.append_row(headers)
         except gspread.exceptions.WorksheetNotFound:
-            sheet = spreadsheet.add_worksheet(title=sheet_name, rows=1000, cols=len(headers))
+            sheet = _scheduled_worksheet(spreadsheet.add_worksheet(title=sheet_name, rows=1000, cols=len(headers)))
             sheet.append_row(headers)
+            with _client_lock:
+                _worksheets[sheet_name] = sheet
+        with _column_maps_lock:
+            _column_maps.pop(sheet_name, None)
 
     print("✅ Google Sheets initialized successfully!")
 
@@ -0,0 +1,758 @@
+"""
+Google Sheets Database Helper - asyncio edition
+
+Stessa API di db_sheets (stessi nomi di funzione, ma awaitable) implementata
+direttamente sulla REST API Sheets v4 con un client httpx asincrono:
+le connessioni keep-alive sono condivise e le letture indipendenti partono
+in parallelo con asyncio.gather invece di occupare un thread ciascuna.
+
+Ogni richiesta prende un token dagli stessi bucket letture/scritture di
+db_sheets.quota (con la priorità corrente, interattiva o bulk). Le risposte
+429 vengono ritentate con backoff esponenziale con jitter, come nel client
+sincrono; 5xx ed errori di rete solo per le richieste idempotenti (letture e
+scritture di celle, non append e cancellazioni di righe). Le operazioni su un
+singolo workday passano dall'indice (user_id, date) -> riga di row_index, come
+in db_sheets, invece di scaricare tutto il foglio. Versioni dei dati (ETag,
+cache dei PDF), resolver delle città, pagine ed export in streaming hanno la
+stessa API di db_sheets.
+
+Le modalità SHEETS_WORKDAYS_PARTITIONED, SHEETS_SOFT_DELETE,
+SHEETS_WRITE_BEHIND e SHEETS_MONTHLY_AGGREGATES non sono supportate:
+storage.load_backend rifiuta la combinazione all'avvio.
+
+Si attiva con SHEETS_CLIENT=async. Per i test si può puntare a un server
+HTTP locale con SHEETS_API_BASE_URL (senza SERVICE_ACCOUNT_JSON le richieste
+partono senza token), oppure passare un trasporto httpx con use_transport()
+(fake_sheets.FakeSheetsAPI).
+"""
+
+import os
+import asyncio
+import logging
+import random
+from typing import AsyncIterator, List, Dict, Optional, Any, Tuple
+from urllib.parse import quote
+
+import httpx
+from google.auth.transport.requests import Request
+
+import db_sheets as base
+import workday_pages
+from city_resolver import CityResolver
+from db_sheets import SHEETS_CONFIG
+from quota_scheduler import QuotaExceededError, current_priority
+from row_index import RowIndex
+from table_cache import TableCache, FIRST_DATA_ROW
+
+logger = logging.getLogger(__name__)
+
+# ==================== CONFIG ====================
+
+DEFAULT_API_BASE_URL = "https://sheets.googleapis.com"
+API_BASE_URL = os.environ.get("SHEETS_API_BASE_URL", DEFAULT_API_BASE_URL)
+SPREADSHEET_ID = os.environ.get("SHEETS_SPREADSHEET_ID", base.SPREADSHEET_ID)
+HTTP_TIMEOUT_SECONDS = float(os.environ.get("SHEETS_HTTP_TIMEOUT", "30"))
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_MAX = 16.0
+
+_SPREADSHEET_PATH = f"/v4/spreadsheets/{SPREADSHEET_ID}"
+
+
+class SheetsAPIError(Exception):
+    """Non-2xx response from the Sheets REST API"""
+
+    def __init__(self, status_code: int, message: str):
+        super().__init__(f"Sheets API error {status_code}: {message}")
+        self.status_code = status_code
+
+
+# ==================== HTTP CLIENT ====================
+
+_http: Optional[httpx.AsyncClient] = None
+_transport: Optional[httpx.AsyncBaseTransport] = None
+_credentials = None
+_token_lock: Optional[asyncio.Lock] = None
+_sheet_ids: Optional[Dict[str, int]] = None
+
+
+def _get_http() -> httpx.AsyncClient:
+    """Process-wide pooled async HTTP client (created inside the running loop)"""
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            base_url=API_BASE_URL,
+            timeout=HTTP_TIMEOUT_SECONDS,
+            limits=httpx.Limits(
+                max_connections=base.HTTP_POOL_SIZE,
+                max_keepalive_connections=base.HTTP_POOL_SIZE,
+            ),
+            transport=_transport,
+        )
+    return _http
+
+
+def use_transport(transport: Optional[httpx.AsyncBaseTransport]):
+    """Send every request through another httpx transport (e.g. fake_sheets.FakeSheetsAPI), None to restore"""
+    global _http, _transport, _sheet_ids, _workdays_lock
+    _http = None
+    _transport = transport
+    _sheet_ids = None
+    _workdays_lock = None
+    _column_maps.clear()
+    _cache.invalidate()
+    _workdays_index.invalidate()
+
+
+async def _auth_headers() -> Dict[str, str]:
+    """Bearer token for the service account, refreshed off the event loop when expired"""
+    global _credentials, _token_lock
+    if _transport is not None or (API_BASE_URL != DEFAULT_API_BASE_URL and not os.environ.get("SERVICE_ACCOUNT_JSON")):
+        return {}  # server locale di test
+
+    if _token_lock is None:
+        _token_lock = asyncio.Lock()
+    async with _token_lock:
+        if _credentials is None:
+            _credentials = base._load_credentials()
+        if not _credentials.valid:
+            await asyncio.to_thread(_credentials.refresh, Request(session=base._token_session))
+    return {"Authorization": f"Bearer {_credentials.token}"}
+
+
+_retry_stats = {"calls": 0, "retries": 0, "throttled": 0, "server_errors": 0, "failures": 0}
+
+
+def _backoff(attempt: int, retry_after: Optional[str] = None) -> float:
+    """Full jitter exponential delay, at least the server's Retry-After"""
+    delay = random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * 2 ** attempt))
+    try:
+        return max(delay, float(retry_after)) if retry_after else delay
+    except ValueError:
+        return delay
+
+
+async def _acquire_token(kind: str):
+    """Take a token from the shared read/write quota bucket (waits off the event loop)"""
+    bucket = base.quota.buckets[kind]
+    await asyncio.to_thread(bucket.acquire, current_priority(), base.QUOTA_MAX_WAIT_SECONDS)
+
+
+async def _request(method: str, path: str, idempotent: bool = True, **kwargs) -> Dict[str, Any]:
+    """
+    One Sheets API call under the read/write quota. 429 is always retried (the
+    request was not executed), 5xx and network errors only when the request is idempotent.
+    """
+    kind = "read" if method == "GET" else "write"
+    attempt = 0
+    while True:
+        await _acquire_token(kind)
+        _retry_stats["calls"] += 1
+        retry_after = None
+        try:
+            response = await _get_http().request(
+                method, _SPREADSHEET_PATH + path, headers=await _auth_headers(), **kwargs
+            )
+        except httpx.TransportError as exc:
+            _retry_stats["server_errors"] += 1
+            if not idempotent or attempt >= base.QUOTA_MAX_RETRIES:
+                _retry_stats["failures"] += 1
+                raise
+            status = type(exc).__name__
+        else:
+            if response.status_code < 400:
+                return response.json() if response.content else {}
+            throttled = response.status_code == 429
+            if throttled:
+                _retry_stats["throttled"] += 1
+                base.quota.buckets[kind].drain()
+            elif response.status_code >= 500:
+                _retry_stats["server_errors"] += 1
+            retryable = throttled or (idempotent and response.status_code >= 500)
+            if not retryable or attempt >= base.QUOTA_MAX_RETRIES:
+                _retry_stats["failures"] += 1
+                error = SheetsAPIError(response.status_code, response.text[:500])
+                if throttled:
+                    raise QuotaExceededError(f"Sheets {kind} quota exceeded after {attempt + 1} attempts") from error
+                raise error
+            status = response.status_code
+            retry_after = response.headers.get("Retry-After")
+
+        delay = _backoff(attempt, retry_after)
+        attempt += 1
+        _retry_stats["retries"] += 1
+        logger.warning("Sheets %s %s failed (%s), retry %d in %.2fs", method, path or "/", status, attempt, delay)
+        await asyncio.sleep(delay)
+
+
+def quota_stats() -> Dict[str, Any]:
+    """Calls and retry counters of the HTTP client, plus the shared quota buckets"""
+    return {**_retry_stats, **{name: bucket.stats() for name, bucket in base.quota.buckets.items()}}
+
+
+async def close():
+    """Close the pooled HTTP client (call on shutdown)"""
+    global _http
+    if _http is not None:
+        await _http.aclose()
+        _http = None
+
+
+async def _get_sheet_ids() -> Dict[str, int]:
+    """Worksheet title -> sheetId (cached spreadsheet metadata)"""
+    global _sheet_ids
+    if _sheet_ids is None:
+        meta = await _request("GET", "", params={"fields": "sheets.properties(sheetId,title)"})
+        _sheet_ids = {
+            s["properties"]["title"]: s["properties"]["sheetId"] for s in meta.get("sheets", [])
+        }
+    return _sheet_ids
+
+
+# ==================== VALUES ====================
+
+def _numericise(value: Any) -> Any:
+    """Same conversion gspread applies in get_all_records()"""
+    if not isinstance(value, str) or "_" in value:
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+async def _get_values(range_: str) -> List[List[Any]]:
+    data = await _request("GET", f"/values/{quote(range_, safe='')}")
+    return data.get("values", [])
+
+
+async def _get_records(title: str) -> List[Dict[str, Any]]:
+    """Equivalent of Worksheet.get_all_records() (empty list if the sheet is missing)"""
+    if title not in await _get_sheet_ids():
+        return []
+    values = await _get_values(title)
+    if not values:
+        return []
+    headers = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [""] * (len(headers) - len(row))
+        records.append({h: _numericise(v) for h, v in zip(headers, row)})
+    return records
+
+
+async def _append_rows(title: str, rows: List[List[Any]]):
+    await _request(
+        "POST",
+        f"/values/{quote(title, safe='')}:append",
+        idempotent=False,
+        params={"valueInputOption": "RAW"},
+        json={"values": rows},
+    )
+
+
+async def _delete_row(title: str, row: int):
+    sheet_id = (await _get_sheet_ids())[title]
+    await _request("POST", ":batchUpdate", idempotent=False, json={"requests": [{
+        "deleteDimension": {
+            "range": {"sheetId": sheet_id, "dimension": "ROWS", "startIndex": row - 1, "endIndex": row},
+        },
+    }]})
+
+
+# ==================== ROW WRITES ====================
+
+_column_maps: Dict[str, Dict[str, int]] = {}
+
+
+async def get_column_map(title: str) -> Dict[str, int]:
+    """Header -> 1-based column number of a worksheet (cached)"""
+    col_map = _column_maps.get(title)
+    if col_map is None:
+        values = await _get_values(f"{title}!1:1")
+        headers = values[0] if values else []
+        col_map = {header: idx for idx, header in enumerate(headers, start=1) if header}
+        _column_maps[title] = col_map
+    return col_map
+
+
+async def write_row(title: str, row: int, current: Dict[str, Any], changes: Dict[str, Any]) -> int:
+    """Write the changed cells of one sheet row with a single API call, returns cells written"""
+    data, candidates = base.diff_row(await get_column_map(title), row, current, changes)
+    if data:
+        for item in data:
+            item["range"] = f"{title}!{item['range']}"
+        await _request("POST", "/values:batchUpdate", json={
+            "valueInputOption": "USER_ENTERED",
+            "data": data,
+        })
+    base.log_row_write(title, row, len(data), candidates)
+    return len(data)
+
+
+# ==================== TABLE CACHE ====================
+
+_cache = TableCache(
+    ttl_seconds=base.CACHE_TTL_SECONDS,
+    max_bytes=base.CACHE_MAX_BYTES,
+    indexes=base.CACHE_INDEXES,
+)
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Hit/miss counters and memory usage of the table cache"""
+    stats = _cache.stats()
+    stats["row_indexes"] = {"workdays": _workdays_index.stats()}
+    return stats
+
+
+def invalidate_cache(table: Optional[str] = None):
+    """Force a reload of one cached table (or all) on next read"""
+    _cache.invalidate(table)
+    if table in (None, "workdays"):
+        _workdays_index.invalidate()
+    # Dati forse cambiati a mano sul foglio: ETag e resolver delle città vanno rifatti
+    base._versions.bump([(name,) for name in SHEETS_CONFIG] if table is None else [(table,)])
+
+
+# Versioni dei dati condivise con db_sheets (stesso processo, stesso file)
+table_version = base.table_version
+workdays_version = base.workdays_version
+close_versions = base.close_versions
+
+
+async def refresh_version(table: str):
+    """Re-read a table whose last full read is old, so that edits made by hand change its version (db_sheets.refresh_version)"""
+    if table != "workdays":
+        await _ensure_cached(table, {"users": _load_users, "cities": _load_cities, "roles": _load_roles}[table])
+    elif base.read_due("workdays", base.VERSION_REFRESH_SECONDS):
+        await _read_workdays()
+
+
+async def _ensure_cached(name: str, load) -> Optional[List[Dict[str, Any]]]:
+    """Load a table into the cache if missing; returns the loaded records (or None if cached)"""
+    if _cache.contains(name):
+        return None
+    version = table_version(name)
+    records = await load()
+    base.note_read(name, name, records, version)
+    _cache.put(name, records)
+    return records
+
+
+def _preloaded(records):
+    def loader():
+        if records is None:
+            raise RuntimeError("cache entry expired during lookup")
+        return records
+    return loader
+
+
+async def _cached_table(name: str, load) -> List[Dict[str, Any]]:
+    records = await _ensure_cached(name, load)
+    return _cache.get(name, _preloaded(records))
+
+
+async def _cached_lookup(name: str, field: str, value: Any, load) -> Optional[Tuple[int, Dict[str, Any]]]:
+    records = await _ensure_cached(name, load)
+    return _cache.lookup(name, field, value, _preloaded(records))
+
+
+async def prefetch_tables():
+    """Load users, cities and roles concurrently (one round trip of latency)"""
+    await asyncio.gather(
+        _ensure_cached("users", _load_users),
+        _ensure_cached("cities", _load_cities),
+        _ensure_cached("roles", _load_roles),
+    )
+
+
+# ==================== USERS ====================
+
+async def _load_users() -> List[Dict[str, Any]]:
+    return [base._normalize_user(r) for r in await _get_records("users")]
+
+
+async def get_all_users() -> List[Dict[str, Any]]:
+    """Get all users from 'users' sheet (cached)"""
+    return await _cached_table("users", _load_users)
+
+
+async def find_user(field: str, value: Any) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Find a user through the id/email/username index, returning (sheet row, user)"""
+    return await _cached_lookup("users", field, value, _load_users)
+
+
+async def get_user_row(user_id: str) -> Optional[int]:
+    """Sheet row number of a user, or None"""
+    found = await find_user("id", user_id)
+    return found[0] if found else None
+
+
+async def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
+    """Find user by ID"""
+    found = await find_user("id", user_id)
+    return found[1] if found else None
+
+
+async def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
+    """Find user by email (case-insensitive)"""
+    found = await find_user("email", email)
+    return found[1] if found else None
+
+
+async def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Find user by username"""
+    found = await find_user("username", username)
+    return found[1] if found else None
+
+
+async def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new user"""
+    row = base._user_row(user_data)
+    await _append_rows("users", [row])
+    record = base._normalize_user(base._record_from_row("users", row))
+    _cache.append("users", record)
+    base._track_user(record)
+    base._versions.bump([("users",)])
+    return user_data
+
+
+async def update_user(user_id: str, update_data: Dict[str, Any]) -> bool:
+    """Update user by ID"""
+    found = await find_user("id", user_id)
+    if not found:
+        return False
+    idx, record = found
+
+    await write_row("users", idx, record, update_data)
+    _cache.update("users", "id", user_id, update_data)
+    record.update({k: v for k, v in update_data.items() if k in record})
+    base._track_user(record)
+    base._versions.bump([("users",)])
+    return True
+
+
+async def delete_user(user_id: str) -> bool:
+    """Delete user by ID"""
+    idx = await get_user_row(user_id)
+    if idx is None:
+        return False
+
+    await _delete_row("users", idx)
+    _cache.remove("users", "id", user_id)
+    base._revoke_user(user_id)
+    base._versions.bump([("users",)])
+    return True
+
+
+# ==================== REVOCATIONS ====================
+
+async def refresh_revocations():
+    """Reload blocked users and roles from the users sheet (also refreshes the cache)"""
+    _cache.invalidate("users")
+    base.set_revocations(await get_all_users())
+
+
+async def check_token_claims(user_id: str) -> Optional[str]:
+    """Return the current role of a token's user, or None if the user is revoked"""
+    if not base.revocations_loaded():
+        await refresh_revocations()
+    return base.claims_role(user_id)
+
+
+# ==================== CITIES ====================
+
+async def _load_cities() -> List[Dict[str, Any]]:
+    return await _get_records("cities")
+
+
+async def get_all_cities() -> List[Dict[str, Any]]:
+    """Get all cities from 'cities' sheet (cached)"""
+    return await _cached_table("cities", _load_cities)
+
+
+async def find_city(city_id: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """Find a city by ID, returning (sheet row, city)"""
+    return await _cached_lookup("cities", "id", city_id, _load_cities)
+
+
+async def get_city_by_id(city_id: str) -> Optional[Dict[str, Any]]:
+    """Find city by ID"""
+    found = await find_city(city_id)
+    return found[1] if found else None
+
+
+async def create_city(city_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new city"""
+    row = base._city_row(city_data)
+    await _append_rows("cities", [row])
+    _cache.append("cities", base._record_from_row("cities", row))
+    base._versions.bump([("cities",)])
+    return city_data
+
+
+async def update_city(city_id: str, update_data: Dict[str, Any]) -> bool:
+    """Update city by ID"""
+    found = await find_city(city_id)
+    if not found:
+        return False
+    idx, record = found
+
+    await write_row("cities", idx, record, update_data)
+    _cache.update("cities", "id", city_id, update_data)
+    base._versions.bump([("cities",)])
+    return True
+
+
+async def delete_city(city_id: str) -> bool:
+    """Delete city by ID"""
+    found = await find_city(city_id)
+    if not found:
+        return False
+
+    await _delete_row("cities", found[0])
+    _cache.remove("cities", "id", city_id)
+    base._versions.bump([("cities",)])
+    return True
+
+
+_city_resolver: Optional[CityResolver] = None
+
+
+async def city_resolver() -> CityResolver:
+    """Resolver of the cities sheet, rebuilt only after create_city/update_city/delete_city"""
+    global _city_resolver
+    version = table_version("cities")
+    if _city_resolver is None or _city_resolver.version != version:
+        _city_resolver = CityResolver(await get_all_cities(), version)
+    return _city_resolver
+
+
+# ==================== WORKDAYS ====================
+# Indice (user_id, date) -> riga condiviso con db_sheets (row_index.RowIndex):
+# ricostruito leggendo solo le colonne user_id e date, poi mantenuto a ogni
+# append/update/delete. Le scritture sono serializzate da un asyncio.Lock
+# perché una cancellazione sposta i numeri di riga.
+
+_workdays_index = RowIndex(ttl_seconds=base.CACHE_TTL_SECONDS)
+_workdays_lock: Optional[asyncio.Lock] = None
+
+
+def _workdays_write_lock() -> asyncio.Lock:
+    global _workdays_lock
+    if _workdays_lock is None:
+        _workdays_lock = asyncio.Lock()
+    return _workdays_lock
+
+
+async def _read_workdays() -> List[Dict[str, Any]]:
+    """All workday records (refreshes the row index for free)"""
+    version = _workdays_index.version
+    data_version = table_version("workdays")
+    records = await _get_records("workdays")
+    _workdays_index.load((base._workday_key(r) for r in records), version=version)
+    base.note_read("workdays", "workdays", records, data_version)
+    return records
+
+
+async def get_all_workdays(user_id: Optional[str] = None, year: Optional[str] = None,
+                           month: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Get all workdays, optionally filtered by user_id and period"""
+    records = await _read_workdays()
+    if user_id:
+        records = [r for r in records if r.get("user_id") == user_id]
+    records = [r for r in records if base.workday_in_period(r, year, month)]
+    return [base._normalize_workday(r) for r in records]
+
+
+async def load_workday_index() -> RowIndex:
+    """Row index of the workdays sheet, rebuilt from the user_id/date columns only when stale"""
+    if _workdays_index.fresh():
+        return _workdays_index
+    version = _workdays_index.version
+    col_map = await get_column_map("workdays")
+    if "user_id" not in col_map or "date" not in col_map:
+        _workdays_index.load([], version=version)  # foglio mancante o senza intestazioni
+        return _workdays_index
+    columns = [base.gspread.utils.rowcol_to_a1(1, col_map[f])[:-1] for f in ("user_id", "date")]
+    data = await _request("GET", "/values:batchGet", params={
+        "ranges": [f"workdays!{c}{FIRST_DATA_ROW}:{c}" for c in columns],
+    })
+    user_ids, dates = [r.get("values", []) for r in data.get("valueRanges", [])]
+
+    def cell(values: List[List[Any]], i: int) -> str:
+        return str(values[i][0]) if i < len(values) and values[i] else ""
+
+    length = max(len(user_ids), len(dates))
+    _workdays_index.load(
+        (base._workday_key({"user_id": cell(user_ids, i), "date": cell(dates, i)}) for i in range(length)),
+        version=version,
+    )
+    return _workdays_index
+
+
+async def _read_row(row: int) -> Dict[str, Any]:
+    """One workdays row as the record get_all_records() would return"""
+    col_map = await get_column_map("workdays")
+    values = await _get_values(f"workdays!{row}:{row}")
+    values = list(values[0]) if values else []
+    values += [""] * (max(col_map.values(), default=0) - len(values))
+    return {header: _numericise(values[col - 1]) for header, col in col_map.items()}
+
+
+async def _find_workday(user_id: str, date: str) -> Optional[Tuple[int, Dict[str, Any]]]:
+    """(sheet row, record) of a workday via the row index, verified against the row read"""
+    key = (str(user_id), str(date))
+    for attempt in range(2):
+        index = await load_workday_index()
+        row = index.find(key)
+        if row is None:
+            return None
+        record = await _read_row(row)
+        if base._workday_key(record) == key:
+            return row, record
+        # Il foglio è cambiato fuori dal processo: ricostruisci l'indice e riprova
+        logger.warning("workdays row index stale at row %d, rebuilding", row)
+        index.invalidate()
+    return None
+
+
+async def get_workday_by_date(user_id: str, date: str) -> Optional[Dict[str, Any]]:
+    """Find workday by user_id and date"""
+    found = await _find_workday(user_id, date)
+    return base._normalize_workday(found[1]) if found else None
+
+
+async def get_workdays_page(user_id: Optional[str] = None, date_from: Optional[str] = None,
+                            date_to: Optional[str] = None, after: Optional[Tuple[str, str]] = None,
+                            limit: int = 100, fields: Optional[List[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page of workdays ordered by (date, user_id), returns (items, next cursor); only the page is normalized"""
+    records = await _read_workdays()
+    candidates = workday_pages.select_page(
+        (r for r in records if workday_pages.matches(r, user_id, date_from, date_to, after)), limit
+    )
+    return workday_pages.finish_page([base._normalize_workday(r) for r in candidates], limit, fields)
+
+
+async def iter_workdays(user_id: Optional[str] = None, date_from: Optional[str] = None,
+                        date_to: Optional[str] = None) -> AsyncIterator[Dict[str, Any]]:
+    """Workdays for streaming exports in sheet order, read base.EXPORT_CHUNK_ROWS rows per request"""
+    col_map = await get_column_map("workdays")
+    if not col_map:
+        return
+    headers = {col: header for header, col in col_map.items()}
+    last_col = base.gspread.utils.rowcol_to_a1(1, max(col_map.values()))[:-1]
+    chunk_rows = base.EXPORT_CHUNK_ROWS
+    start = FIRST_DATA_ROW
+    while True:
+        values = await _get_values(f"workdays!A{start}:{last_col}{start + chunk_rows - 1}")
+        for row in values:
+            record = {headers[col]: _numericise(row[col - 1]) if col <= len(row) else "" for col in headers}
+            if workday_pages.matches(record, user_id, date_from, date_to):
+                yield base._normalize_workday(record)
+        if len(values) < chunk_rows:
+            return
+        start += chunk_rows
+
+
+async def create_workday(workday_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new workday"""
+    async with _workdays_write_lock():
+        await _append_rows("workdays", [base._workday_row(workday_data)])
+        _workdays_index.append([base._workday_key(workday_data)])
+    base._versions.bump(base._workday_keys([workday_data]))
+    return workday_data
+
+
+async def create_workdays_batch(workdays: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Create multiple workdays in batch (optimized for CSV import)"""
+    if not workdays:
+        return []
+    async with _workdays_write_lock():
+        await _append_rows("workdays", [base._workday_row(wd) for wd in workdays])
+        _workdays_index.append(base._workday_key(wd) for wd in workdays)
+    base._versions.bump(base._workday_keys(workdays))
+    return workdays
+
+
+async def update_workday(user_id: str, date: str, update_data: Dict[str, Any]) -> bool:
+    """Update workday by user_id and date"""
+    async with _workdays_write_lock():
+        found = await _find_workday(user_id, date)
+        if not found:
+            return False
+        row, record = found
+        await write_row("workdays", row, record, update_data)
+        _workdays_index.rekey(row, base._workday_key(record), base._workday_key({**record, **update_data}))
+    base._versions.bump(base._workday_keys([record, {**record, **update_data}]))
+    return True
+
+
+async def delete_workday(user_id: str, date: str) -> bool:
+    """Delete workday by user_id and date"""
+    async with _workdays_write_lock():
+        found = await _find_workday(user_id, date)
+        if not found:
+            return False
+        await _delete_row("workdays", found[0])
+        _workdays_index.remove_row(found[0])
+    base._versions.bump(base._workday_keys([found[1]]))
+    return True
+
+
+# ==================== ROLES ====================
+
+async def _load_roles() -> List[Dict[str, Any]]:
+    return [base._normalize_role(r) for r in await _get_records("roles")]
+
+
+async def get_all_roles() -> List[Dict[str, Any]]:
+    """Get all roles from 'roles' sheet (cached)"""
+    return await _cached_table("roles", _load_roles)
+
+
+async def create_role(role_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new role"""
+    row = base._role_row(role_data)
+    await _append_rows("roles", [row])
+    _cache.append("roles", base._normalize_role(base._record_from_row("roles", row)))
+    base._versions.bump([("roles",)])
+    return role_data
+
+
+# ==================== INITIALIZATION ====================
+
+async def initialize_sheets():
+    """Initialize all sheets with headers if they don't exist"""
+    global _sheet_ids
+    existing = await _get_sheet_ids()
+
+    missing = [name for name in SHEETS_CONFIG if name not in existing]
+    if missing:
+        await _request("POST", ":batchUpdate", idempotent=False, json={"requests": [
+            {"addSheet": {"properties": {
+                "title": name,
+                "gridProperties": {"rowCount": 1000, "columnCount": len(SHEETS_CONFIG[name])},
+            }}}
+            for name in missing
+        ]})
+        _sheet_ids = None
+
+    # Legge gli header di tutti i fogli in parallelo
+    titles = list(SHEETS_CONFIG)
+    header_rows = await asyncio.gather(*[_get_values(f"{title}!1:1") for title in titles])
+    await asyncio.gather(*[
+        _append_rows(title, [SHEETS_CONFIG[title]])
+        for title, values in zip(titles, header_rows) if not values
+    ])
+    _column_maps.clear()
+
+    print("✅ Google Sheets initialized successfully!")
+
+
+if __name__ == "__main__":
+    asyncio.run(initialize_sheets())
+    print("Database sheets ready!")
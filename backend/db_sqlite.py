@@ -0,0 +1,470 @@
+"""
+SQLite Database Helper
+Stessa API di db_sheets su un file SQLite locale (STORAGE_BACKEND=sqlite)
+
+Il database usa il journal WAL (letture concorrenti alle scritture) e indici
+su workdays(user_id, date), users(email) e users(username). Google Sheets può
+restare come destinazione opzionale: con SQLITE_SHEETS_SINK=1 ogni scrittura
+viene replicata sul foglio in background.
+
+Migrazione dal foglio esistente:
+    python db_sqlite.py migrate
+"""
+
+import os
+import sys
+import sqlite3
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Any
+
+import db_sheets
+from city_resolver import CityResolver
+from db_sheets import SHEETS_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# ==================== CONFIG ====================
+
+SQLITE_PATH = os.environ.get("SQLITE_PATH", "travel_work.db")
+SHEETS_SINK = os.environ.get("SQLITE_SHEETS_SINK", "").lower() in ("1", "true", "yes")
+
+BOOL_COLUMNS = {
+    "users": {"blocked"},
+    "workdays": {"is_custom_city"},
+    "roles": {"custom"},
+}
+
+# Come sul foglio, id non è vincolato come chiave primaria (i dati migrati
+# possono contenere duplicati) ma è indicizzato.
+# Colonne senza tipo dichiarato: i valori restano come scritti (numero o "")
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id TEXT NOT NULL DEFAULT '',
+    username TEXT NOT NULL DEFAULT '',
+    email TEXT NOT NULL DEFAULT '',
+    password_hash TEXT NOT NULL DEFAULT '',
+    role TEXT NOT NULL DEFAULT 'user',
+    blocked INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_users_id ON users (id);
+CREATE INDEX IF NOT EXISTS idx_users_email ON users (email COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_username ON users (username);
+
+CREATE TABLE IF NOT EXISTS cities (
+    id TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    travel_minutes,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_cities_id ON cities (id);
+
+CREATE TABLE IF NOT EXISTS workdays (
+    id TEXT NOT NULL DEFAULT '',
+    user_id TEXT NOT NULL DEFAULT '',
+    date TEXT NOT NULL DEFAULT '',
+    city,
+    is_custom_city INTEGER NOT NULL DEFAULT 0,
+    custom_city_name,
+    custom_distance_km,
+    custom_travel_minutes,
+    travel_minutes_outbound,
+    travel_minutes_return,
+    work_minutes,
+    arrival_time,
+    departure_home,
+    exit_time,
+    return_home,
+    actual_arrival_at_store,
+    actual_exit_from_store,
+    actual_return_home,
+    status,
+    created_at TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_workdays_id ON workdays (id);
+CREATE INDEX IF NOT EXISTS idx_workdays_user_date ON workdays (user_id, date);
+CREATE INDEX IF NOT EXISTS idx_workdays_date ON workdays (date);
+
+CREATE TABLE IF NOT EXISTS roles (
+    id TEXT NOT NULL DEFAULT '',
+    name TEXT NOT NULL DEFAULT '',
+    permissions TEXT NOT NULL DEFAULT '',
+    custom INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT
+);
+"""
+
+
+# ==================== CONNECTION ====================
+# Una connessione per thread (il pool di storage_executor usa più thread)
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+
+def get_connection() -> sqlite3.Connection:
+    """Thread-local connection with WAL enabled and the schema created"""
+    global _schema_ready
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(SQLITE_PATH, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        with _schema_lock:
+            if not _schema_ready:
+                conn.executescript(SCHEMA)
+                _schema_ready = True
+    return conn
+
+
+def _record(table: str, row: sqlite3.Row) -> Dict[str, Any]:
+    """Convert a DB row into the same record shape db_sheets returns"""
+    record = dict(row)
+    for col in BOOL_COLUMNS.get(table, ()):
+        record[col] = bool(record[col])
+    if table == "roles":
+        record["permissions"] = [p.strip() for p in (record["permissions"] or "").split(",") if p.strip()]
+    return record
+
+
+def _select(table: str, where: str = "", params: tuple = ()) -> List[Dict[str, Any]]:
+    sql = f"SELECT {', '.join(SHEETS_CONFIG[table])} FROM {table}"
+    if where:
+        sql += f" WHERE {where}"
+    sql += " ORDER BY rowid"
+    return [_record(table, row) for row in get_connection().execute(sql, params)]
+
+
+def _db_value(value: Any) -> Any:
+    return "" if value is None else value
+
+
+def _insert_rows(table: str, rows: List[List[Any]]):
+    """Insert rows built by the db_sheets row builders (same column order)"""
+    conn = get_connection()
+    with conn:
+        _execute_insert(conn, table, rows)
+
+
+def _execute_insert(conn: sqlite3.Connection, table: str, rows: List[List[Any]]):
+    """INSERT of the rows in the caller's transaction"""
+    columns = SHEETS_CONFIG[table]
+    bool_idx = [i for i, col in enumerate(columns) if col in BOOL_COLUMNS.get(table, ())]
+    values = []
+    for row in rows:
+        row = [_db_value(v) for v in row]
+        for i in bool_idx:
+            row[i] = str(row[i]).lower() == "true"
+        values.append(row)
+    conn.executemany(
+        f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+        values,
+    )
+
+
+def _update(table: str, where: str, params: tuple, update_data: Dict[str, Any]) -> bool:
+    columns = [key for key in update_data if key in SHEETS_CONFIG[table] and key != "id"]
+    conn = get_connection()
+    with conn:
+        if not columns:
+            return conn.execute(f"SELECT 1 FROM {table} WHERE {where}", params).fetchone() is not None
+        values = []
+        for key in columns:
+            value = update_data[key]
+            if key == "permissions" and isinstance(value, list):
+                value = ",".join(value)
+            values.append(_db_value(value))
+        cursor = conn.execute(
+            f"UPDATE {table} SET {', '.join(f'{c} = ?' for c in columns)} "
+            f"WHERE rowid = (SELECT rowid FROM {table} WHERE {where} ORDER BY rowid LIMIT 1)",
+            (*values, *params),
+        )
+    return cursor.rowcount > 0
+
+
+def _delete(table: str, where: str, params: tuple) -> bool:
+    conn = get_connection()
+    with conn:
+        cursor = conn.execute(
+            f"DELETE FROM {table} WHERE rowid = (SELECT rowid FROM {table} WHERE {where} ORDER BY rowid LIMIT 1)",
+            params,
+        )
+    return cursor.rowcount > 0
+
+
+# ==================== SHEETS SINK ====================
+
+# Un solo worker: le scritture arrivano al foglio nello stesso ordine
+_sink_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sheets-sink") if SHEETS_SINK else None
+
+
+def _sink(fn_name: str, *args):
+    """Replicate a write to Google Sheets in background (best effort)"""
+    if _sink_executor is None:
+        return
+
+    def run():
+        try:
+            getattr(db_sheets, fn_name)(*args)
+        except Exception:
+            logger.exception("Sheets sink failed for %s", fn_name)
+
+    _sink_executor.submit(run)
+
+
+def cache_stats() -> Dict[str, Any]:
+    """Table sizes (no in-memory cache is needed with SQLite)"""
+    conn = get_connection()
+    return {
+        "backend": "sqlite",
+        "path": SQLITE_PATH,
+        "tables": {
+            table: {"rows": conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]}
+            for table in SHEETS_CONFIG
+        },
+    }
+
+
+# ==================== USERS ====================
+
+def get_all_users() -> List[Dict[str, Any]]:
+    """Get all users"""
+    return _select("users")
+
+
+def _first(records: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    return records[0] if records else None
+
+
+def get_user_by_id(user_id: str) -> Optional[Dict[str, Any]]:
+    """Find user by ID"""
+    return _first(_select("users", "id = ?", (user_id,)))
+
+
+def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
+    """Find user by email (case-insensitive)"""
+    if not email:
+        return None
+    return _first(_select("users", "email = ? COLLATE NOCASE", (email.strip(),)))
+
+
+def get_user_by_username(username: str) -> Optional[Dict[str, Any]]:
+    """Find user by username"""
+    if not username:
+        return None
+    return _first(_select("users", "username = ?", (username,)))
+
+
+def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new user"""
+    row = db_sheets._user_row(user_data)
+    _insert_rows("users", [row])
+    db_sheets._track_user(db_sheets._normalize_user(db_sheets._record_from_row("users", row)))
+    _sink("create_user", user_data)
+    return user_data
+
+
+def update_user(user_id: str, update_data: Dict[str, Any]) -> bool:
+    """Update user by ID"""
+    if not _update("users", "id = ?", (user_id,), update_data):
+        return False
+    user = get_user_by_id(user_id)
+    if user:
+        db_sheets._track_user(user)
+    _sink("update_user", user_id, update_data)
+    return True
+
+
+def delete_user(user_id: str) -> bool:
+    """Delete user by ID"""
+    if not _delete("users", "id = ?", (user_id,)):
+        return False
+    db_sheets._revoke_user(user_id)
+    _sink("delete_user", user_id)
+    return True
+
+
+def refresh_revocations():
+    """Reload blocked users and roles from the users table"""
+    db_sheets.set_revocations(get_all_users())
+
+
+def check_token_claims(user_id: str) -> Optional[str]:
+    """Return the current role of a token's user, or None if the user is revoked"""
+    if not db_sheets.revocations_loaded():
+        refresh_revocations()
+    return db_sheets.claims_role(user_id)
+
+
+# ==================== CITIES ====================
+
+def get_all_cities() -> List[Dict[str, Any]]:
+    """Get all cities"""
+    return _select("cities")
+
+
+def get_city_by_id(city_id: str) -> Optional[Dict[str, Any]]:
+    """Find city by ID"""
+    return _first(_select("cities", "id = ?", (city_id,)))
+
+
+def create_city(city_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new city"""
+    _insert_rows("cities", [db_sheets._city_row(city_data)])
+    _cities_changed()
+    _sink("create_city", city_data)
+    return city_data
+
+
+def update_city(city_id: str, update_data: Dict[str, Any]) -> bool:
+    """Update city by ID"""
+    if not _update("cities", "id = ?", (city_id,), update_data):
+        return False
+    _cities_changed()
+    _sink("update_city", city_id, update_data)
+    return True
+
+
+def delete_city(city_id: str) -> bool:
+    """Delete city by ID"""
+    if not _delete("cities", "id = ?", (city_id,)):
+        return False
+    _cities_changed()
+    _sink("delete_city", city_id)
+    return True
+
+
+_city_resolver: Optional[CityResolver] = None
+_cities_version = 0
+_city_resolver_lock = threading.Lock()
+
+
+def _cities_changed():
+    global _cities_version
+    with _city_resolver_lock:
+        _cities_version += 1
+
+
+def city_resolver() -> CityResolver:
+    """Resolver of the cities table, rebuilt only after create_city/update_city/delete_city"""
+    global _city_resolver
+    with _city_resolver_lock:
+        if _city_resolver is None or _city_resolver.version != _cities_version:
+            _city_resolver = CityResolver(get_all_cities(), _cities_version)
+        return _city_resolver
+
+
+# ==================== WORKDAYS ====================
+
+def get_all_workdays(user_id: Optional[str] = None, year: Optional[str] = None,
+                     month: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Get all workdays, optionally filtered by user_id and period"""
+    clauses, params = [], []
+    if user_id:
+        clauses.append("user_id = ?")
+        params.append(user_id)
+    if year:
+        # YYYY-MM-DD o DD/MM/YYYY: il filtro esatto sul mese è fatto dopo
+        clauses.append("(date LIKE ? OR date LIKE ?)")
+        params += [f"{year}-%", f"%/{year}"]
+    records = _select("workdays", " AND ".join(clauses), tuple(params))
+    if year or month:
+        records = [r for r in records if db_sheets.workday_in_period(r, year, month)]
+    return records
+
+
+def get_workday_by_date(user_id: str, date: str) -> Optional[Dict[str, Any]]:
+    """Find workday by user_id and date"""
+    return _first(_select("workdays", "user_id = ? AND date = ?", (user_id, date)))
+
+
+def create_workday(workday_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new workday"""
+    _insert_rows("workdays", [db_sheets._workday_row(workday_data)])
+    _sink("create_workday", workday_data)
+    return workday_data
+
+
+def create_workdays_batch(workdays: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Create multiple workdays in one transaction"""
+    if not workdays:
+        return []
+    _insert_rows("workdays", [db_sheets._workday_row(wd) for wd in workdays])
+    _sink("create_workdays_batch", workdays)
+    return workdays
+
+
+def update_workday(user_id: str, date: str, update_data: Dict[str, Any]) -> bool:
+    """Update workday by user_id and date"""
+    if not _update("workdays", "user_id = ? AND date = ?", (user_id, date), update_data):
+        return False
+    _sink("update_workday", user_id, date, update_data)
+    return True
+
+
+def delete_workday(user_id: str, date: str) -> bool:
+    """Delete workday by user_id and date"""
+    if not _delete("workdays", "user_id = ? AND date = ?", (user_id, date)):
+        return False
+    _sink("delete_workday", user_id, date)
+    return True
+
+
+# ==================== ROLES ====================
+
+def get_all_roles() -> List[Dict[str, Any]]:
+    """Get all roles"""
+    return _select("roles")
+
+
+def create_role(role_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Create new role"""
+    _insert_rows("roles", [db_sheets._role_row(role_data)])
+    _sink("create_role", role_data)
+    return role_data
+
+
+# ==================== INITIALIZATION ====================
+
+def initialize_sheets():
+    """Create the SQLite schema (same name as the Sheets initializer)"""
+    get_connection()
+    print(f"✅ SQLite database ready: {SQLITE_PATH}")
+
+
+def migrate_from_sheets():
+    """
+    Copy every table of the Google spreadsheet into the SQLite database (replacing its content).
+    Everything is read from Sheets first and then written in one transaction: if a read or an
+    insert fails the database keeps its previous content.
+    """
+    loaders = {
+        "users": (db_sheets._load_users, db_sheets._user_row),
+        "cities": (db_sheets._load_cities, db_sheets._city_row),
+        "workdays": (lambda: db_sheets.get_all_workdays(), db_sheets._workday_row),
+        "roles": (db_sheets._load_roles, db_sheets._role_row),
+    }
+    rows = {table: [to_row(r) for r in load()] for table, (load, to_row) in loaders.items()}
+    conn = get_connection()
+    with conn:
+        for table, table_rows in rows.items():
+            conn.execute(f"DELETE FROM {table}")
+            _execute_insert(conn, table, table_rows)
+    _cities_changed()
+    for table, table_rows in rows.items():
+        print(f"✅ {table}: {len(table_rows)} righe copiate")
+    conn.execute("PRAGMA optimize")
+
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "init"
+    if command == "migrate":
+        migrate_from_sheets()
+        print("Migrazione completata!")
+    else:
+        initialize_sheets()
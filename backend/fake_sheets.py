@@ -0,0 +1,397 @@
+"""
+Fake Google Sheets
+
+Implementazione in memoria della parte di gspread usata da db_sheets
+(Spreadsheet.worksheet/add_worksheet/values_batch_get/batch_update,
+Worksheet.get_all_records, get, batch_get, row_values, append_row(s),
+update_cell, batch_update, delete_rows, add_cols).
+
+Serve per i benchmark e per provare db_sheets senza credenziali:
+  - latency_ms    ritardo simulato per ogni chiamata remota
+  - quota_limit   chiamate ammesse per quota_window secondi, oltre -> APIError 429
+  - calls         contatore delle chiamate remote per metodo
+
+    import db_sheets, fake_sheets
+    fake = fake_sheets.FakeSpreadsheet(latency_ms=50)
+    db_sheets.use_spreadsheet(fake)
+    db_sheets.initialize_sheets()
+
+FakeSheetsAPI espone lo stesso foglio come REST API Sheets v4 (trasporto
+httpx) per db_sheets_async:
+
+    api = fake_sheets.FakeSheetsAPI(fake)
+    db_sheets_async.use_transport(api.transport())
+"""
+
+import json
+import re
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Dict, List, Optional
+
+import gspread
+import httpx
+import requests
+from gspread.utils import a1_to_rowcol, numericise_all
+
+_RANGE = re.compile(r"^([A-Z]+)(\d*)(?::([A-Z]+)(\d*))?$")
+
+
+def _cell(value: Any) -> str:
+    """Store a value the way Sheets returns it (formatted string)"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "TRUE" if value else "FALSE"
+    return str(value)
+
+
+def quota_error(message: str = "Quota exceeded for quota metric 'Read requests'") -> gspread.exceptions.APIError:
+    """Build the APIError gspread raises on HTTP 429"""
+    response = requests.Response()
+    response.status_code = 429
+    response._content = json.dumps({
+        "error": {"code": 429, "message": message, "status": "RESOURCE_EXHAUSTED"}
+    }).encode()
+    return gspread.exceptions.APIError(response)
+
+
+class FakeSpreadsheet:
+    """In-memory spreadsheet with simulated latency, quota and call counting"""
+
+    def __init__(self, latency_ms: float = 0.0, quota_limit: Optional[int] = None, quota_window: float = 60.0):
+        self.latency_ms = latency_ms
+        self.quota_limit = quota_limit
+        self.quota_window = quota_window
+        self.calls: Counter = Counter()
+        self.quota_errors = 0
+        self._sheets: Dict[str, "FakeWorksheet"] = {}
+        self._next_id = 0
+        self._recent: deque = deque()
+        self._lock = threading.Lock()
+
+    # ---- remote call accounting ----
+
+    def _remote(self, method: str):
+        """Count one API call, apply latency and quota"""
+        with self._lock:
+            now = time.monotonic()
+            if self.quota_limit is not None:
+                while self._recent and now - self._recent[0] > self.quota_window:
+                    self._recent.popleft()
+                if len(self._recent) >= self.quota_limit:
+                    self.quota_errors += 1
+                    raise quota_error()
+                self._recent.append(now)
+            self.calls[method] += 1
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+
+    @property
+    def remote_calls(self) -> int:
+        return sum(self.calls.values())
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+            self.quota_errors = 0
+            self._recent.clear()
+
+    # ---- spreadsheet surface ----
+
+    def worksheet(self, title: str) -> "FakeWorksheet":
+        self._remote("worksheet")
+        sheet = self._sheets.get(title)
+        if sheet is None:
+            raise gspread.exceptions.WorksheetNotFound(title)
+        return sheet
+
+    def worksheets(self) -> List["FakeWorksheet"]:
+        self._remote("worksheets")
+        return list(self._sheets.values())
+
+    def add_worksheet(self, title: str, rows: int = 1000, cols: int = 26, index: Optional[int] = None) -> "FakeWorksheet":
+        self._remote("add_worksheet")
+        if title in self._sheets:
+            raise gspread.exceptions.GSpreadException(f"A sheet with the name \"{title}\" already exists")
+        sheet = self._new_sheet(title)
+        sheet.col_count = cols
+        return sheet
+
+    def values_batch_get(self, ranges: List[str], params: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Ranges must name the sheet: 'users'!H2:H"""
+        self._remote("values_batch_get")
+        value_ranges = []
+        for a1 in ranges:
+            title, _, cells = a1.rpartition("!")
+            sheet = self._sheets[title.strip("'")]
+            value_ranges.append({"range": a1, "values": sheet._range(cells)})
+        return {"valueRanges": value_ranges}
+
+    def batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """Only deleteDimension on ROWS is supported (what db_sheets.compact_tables sends)"""
+        self._remote("spreadsheet_batch_update")
+        by_id = {sheet.id: sheet for sheet in self._sheets.values()}
+        for request in body.get("requests", []):
+            dimension = request["deleteDimension"]["range"]
+            if dimension["dimension"] != "ROWS":
+                raise ValueError("Only ROWS deleteDimension is supported")
+            del by_id[dimension["sheetId"]]._rows[dimension["startIndex"]:dimension["endIndex"]]
+        return {"replies": [{} for _ in body.get("requests", [])]}
+
+    def _new_sheet(self, title: str) -> "FakeWorksheet":
+        self._next_id += 1
+        sheet = FakeWorksheet(self, title, self._next_id)
+        self._sheets[title] = sheet
+        return sheet
+
+    def del_worksheet(self, worksheet: "FakeWorksheet"):
+        self._remote("del_worksheet")
+        self._sheets.pop(worksheet.title, None)
+
+    def load(self, title: str, headers: List[str], rows: List[List[Any]]) -> "FakeWorksheet":
+        """Create or replace a worksheet with data, without counting remote calls"""
+        sheet = self._new_sheet(title)
+        sheet._rows = [[_cell(v) for v in headers]] + [[_cell(v) for v in row] for row in rows]
+        sheet.col_count = len(headers)
+        return sheet
+
+
+class FakeWorksheet:
+    """In-memory worksheet: rows are lists of strings, row 1 is the header"""
+
+    def __init__(self, spreadsheet: FakeSpreadsheet, title: str, sheet_id: int):
+        self.spreadsheet = spreadsheet
+        self.title = title
+        self.id = sheet_id
+        self.col_count = 26
+        self._rows: List[List[str]] = []
+
+    @property
+    def row_count(self) -> int:
+        return len(self._rows)
+
+    def _set(self, row: int, col: int, value: Any):
+        if col > self.col_count:
+            raise ValueError(f"Column {col} exceeds grid limits of {self.title} ({self.col_count} columns)")
+        while len(self._rows) < row:
+            self._rows.append([])
+        values = self._rows[row - 1]
+        if len(values) < col:
+            values.extend([""] * (col - len(values)))
+        values[col - 1] = _cell(value)
+
+    # ---- reads ----
+
+    def get_all_values(self) -> List[List[str]]:
+        self.spreadsheet._remote("get_all_values")
+        return [list(r) for r in self._rows]
+
+    def get_all_records(self, head: int = 1, **kwargs) -> List[Dict[str, Any]]:
+        self.spreadsheet._remote("get_all_records")
+        if len(self._rows) < head:
+            return []
+        headers = self._rows[head - 1]
+        records = []
+        for values in self._rows[head:]:
+            values = numericise_all(values + [""] * (len(headers) - len(values)))
+            records.append(dict(zip(headers, values)))
+        return records
+
+    def _range(self, a1: str) -> List[List[str]]:
+        """Values of an A1 range like "B2:C" or "A5:T5" (trailing blanks trimmed, as the API does)"""
+        match = _RANGE.match(a1.split("!")[-1])
+        if not match:
+            raise ValueError(f"Unsupported range: {a1}")
+        first_col, first_row, last_col, last_row = match.groups()
+        _, col_start = a1_to_rowcol(f"{first_col}1")
+        _, col_end = a1_to_rowcol(f"{last_col or first_col}1")
+        row_start = int(first_row or 1)
+        row_end = int(last_row) if last_row else (row_start if not last_col and first_row else len(self._rows))
+
+        values = []
+        for r in self._rows[row_start - 1:row_end]:
+            cells = r[col_start - 1:col_end]
+            while cells and cells[-1] == "":
+                cells = cells[:-1]
+            values.append(cells)
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get(self, range_name: str, **kwargs) -> List[List[str]]:
+        self.spreadsheet._remote("get")
+        return self._range(range_name)
+
+    def batch_get(self, ranges: List[str], **kwargs) -> List[List[List[str]]]:
+        self.spreadsheet._remote("batch_get")
+        return [self._range(r) for r in ranges]
+
+    def row_values(self, row: int, **kwargs) -> List[str]:
+        self.spreadsheet._remote("row_values")
+        if row > len(self._rows):
+            return []
+        values = list(self._rows[row - 1])
+        while values and values[-1] == "":
+            values.pop()
+        return values
+
+    # ---- writes ----
+
+    def append_row(self, values: List[Any], **kwargs):
+        self.spreadsheet._remote("append_row")
+        self._rows.append([_cell(v) for v in values])
+
+    def append_rows(self, values: List[List[Any]], **kwargs):
+        self.spreadsheet._remote("append_rows")
+        self._rows.extend([_cell(v) for v in row] for row in values)
+
+    def update_cell(self, row: int, col: int, value: Any):
+        self.spreadsheet._remote("update_cell")
+        self._set(row, col, value)
+
+    def batch_update(self, data: List[Dict[str, Any]], **kwargs):
+        """Single-cell ranges only ("C5"), which is what db_sheets.write_row sends"""
+        self.spreadsheet._remote("batch_update")
+        for item in data:
+            row, col = a1_to_rowcol(item["range"])
+            self._set(row, col, item["values"][0][0])
+
+    def add_cols(self, cols: int):
+        self.spreadsheet._remote("add_cols")
+        self.col_count += cols
+
+    def delete_rows(self, start_index: int, end_index: Optional[int] = None):
+        self.spreadsheet._remote("delete_rows")
+        end_index = end_index or start_index
+        del self._rows[start_index - 1:end_index]
+
+
+class FakeSheetsAPI:
+    """
+    The REST endpoints db_sheets_async calls, served from a FakeSpreadsheet
+    through an httpx.MockTransport (no network). fail() queues error statuses
+    returned before the next requests reach the sheet.
+    """
+
+    _PATH = re.compile(r"^/v4/spreadsheets/[^/:]+(.*)$")
+    _ROWS = re.compile(r"^(\d+):(\d+)$")
+
+    def __init__(self, spreadsheet: FakeSpreadsheet):
+        self.spreadsheet = spreadsheet
+        self.requests: Counter = Counter()
+        self._failures: deque = deque()
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+    def fail(self, *statuses: int):
+        """Answer the next len(statuses) requests with these HTTP statuses"""
+        self._failures.extend(statuses)
+
+    def reset_requests(self):
+        self.requests.clear()
+        self.spreadsheet.reset_calls()
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        match = self._PATH.match(request.url.path)
+        if not match:
+            return self._error(404, f"Unknown path {request.url.path}")
+        if self._failures:
+            status = self._failures.popleft()
+            self.requests[f"error_{status}"] += 1
+            return self._error(status, "Injected failure")
+
+        path = match.group(1)
+        body = json.loads(request.content) if request.content else {}
+        try:
+            if request.method == "GET" and path == "":
+                return self._ok("metadata", self._metadata())
+            if request.method == "GET" and path == "/values:batchGet":
+                ranges = request.url.params.get_list("ranges")
+                return self._ok("values_batch_get", self.spreadsheet.values_batch_get(ranges))
+            if request.method == "GET" and path.startswith("/values/"):
+                a1 = path[len("/values/"):]
+                return self._ok("values_get", {"range": a1, "values": self._values(a1)})
+            if request.method == "POST" and path == "/values:batchUpdate":
+                return self._ok("values_batch_update", self._values_batch_update(body))
+            if request.method == "POST" and path.startswith("/values/") and path.endswith(":append"):
+                title = path[len("/values/"):-len(":append")]
+                self._sheet(title).append_rows(body.get("values", []))
+                return self._ok("values_append", {"spreadsheetId": "fake"})
+            if request.method == "POST" and path == ":batchUpdate":
+                return self._ok("batch_update", self._batch_update(body))
+        except KeyError as exc:
+            return self._error(400, f"Unable to parse range: {exc}")
+        except gspread.exceptions.APIError as exc:  # quota_limit del FakeSpreadsheet
+            return self._error(exc.response.status_code, str(exc))
+        return self._error(404, f"Unsupported {request.method} {path}")
+
+    # ---- endpoints ----
+
+    def _metadata(self) -> Dict[str, Any]:
+        return {"sheets": [
+            {"properties": {"sheetId": sheet.id, "title": sheet.title}}
+            for sheet in self.spreadsheet.worksheets()
+        ]}
+
+    def _values(self, a1: str) -> List[List[str]]:
+        """Bare title (whole sheet), rows "5:5" or a column range"""
+        title, _, cells = a1.rpartition("!")
+        if not title:
+            return self._sheet(cells).get_all_values()
+        sheet = self._sheet(title)
+        rows = self._ROWS.match(cells)
+        if rows:
+            self.spreadsheet._remote("get")
+            start, end = int(rows.group(1)), int(rows.group(2))
+            values = []
+            for row in sheet._rows[start - 1:end]:
+                row = list(row)
+                while row and row[-1] == "":
+                    row.pop()
+                values.append(row)
+            while values and not values[-1]:
+                values.pop()
+            return values
+        return sheet.get(cells)
+
+    def _values_batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        by_title: Dict[str, List[Dict[str, Any]]] = {}
+        for item in body.get("data", []):
+            title, _, cells = item["range"].rpartition("!")
+            by_title.setdefault(title.strip("'"), []).append({"range": cells, "values": item["values"]})
+        for title, data in by_title.items():
+            self._sheet(title).batch_update(data)
+        return {"totalUpdatedCells": len(body.get("data", []))}
+
+    def _batch_update(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        """deleteDimension (ROWS) and addSheet requests"""
+        replies = []
+        for request in body.get("requests", []):
+            if "addSheet" in request:
+                properties = request["addSheet"]["properties"]
+                grid = properties.get("gridProperties", {})
+                sheet = self.spreadsheet.add_worksheet(properties["title"], cols=grid.get("columnCount", 26))
+                replies.append({"addSheet": {"properties": {"sheetId": sheet.id, "title": sheet.title}}})
+            else:
+                self.spreadsheet.batch_update({"requests": [request]})
+                replies.append({})
+        return {"replies": replies}
+
+    # ---- helpers ----
+
+    def _sheet(self, title: str) -> FakeWorksheet:
+        title = title.strip("'")
+        if title not in self.spreadsheet._sheets:
+            raise KeyError(title)
+        return self.spreadsheet._sheets[title]
+
+    def _ok(self, endpoint: str, payload: Dict[str, Any]) -> httpx.Response:
+        self.requests[endpoint] += 1
+        return httpx.Response(200, json=payload)
+
+    @staticmethod
+    def _error(status: int, message: str) -> httpx.Response:
+        return httpx.Response(status, json={"error": {"code": status, "message": message}})
@@ -0,0 +1,217 @@
+"""
+Background CSV import jobs
+
+POST /api/workdays/import-jobs salva il CSV su disco e risponde subito con
+l'id del job; l'import vero e proprio gira in background (al massimo
+`max_concurrent` job alla volta) e il frontend interroga lo stato con
+GET /api/workdays/import-jobs/{job_id}.
+
+Ogni job ha nella cartella `jobs_dir` il file caricato (<id>.csv) e il suo
+stato (<id>.json), riscritto su un thread dopo ogni blocco salvato, così
+l'event loop non aspetta il disco. Al riavvio resume() rimette in coda i job
+non finiti, che ripartono dal blocco successivo all'ultimo registrato
+(csv_import.import_csv_stream con start_chunk).
+"""
+
+import asyncio
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, BinaryIO, Callable, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+COMPLETED = "completed"
+FAILED = "failed"
+
+# (job, file, start_chunk, on_chunk) -> import del file, vedi server.run_import_job
+Runner = Callable[[Dict[str, Any], BinaryIO, int, Callable[[Dict[str, Any], List[str]], Awaitable[None]]], Awaitable[Any]]
+
+
+class ImportJobManager:
+    """Persistent queue of CSV import jobs run with bounded concurrency"""
+
+    def __init__(self, jobs_dir: str, max_concurrent: int, runner: Runner,
+                 max_errors: int = 10, retention_days: int = 7):
+        self.jobs_dir = jobs_dir
+        self.max_concurrent = max_concurrent
+        self.max_errors = max_errors
+        self.retention_days = retention_days
+        self._runner = runner
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    # ---------- files ----------
+
+    def _path(self, job_id: str, ext: str) -> str:
+        return os.path.join(self.jobs_dir, f"{job_id}.{ext}")
+
+    def _write(self, job_id: str, data: str):
+        path = self._path(job_id, "json")
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _save(self, job: Dict[str, Any]):
+        self._write(job["id"], json.dumps(job))
+
+    async def _save_async(self, job: Dict[str, Any]):
+        """Write the job state off the event loop (serialized here, so later changes don't race the write)"""
+        await asyncio.to_thread(self._write, job["id"], json.dumps(job))
+
+    def _remove_upload(self, job_id: str):
+        try:
+            os.remove(self._path(job_id, "csv"))
+        except FileNotFoundError:
+            pass
+
+    # ---------- jobs ----------
+
+    def _schedule(self, job: Dict[str, Any]):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        self._tasks[job["id"]] = asyncio.create_task(self._execute(job))
+
+    async def submit(self, user_id: str, filename: str, upload: BinaryIO) -> Dict[str, Any]:
+        """Store the upload on disk and queue the import, returns the job"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        job_id = str(uuid.uuid4())
+
+        def copy():
+            upload.seek(0)
+            with open(self._path(job_id, "csv"), "wb") as f:
+                shutil.copyfileobj(upload, f)
+
+        await asyncio.to_thread(copy)
+        job = {
+            "id": job_id,
+            "user_id": user_id,
+            "filename": filename,
+            "status": QUEUED,
+            "rows_read": 0,
+            "rows_saved": 0,
+            "errors": [],
+            "error_count": 0,
+            "chunks_done": 0,
+            "chunks_failed": 0,
+            "elapsed_seconds": 0.0,
+            "rows_per_second": 0.0,
+            "resumed": 0,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "started_at": None,
+            "finished_at": None,
+        }
+        self._jobs[job_id] = job
+        await self._save_async(job)
+        self._schedule(job)
+        return job
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self._jobs.get(job_id)
+
+    def list_jobs(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Jobs of one user (all of them with None), newest first"""
+        jobs = [job for job in self._jobs.values() if user_id is None or job["user_id"] == user_id]
+        return sorted(jobs, key=lambda job: job["created_at"], reverse=True)
+
+    async def _execute(self, job: Dict[str, Any]):
+        async with self._semaphore:
+            job["status"] = RUNNING
+            job["started_at"] = job["started_at"] or datetime.now(timezone.utc).isoformat()
+            await self._save_async(job)
+            # elapsed_seconds accumula anche il tempo delle esecuzioni prima di un riavvio
+            elapsed_before = job["elapsed_seconds"]
+            started = time.monotonic()
+
+            async def on_chunk(result: Dict[str, Any], messages: List[str]):
+                job["chunks_done"] = result["chunk"]
+                job["rows_read"] += result["rows"]
+                job["rows_saved"] += result["saved"]
+                job["error_count"] += len(messages)
+                job["errors"].extend(messages[:self.max_errors - len(job["errors"])])
+                if result["error"]:
+                    job["chunks_failed"] += 1
+                job["elapsed_seconds"] = round(elapsed_before + time.monotonic() - started, 3)
+                if job["elapsed_seconds"]:
+                    job["rows_per_second"] = round(job["rows_read"] / job["elapsed_seconds"], 1)
+                await self._save_async(job)
+
+            try:
+                with open(self._path(job["id"], "csv"), "rb") as f:
+                    await self._runner(job, f, job["chunks_done"], on_chunk)
+                job["status"] = COMPLETED
+            except asyncio.CancelledError:
+                # Shutdown: il job resta "running" e riparte al prossimo avvio
+                raise
+            except Exception as e:
+                logger.exception("Import job %s failed", job["id"])
+                job["status"] = FAILED
+                job["errors"] = (job["errors"] + [f"Import interrotto: {str(e)}"])[-self.max_errors:]
+            finally:
+                self._tasks.pop(job["id"], None)
+
+            job["elapsed_seconds"] = round(elapsed_before + time.monotonic() - started, 3)
+            job["finished_at"] = datetime.now(timezone.utc).isoformat()
+            await self._save_async(job)
+            await asyncio.to_thread(self._remove_upload, job["id"])
+
+    def resume(self) -> int:
+        """Load the jobs on disk, queue the unfinished ones and drop the expired ones"""
+        if not os.path.isdir(self.jobs_dir):
+            return 0
+        cutoff = (datetime.now(timezone.utc) - timedelta(days=self.retention_days)).isoformat()
+        jobs = []
+        for name in os.listdir(self.jobs_dir):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.jobs_dir, name), encoding="utf-8") as f:
+                    jobs.append(json.load(f))
+            except (OSError, json.JSONDecodeError):
+                logger.warning("Skipping unreadable import job %s", name)
+
+        resumed = 0
+        for job in sorted(jobs, key=lambda job: job["created_at"]):
+            if job["status"] in (COMPLETED, FAILED):
+                if (job["finished_at"] or job["created_at"]) < cutoff:
+                    os.remove(self._path(job["id"], "json"))
+                    self._remove_upload(job["id"])
+                else:
+                    self._jobs[job["id"]] = job
+                continue
+
+            self._jobs[job["id"]] = job
+            if not os.path.exists(self._path(job["id"], "csv")):
+                job["status"] = FAILED
+                job["errors"].append("File CSV non più disponibile")
+                self._save(job)
+                continue
+            job["status"] = QUEUED
+            job["resumed"] += 1
+            self._save(job)
+            self._schedule(job)
+            resumed += 1
+        if resumed:
+            logger.info("Resumed %d import jobs from %s", resumed, self.jobs_dir)
+        return resumed
+
+    async def shutdown(self):
+        """Cancel the running jobs; they resume from their last chunk at the next start"""
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        counts: Dict[str, int] = {}
+        for job in self._jobs.values():
+            counts[job["status"]] = counts.get(job["status"], 0) + 1
+        return {"max_concurrent": self.max_concurrent, "jobs": counts}
@@ -0,0 +1,202 @@
+"""
+Materialized monthly aggregates of workdays
+
+Tiene in memoria i totali di stats.py per (user_id, anno, mese) e li aggiorna
+con dei delta a ogni scrittura dei workdays (righe tolte -> sottratte, righe
+aggiunte -> sommate), senza rileggere il foglio. db_sheets salva i gruppi
+modificati nel foglio "monthly_stats", una riga per gruppo; all'avvio li
+rilegge da lì con una sola chiamata.
+
+Se il processo si ferma tra la scrittura di un workday e quella del suo
+gruppo, il foglio resta indietro: check_monthly_aggregates.py confronta i
+gruppi salvati con un ricalcolo completo e con --fix li riscrive.
+"""
+
+import json
+import threading
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import stats
+
+Key = Tuple[str, str, str]
+
+HEADERS = [
+    "user_id", "year", "month",
+    *stats.SUM_COLUMNS,
+    "rest_days_by_status", "updated_at",
+]
+
+REST_PREFIX = "rest_"
+
+
+def _is_rest_status(name: str) -> bool:
+    return name.startswith(REST_PREFIX) and name != "rest_days"
+
+
+def encode_row(key: Key, totals: Dict[str, float]) -> List[Any]:
+    """Sheet row of one group (rest-day statuses as a JSON object)"""
+    by_status = {name[len(REST_PREFIX):]: int(value) for name, value in totals.items()
+                 if _is_rest_status(name) and value}
+    return [
+        *key,
+        *(round(totals.get(name, 0), 2) for name in stats.SUM_COLUMNS),
+        json.dumps(by_status, ensure_ascii=False),
+        datetime.now(timezone.utc).isoformat(),
+    ]
+
+
+def decode_record(record: Dict[str, Any]) -> Tuple[Key, Dict[str, float]]:
+    """Group key and totals from a monthly_stats sheet record"""
+    key = (str(record.get("user_id", "")), str(record.get("year", "")), str(record.get("month", "")))
+    totals = {}
+    for name in stats.SUM_COLUMNS:
+        try:
+            totals[name] = float(record.get(name) or 0)
+        except (TypeError, ValueError):
+            totals[name] = 0.0
+    try:
+        by_status = json.loads(record.get("rest_days_by_status") or "{}")
+    except json.JSONDecodeError:
+        by_status = {}
+    for status, count in by_status.items():
+        totals[f"{REST_PREFIX}{status}"] = float(count)
+    return key, totals
+
+
+def _same(a: Dict[str, float], b: Dict[str, float]) -> bool:
+    names = set(a) | set(b)
+    return all(abs(a.get(name, 0) - b.get(name, 0)) < 0.01 for name in names)
+
+
+def diff(stored: Dict[Key, Dict[str, float]], expected: Dict[Key, Dict[str, float]]) -> List[Dict[str, Any]]:
+    """Groups whose stored totals differ from a full recompute"""
+    empty: Dict[str, float] = {}
+    mismatches = []
+    for key in sorted(set(stored) | set(expected)):
+        if not _same(stored.get(key, empty), expected.get(key, empty)):
+            mismatches.append({
+                "user_id": key[0], "year": key[1], "month": key[2],
+                "stored": stored.get(key), "expected": expected.get(key),
+            })
+    return mismatches
+
+
+class MonthlyAggregates:
+    """
+    Thread-safe (user_id, year, month) -> totals map, updated by deltas.
+    The caller serializes apply() with pending()/saved() (db_sheets holds the workdays write lock).
+    """
+
+    def __init__(self):
+        self._groups: Dict[Key, Dict[str, float]] = {}
+        # Riga del foglio monthly_stats di ogni gruppo già salvato
+        self._rows: Dict[Key, int] = {}
+        self._dirty: set = set()
+        self._next_row = 0
+        self._lock = threading.RLock()
+        self.loaded = False
+        self.deltas = 0
+        self.rebuilds = 0
+
+    def reset(self):
+        """Forget everything, the next use reloads from the sheet"""
+        with self._lock:
+            self._groups, self._rows, self._dirty = {}, {}, set()
+            self._next_row = 0
+            self.loaded = False
+
+    def load(self, records: Iterable[Dict[str, Any]], first_row: int):
+        """Groups as saved on the sheet, one record per row starting at first_row"""
+        records = list(records)
+        with self._lock:
+            self._groups, self._rows, self._dirty = {}, {}, set()
+            for row, record in enumerate(records, start=first_row):
+                if not record.get("user_id"):
+                    continue
+                key, totals = decode_record(record)
+                self._groups[key] = totals
+                self._rows[key] = row
+            self._next_row = first_row + len(records)
+            self.loaded = True
+
+    def replace(self, groups: Dict[Key, Dict[str, float]], first_row: int):
+        """Groups from a full recompute; every group must be written again"""
+        with self._lock:
+            self._groups = dict(groups)
+            self._rows = {}
+            self._dirty = set(groups)
+            self._next_row = first_row
+            self.loaded = True
+            self.rebuilds += 1
+
+    def apply(self, removed: Iterable[Dict[str, Any]] = (), added: Iterable[Dict[str, Any]] = ()):
+        """Subtract the removed workdays and add the added ones"""
+        removed, added = list(removed), list(added)
+        if not removed and not added:
+            return
+        minus = stats.contributions(removed) if removed else {}
+        plus = stats.contributions(added) if added else {}
+        with self._lock:
+            for sign, groups in ((-1, minus), (1, plus)):
+                for key, totals in groups.items():
+                    current = self._groups.setdefault(key, {})
+                    for name, value in totals.items():
+                        current[name] = current.get(name, 0) + sign * value
+                    self._dirty.add(key)
+            self.deltas += 1
+
+    def get(self, user_id: Optional[str], year: str, month: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Groups of a year (or one month), of one user or all of them"""
+        year = str(year)
+        month = str(month).lstrip("0") if month else None
+        with self._lock:
+            if user_id and month:
+                totals = self._groups.get((str(user_id), year, month))
+                matches = [((str(user_id), year, month), totals)] if totals else []
+            else:
+                matches = [(key, totals) for key, totals in self._groups.items()
+                           if key[1] == year and (not month or key[2] == month)
+                           and (not user_id or key[0] == str(user_id))]
+            return [
+                {"user_id": key[0], "year": key[1], "month": key[2], **totals}
+                for key, totals in matches
+                if any(totals.values())
+            ]
+
+    def snapshot(self) -> Dict[Key, Dict[str, float]]:
+        with self._lock:
+            return {key: dict(totals) for key, totals in self._groups.items()}
+
+    def pending(self) -> Tuple[List[Tuple[int, List[Any]]], List[Tuple[Key, List[Any]]]]:
+        """Changed groups to write: ([(row, values)] already on the sheet, [(key, values)] to append)"""
+        with self._lock:
+            updates, appends = [], []
+            for key in sorted(self._dirty):
+                values = encode_row(key, self._groups[key])
+                if key in self._rows:
+                    updates.append((self._rows[key], values))
+                else:
+                    appends.append((key, values))
+            return updates, appends
+
+    def saved(self, updated_rows: Iterable[int], appended: Iterable[Key]):
+        """Mark the groups returned by pending() as written"""
+        with self._lock:
+            by_row = {row: key for key, row in self._rows.items()}
+            for row in updated_rows:
+                self._dirty.discard(by_row.get(row))
+            for key in appended:
+                self._rows[key] = self._next_row
+                self._next_row += 1
+                self._dirty.discard(key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "loaded": self.loaded,
+                "groups": len(self._groups),
+                "dirty": len(self._dirty),
+                "deltas": self.deltas,
+                "rebuilds": self.rebuilds,
+            }
@@ -0,0 +1,227 @@
+"""
+Monthly PDF report (reportlab) and its disk cache
+
+render_monthly_pdf() riprende il layout di server_old.export_monthly_pdf
+(riepilogo + dettaglio giornaliero) sui campi dei workdays del foglio. È una
+funzione pura, dati in ingresso e bytes in uscita, così gira in un thread o
+in un processo separato senza toccare Sheets.
+
+PdfCache tiene i PDF già generati su disco, con chiave (utente, mese, anno,
+versioni dei dati): finché non cambiano né il mese né utenti e città (nomi
+stampati nel PDF) lo stesso file viene servito di nuovo. I file più vecchi vengono rimossi oltre max_bytes.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+from reportlab.lib.units import cm
+from reportlab.platypus import Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
+
+logger = logging.getLogger(__name__)
+
+
+def _display_date(date: str) -> str:
+    """YYYY-MM-DD -> DD/MM/YYYY (other formats unchanged)"""
+    parts = str(date).split("-")
+    if len(parts) == 3:
+        return f"{parts[2]}/{parts[1]}/{parts[0]}"
+    return str(date)
+
+
+def _date_key(date: str) -> str:
+    """Sortable YYYY-MM-DD from either sheet date format"""
+    parts = str(date).split("/")
+    if len(parts) == 3:
+        return f"{parts[2]}-{parts[1].zfill(2)}-{parts[0].zfill(2)}"
+    return str(date)
+
+
+def _minutes(value: int) -> str:
+    return f"{value // 60}h {value % 60}min"
+
+
+def _is_custom(workday: Dict[str, Any]) -> bool:
+    return str(workday.get("is_custom_city", "")).lower() == "true"
+
+
+def _workday_km(workday: Dict[str, Any]) -> str:
+    try:
+        return f"{2 * float(workday.get('custom_distance_km') or 0):.1f}" if _is_custom(workday) else "-"
+    except (TypeError, ValueError):
+        return "-"
+
+
+def render_monthly_pdf(workdays: List[Dict[str, Any]], stats: Dict[str, Any], user_name: str,
+                       month: str, year: str, city_names: Optional[Dict[str, str]] = None) -> bytes:
+    """Build the monthly report: summary table (stats.monthly_stats) and one row per day"""
+    city_names = city_names or {}
+    buffer = io.BytesIO()
+    doc = SimpleDocTemplate(buffer, pagesize=A4)
+    elements = []
+
+    styles = getSampleStyleSheet()
+    title_style = ParagraphStyle(
+        'CustomTitle',
+        parent=styles['Heading1'],
+        fontSize=18,
+        textColor=colors.HexColor('#1e40af'),
+        spaceAfter=30,
+        alignment=1  # Center
+    )
+    subtitle_style = ParagraphStyle(
+        'CustomSubtitle',
+        parent=styles['Normal'],
+        fontSize=12,
+        textColor=colors.HexColor('#475569'),
+        spaceAfter=20,
+        alignment=1  # Center
+    )
+
+    elements.append(Paragraph(f"Report Mensile - {str(month).zfill(2)}/{year}", title_style))
+    elements.append(Paragraph(f"Dipendente: {user_name}", subtitle_style))
+    elements.append(Spacer(1, 0.5*cm))
+
+    # Riepilogo
+    summary_data = [
+        ["Statistiche Mensili", ""],
+        ["Giorni lavorativi", str(stats["work_days"])],
+        ["Giorni riposo", str(stats["rest_days"])],
+        ["KM totali", f"{stats['total_km']} km"],
+        ["", ""],
+        ["Tempi", ""],
+        ["Tempo in negozio VIS", _minutes(stats["total_time_at_store_minutes"])],
+        ["Tempo in auto (senza traffico)", _minutes(stats["total_travel_time_minutes"])],
+        ["", ""],
+        ["Rimborsi", ""],
+        ["Rimborso usura KM", f"€ {stats['km_allowance']}"],
+        ["Benzina consumata", f"{stats['total_fuel_liters']} L (coperta da azienda)"],
+        ["Pedaggio", "Coperto da Telepass aziendale"]
+    ]
+    summary_table = Table(summary_data, colWidths=[10*cm, 6*cm])
+    summary_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1e40af')),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'LEFT'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 14),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.beige),
+        ('GRID', (0, 0), (-1, -1), 1, colors.black)
+    ]))
+    elements.append(summary_table)
+    elements.append(Spacer(1, 1*cm))
+
+    # Dettaglio giornate
+    elements.append(Paragraph("Dettaglio Giornaliero", styles['Heading2']))
+    elements.append(Spacer(1, 0.3*cm))
+
+    detail_data = [["Data", "Città", "Partenza", "Arrivo", "Uscita", "Rientro", "KM"]]
+    for wd in sorted(workdays, key=lambda w: _date_key(w.get("date", ""))):
+        city = wd.get("custom_city_name") if _is_custom(wd) else city_names.get(wd.get("city"), wd.get("city"))
+        if not city and wd.get("status"):
+            detail_data.append([_display_date(wd["date"]), wd["status"], "-", "-", "-", "-", "-"])
+        else:
+            detail_data.append([
+                _display_date(wd.get("date", "")),
+                city or "",
+                wd.get("departure_home") or "",
+                wd.get("actual_arrival_at_store") or wd.get("arrival_time") or "",
+                wd.get("actual_exit_from_store") or wd.get("exit_time") or "",
+                wd.get("actual_return_home") or wd.get("return_home") or "",
+                _workday_km(wd),
+            ])
+
+    detail_table = Table(detail_data, colWidths=[2.5*cm, 3*cm, 2*cm, 2*cm, 2*cm, 2*cm, 2*cm], repeatRows=1)
+    detail_table.setStyle(TableStyle([
+        ('BACKGROUND', (0, 0), (-1, 0), colors.grey),
+        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+        ('FONTSIZE', (0, 0), (-1, 0), 10),
+        ('BOTTOMPADDING', (0, 0), (-1, 0), 12),
+        ('BACKGROUND', (0, 1), (-1, -1), colors.whitesmoke),
+        ('GRID', (0, 0), (-1, -1), 0.5, colors.grey)
+    ]))
+    elements.append(detail_table)
+
+    doc.build(elements)
+    return buffer.getvalue()
+
+
+class PdfCache:
+    """Rendered PDFs on disk, keyed by (user, month, year, data versions)"""
+
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: float):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def path(self, user_id: str, month: str, year: str, *versions: int) -> str:
+        key = "|".join([str(user_id), str(year), str(month).lstrip('0'), *map(str, versions)])
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + ".pdf")
+
+    def get(self, path: str) -> Optional[str]:
+        """The cached file if present and not older than the TTL"""
+        try:
+            fresh = time.time() - os.path.getmtime(path) < self.ttl_seconds
+        except OSError:
+            fresh = False
+        with self._lock:
+            if fresh:
+                self.hits += 1
+                return path
+            self.misses += 1
+            return None
+
+    def read(self, path: str) -> Optional[bytes]:
+        """Contents of the cached file, None if missing, stale or evicted meanwhile"""
+        if not self.get(path):
+            return None
+        try:
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, path: str, data: bytes):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        self._evict()
+
+    def _evict(self):
+        """Drop the least recently written files above max_bytes"""
+        with self._lock:
+            entries = []
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".pdf"):
+                    st = entry.stat()
+                    entries.append((st.st_mtime, st.st_size, entry.path))
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                total -= size
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
@@ -4,6 +4,7 @@ Super Admin + Sales User + Cities
 """
 
 from db_sheets import create_user, create_city, get_user_by_username, get_user_by_email
+from city_resolver import CityResolver
 from passlib.context import CryptContext
 import uuid
 from datetime import datetime
@@ -62,10 +63,10 @@ def populate_initial_data():
     
     from db_sheets import get_all_cities
     existing_cities = get_all_cities()
-    existing_names = [c.get('name') for c in existing_cities]
+    resolver = CityResolver(existing_cities)
     
     for city in cities_to_create:
-        if city['name'] not in existing_names:
+        if not resolver.lookup(city['name']):
             city_data = {
                 "id": str(uuid.uuid4()),
                 "name": city['name'],
@@ -0,0 +1,253 @@
+"""
+Quota-aware scheduler for Google Sheets API calls
+
+L'API Sheets ha quote al minuto separate per letture e scritture: ogni chiamata
+remota di db_sheets passa da qui e prende un token dal bucket corrispondente.
+Chi aspetta un token viene servito per priorità: le richieste interattive
+(salvataggi dal calendario) passano davanti a quelle bulk (import CSV, report,
+flush in background), poi in ordine di arrivo.
+
+Le risposte 429 e 5xx vengono ritentate con backoff esponenziale con jitter;
+una 429 svuota anche il bucket, così le altre chiamate rallentano subito.
+Le chiamate non idempotenti (append, delete_rows) sono ritentate solo su 429,
+quando la richiesta sicuramente non è stata eseguita.
+
+La priorità è una ContextVar: vale per tutte le chiamate fatte nel blocco
+
+    with priority(BULK):
+        db.create_workdays_batch(rows)
+"""
+
+import contextvars
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+import gspread
+import requests
+
+logger = logging.getLogger(__name__)
+
+# Classi di priorità (valore più basso = servito prima)
+INTERACTIVE = 0
+BULK = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", BULK: "bulk"}
+
+_priority: contextvars.ContextVar = contextvars.ContextVar("sheets_priority", default=INTERACTIVE)
+
+
+@contextmanager
+def priority(level: int):
+    """Run the enclosed Sheets calls with the given priority class"""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def current_priority() -> int:
+    return _priority.get()
+
+
+class QuotaExceededError(Exception):
+    """The Sheets quota did not free up in time (or kept answering 429)"""
+
+
+class TokenBucket:
+    """Token bucket refilled at per_minute / 60 tokens per second, served by priority"""
+
+    def __init__(self, name: str, per_minute: int, burst: Optional[int] = None):
+        self.name = name
+        self.rate = per_minute / 60.0
+        self.capacity = float(burst or per_minute)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._cond = threading.Condition()
+        self._waiters: list = []
+        self._seq = itertools.count()
+        self.acquired = {name: 0 for name in PRIORITY_NAMES.values()}
+        self.wait_ms = {name: 0.0 for name in PRIORITY_NAMES.values()}
+        self.max_wait_ms = {name: 0.0 for name in PRIORITY_NAMES.values()}
+        self.timeouts = 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, level: int, timeout: float) -> float:
+        """Take one token, waiting behind higher-priority (then older) callers; returns seconds waited"""
+        ticket = (level, next(self._seq))
+        started = time.monotonic()
+        deadline = started + timeout
+        with self._cond:
+            heapq.heappush(self._waiters, ticket)
+            try:
+                while True:
+                    self._refill()
+                    at_head = self._waiters[0] == ticket
+                    if at_head and self._tokens >= 1:
+                        heapq.heappop(self._waiters)
+                        self._tokens -= 1
+                        self._cond.notify_all()
+                        break
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timeouts += 1
+                        raise QuotaExceededError(f"Sheets {self.name} quota busy for {timeout:.0f}s")
+                    wait = (1 - self._tokens) / self.rate if at_head else remaining
+                    self._cond.wait(min(wait, remaining))
+            except BaseException:
+                if ticket in self._waiters:
+                    self._waiters.remove(ticket)
+                    heapq.heapify(self._waiters)
+                    self._cond.notify_all()
+                raise
+
+        waited = time.monotonic() - started
+        name = PRIORITY_NAMES.get(level, str(level))
+        self.acquired[name] = self.acquired.get(name, 0) + 1
+        self.wait_ms[name] = self.wait_ms.get(name, 0.0) + waited * 1000
+        self.max_wait_ms[name] = max(self.max_wait_ms.get(name, 0.0), waited * 1000)
+        return waited
+
+    def drain(self):
+        """Empty the bucket after a 429: the server says the quota is already used up"""
+        with self._cond:
+            self._refill()
+            self._tokens = 0.0
+            self._updated = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            self._refill()
+            return {
+                "per_minute": round(self.rate * 60),
+                "tokens": round(self._tokens, 1),
+                "waiting": len(self._waiters),
+                "acquired": dict(self.acquired),
+                "avg_wait_ms": {
+                    name: round(self.wait_ms[name] / count, 1) if count else 0.0
+                    for name, count in self.acquired.items()
+                },
+                "max_wait_ms": {name: round(ms, 1) for name, ms in self.max_wait_ms.items()},
+                "timeouts": self.timeouts,
+            }
+
+
+def _status_code(exc: Exception) -> Optional[int]:
+    """HTTP status of a failed Sheets call, None if it is not an HTTP error"""
+    if isinstance(exc, gspread.exceptions.APIError):
+        code = exc.code if isinstance(exc.code, int) and exc.code > 0 else None
+        response = getattr(exc, "response", None)
+        return code or getattr(response, "status_code", None)
+    return None
+
+
+class QuotaScheduler:
+    """Rate-limit, prioritize and retry Sheets API calls"""
+
+    def __init__(self, read_per_minute: int, write_per_minute: int, max_retries: int = 5,
+                 backoff_base: float = 0.5, backoff_max: float = 16.0, max_wait: float = 30.0):
+        self.buckets = {
+            "read": TokenBucket("read", read_per_minute),
+            "write": TokenBucket("write", write_per_minute),
+        }
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_wait = max_wait
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.failures = 0
+
+    def _backoff(self, attempt: int) -> float:
+        # "Full jitter": attesa casuale fino al limite esponenziale
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+
+    def call(self, kind: str, fn: Callable[..., Any], *args, idempotent: bool = True, **kwargs) -> Any:
+        """Run one remote call under the `kind` ("read"/"write") quota, retrying 429/5xx"""
+        bucket = self.buckets[kind]
+        level = current_priority()
+        attempt = 0
+        while True:
+            bucket.acquire(level, self.max_wait)
+            with self._lock:
+                self.calls += 1
+            try:
+                return fn(*args, **kwargs)
+            except (gspread.exceptions.APIError, requests.exceptions.ConnectionError,
+                    requests.exceptions.Timeout) as exc:
+                status = _status_code(exc)
+                throttled = status == 429
+                retryable = throttled or (idempotent and (status is None or status >= 500))
+                with self._lock:
+                    if throttled:
+                        self.throttled += 1
+                    elif status is None or status >= 500:
+                        self.server_errors += 1
+                if throttled:
+                    bucket.drain()
+                if not retryable or attempt >= self.max_retries:
+                    with self._lock:
+                        self.failures += 1
+                    if throttled:
+                        raise QuotaExceededError(f"Sheets {kind} quota exceeded after {attempt + 1} attempts") from exc
+                    raise
+                delay = self._backoff(attempt)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                logger.warning("Sheets %s %s failed (%s), retry %d in %.2fs",
+                               kind, getattr(fn, "__name__", "call"), status or type(exc).__name__, attempt, delay)
+                time.sleep(delay)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            counters = {
+                "calls": self.calls,
+                "retries": self.retries,
+                "throttled": self.throttled,
+                "server_errors": self.server_errors,
+                "failures": self.failures,
+            }
+        return {**counters, **{name: bucket.stats() for name, bucket in self.buckets.items()}}
+
+
+class ScheduledProxy:
+    """
+    Wrap a gspread Spreadsheet/Worksheet so every API method goes through the
+    scheduler. `methods` maps method name -> (kind, idempotent); any other
+    attribute (title, id, col_count, ...) is passed through untouched.
+    """
+
+    def __init__(self, target: Any, scheduler: QuotaScheduler, methods: Dict[str, tuple]):
+        self._target = target
+        self._scheduler = scheduler
+        self._methods = methods
+
+    @property
+    def target(self) -> Any:
+        return self._target
+
+    def __getattr__(self, name: str) -> Any:
+        attr = getattr(self._target, name)
+        spec = self._methods.get(name)
+        if spec is None or not callable(attr):
+            return attr
+        kind, idempotent = spec
+
+        def scheduled(*args, **kwargs):
+            return self._scheduler.call(kind, attr, *args, idempotent=idempotent, **kwargs)
+
+        scheduled.__name__ = name
+        return scheduled
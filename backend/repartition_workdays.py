@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Sposta i workdays dal foglio unico "workdays" ai fogli per anno (workdays_YYYY)
+
+    python repartition_workdays.py            # copia (si può rilanciare)
+    python repartition_workdays.py --delete   # copia e svuota "workdays"
+
+Poi avviare il server con SHEETS_WORKDAYS_PARTITIONED=true.
+"""
+
+import argparse
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+import db_sheets
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Split the workdays sheet into per-year partitions")
+    parser.add_argument("--delete", action="store_true", help="remove the copied rows from the 'workdays' sheet")
+    args = parser.parse_args()
+
+    print("🔄 Repartitioning workdays...")
+    result = db_sheets.repartition_workdays(delete_source=args.delete)
+
+    print(f"   Rows in 'workdays': {result['source_rows']}")
+    for title, count in result["copied"].items():
+        print(f"   ✅ {title}: {count} rows copied")
+    if result["unrouted"]:
+        print(f"   ⚠️  {result['unrouted']} rows without a valid date left in 'workdays'")
+        if args.delete:
+            print("   ⚠️  'workdays' not emptied: fix those rows and run again")
+    if result["deleted"]:
+        print(f"   🗑️  {result['deleted']} rows removed from 'workdays'")
+
+    if not db_sheets.WORKDAYS_PARTITIONED:
+        print("👉 Set SHEETS_WORKDAYS_PARTITIONED=true to start using the partitions")
+    print("🎉 Done!")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""
+Row-position index for a Google Sheets worksheet
+
+Mappa una chiave (per i workdays: (user_id, date)) al numero di riga del
+foglio, così le operazioni su un singolo giorno leggono/scrivono solo quella
+riga invece di scaricare tutto il foglio.
+
+L'indice viene ricostruito da una lettura delle sole colonne chiave, poi
+mantenuto in place: le righe aggiunte prendono i numeri successivi, una riga
+cancellata fa scalare di uno tutte quelle sotto (come delete_rows sul foglio).
+Dopo il TTL viene ricostruito, per recepire modifiche fatte fuori dal processo.
+"""
+
+import bisect
+import threading
+import time
+from typing import Any, Dict, Hashable, Iterable, List, Optional
+
+from table_cache import FIRST_DATA_ROW
+
+
+class RowIndex:
+    """Thread-safe key -> sheet row numbers map for one worksheet"""
+
+    def __init__(self, ttl_seconds: float):
+        self.ttl_seconds = ttl_seconds
+        self._rows: Dict[Hashable, List[int]] = {}
+        self._next_row = FIRST_DATA_ROW
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.rebuilds = 0
+        # Incrementato a ogni modifica: load(version=...) scarta letture fatte prima di una scrittura
+        self.version = 0
+
+    def fresh(self) -> bool:
+        with self._lock:
+            return self._loaded_at is not None and time.monotonic() - self._loaded_at < self.ttl_seconds
+
+    def load(self, keys: Iterable[Optional[Hashable]], version: Optional[int] = None) -> bool:
+        """
+        Rebuild from the keys of every data row, in sheet order (None for blank rows).
+
+        With `version`, the rebuild is skipped (returns False) if the index was
+        modified since that version was read, i.e. the keys may miss a write.
+        """
+        rows: Dict[Hashable, List[int]] = {}
+        row = FIRST_DATA_ROW - 1
+        for row, key in enumerate(keys, start=FIRST_DATA_ROW):
+            if key is not None:
+                rows.setdefault(key, []).append(row)
+        with self._lock:
+            if version is not None and version != self.version:
+                return False
+            self._rows = rows
+            self._next_row = row + 1
+            self._loaded_at = time.monotonic()
+            self.rebuilds += 1
+            return True
+
+    def invalidate(self):
+        with self._lock:
+            self._rows = {}
+            self._loaded_at = None
+            self.version += 1
+
+    def find(self, key: Hashable) -> Optional[int]:
+        """Sheet row of the first row with this key"""
+        with self._lock:
+            rows = self._rows.get(key)
+            if rows:
+                self.hits += 1
+                return rows[0]
+            self.misses += 1
+            return None
+
+    def append(self, keys: Iterable[Optional[Hashable]]):
+        """Register rows appended at the end of the sheet"""
+        with self._lock:
+            self.version += 1
+            if self._loaded_at is None:
+                return
+            for key in keys:
+                if key is not None:
+                    self._rows.setdefault(key, []).append(self._next_row)
+                self._next_row += 1
+
+    def rekey(self, row: int, old_key: Hashable, new_key: Hashable):
+        """A row kept its position but its key columns changed"""
+        with self._lock:
+            self.version += 1
+            if self._loaded_at is None or old_key == new_key:
+                return
+            rows = self._rows.get(old_key, [])
+            if row in rows:
+                rows.remove(row)
+                if not rows:
+                    del self._rows[old_key]
+            if new_key is not None:
+                bisect.insort(self._rows.setdefault(new_key, []), row)
+
+    def remove_row(self, row: int):
+        """A row was deleted: drop it and shift every row below it up by one"""
+        with self._lock:
+            self.version += 1
+            if self._loaded_at is None:
+                return
+            for key in list(self._rows):
+                rows = [r if r < row else r - 1 for r in self._rows[key] if r != row]
+                if rows:
+                    self._rows[key] = rows
+                else:
+                    del self._rows[key]
+            self._next_row -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "keys": len(self._rows),
+                "next_row": self._next_row,
+                "loaded": self._loaded_at is not None,
+                "hits": self.hits,
+                "misses": self.misses,
+                "rebuilds": self.rebuilds,
+            }
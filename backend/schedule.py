@@ -0,0 +1,122 @@
+"""
+Batch schedule calculator for workdays (numpy)
+
+Stessa logica di server_old.calculate_work_day, ma su tanti workdays insieme
+e con aritmetica intera sui minuti del giorno invece di datetime:
+
+- giornata: 9 ore (8 lavoro + 1 pausa) = 540 minuti
+- i primi 30 minuti di andata e di ritorno non sono pagati
+- presenza in negozio = 540 - viaggio pagato + tolleranza extra (default 15)
+- lavoro = presenza - 60 (pausa)
+- partenza = arrivo - andata, uscita = arrivo + presenza, rientro = uscita + ritorno
+
+Il tempo di viaggio viene dalla città (city_resolver.CityResolver, costruito
+una volta dal foglio cities) o da custom_travel_minutes per le città
+personalizzate. I valori già presenti (minuti dal CSV, orari "Arrivo VIS",
+...) non vengono sovrascritti: si riempiono solo i campi vuoti.
+"""
+
+import os
+from typing import Any, Dict, List
+
+import numpy as np
+import pandas as pd
+
+from city_resolver import CityResolver
+
+WORKDAY_MINUTES = 540
+UNPAID_TRAVEL_MINUTES = 30
+BREAK_MINUTES = 60
+EXTRA_TOLERANCE_MINUTES = int(os.environ.get("EXTRA_TOLERANCE_MINUTES", "15"))
+DEFAULT_ARRIVAL_TIME = os.environ.get("DEFAULT_ARRIVAL_TIME", "10:00")
+
+MINUTES_PER_DAY = 24 * 60
+
+# Campi del workday riempiti da fill_schedules() quando sono vuoti
+CLOCK_FIELDS = ["departure_home", "arrival_time", "exit_time", "return_home"]
+MINUTE_FIELDS = ["travel_minutes_outbound", "travel_minutes_return", "work_minutes"]
+
+
+def parse_clock(values: pd.Series) -> np.ndarray:
+    """"HH:MM" strings as minutes of the day, -1 for blanks and invalid times"""
+    parts = values.fillna("").astype(str).str.strip().str.extract(r"^(\d{1,2}):(\d{2})")
+    hours = pd.to_numeric(parts[0], errors="coerce").to_numpy(dtype=float)
+    minutes = pd.to_numeric(parts[1], errors="coerce").to_numpy(dtype=float)
+    valid = (hours < 24) & (minutes < 60)
+    return np.where(valid, hours * 60 + minutes, -1).astype(int)
+
+
+def format_clock(minutes: np.ndarray) -> np.ndarray:
+    """Minutes (wrapped over midnight) as "HH:MM" strings"""
+    minutes = np.mod(minutes, MINUTES_PER_DAY)
+    hours = np.char.zfill((minutes // 60).astype(str), 2)
+    return np.char.add(np.char.add(hours, ":"), np.char.zfill((minutes % 60).astype(str), 2))
+
+
+def _numbers(column: pd.Series) -> np.ndarray:
+    """Sheet cells as floats, blanks and garbage as NaN"""
+    return pd.to_numeric(column.replace("", np.nan), errors="coerce").to_numpy(dtype=float)
+
+
+def compute_schedules(workdays: List[Dict[str, Any]], resolver: CityResolver,
+                      extra_tolerance: int = EXTRA_TOLERANCE_MINUTES,
+                      default_arrival: str = DEFAULT_ARRIVAL_TIME) -> Dict[str, np.ndarray]:
+    """
+    Schedule of every workday as arrays: a `valid` mask (rows with a known travel
+    time), the minute fields and the clock fields as "HH:MM".
+    """
+    frame = pd.DataFrame.from_records(workdays, columns=[
+        "city", "is_custom_city", "custom_travel_minutes", "arrival_time", "exit_time",
+        "travel_minutes_outbound", "travel_minutes_return",
+    ])
+    custom = frame["is_custom_city"].astype(str).str.lower().to_numpy() == "true"
+    city = frame["city"].fillna("").astype(str).str.strip().to_numpy()
+
+    travel = np.where(custom, _numbers(frame["custom_travel_minutes"]), resolver.travel_minutes(frame["city"]))
+    # Minuti già noti (es. dal CSV) hanno la precedenza su quelli della città
+    outbound = _numbers(frame["travel_minutes_outbound"])
+    outbound = np.where(outbound > 0, outbound, travel)
+    inbound = _numbers(frame["travel_minutes_return"])
+    inbound = np.where(inbound > 0, inbound, travel)
+    valid = ((city != "") | custom) & ~np.isnan(outbound) & ~np.isnan(inbound)
+
+    outbound = np.nan_to_num(outbound).astype(int)
+    inbound = np.nan_to_num(inbound).astype(int)
+    arrival = parse_clock(frame["arrival_time"])
+    arrival = np.where(arrival >= 0, arrival, parse_clock(pd.Series([default_arrival]))[0])
+
+    paid = np.maximum(0, outbound - UNPAID_TRAVEL_MINUTES) + np.maximum(0, inbound - UNPAID_TRAVEL_MINUTES)
+    presence = WORKDAY_MINUTES - paid + extra_tolerance
+    # Un'uscita già registrata resta la base del rientro
+    exit_time = parse_clock(frame["exit_time"])
+    exit_time = np.where(exit_time >= 0, exit_time, arrival + presence)
+
+    return {
+        "valid": valid,
+        "travel_minutes_outbound": outbound,
+        "travel_minutes_return": inbound,
+        "paid_travel_minutes": paid,
+        "presence_minutes": presence,
+        "work_minutes": presence - BREAK_MINUTES,
+        "departure_home": format_clock(arrival - outbound),
+        "arrival_time": format_clock(arrival),
+        "exit_time": format_clock(exit_time),
+        "return_home": format_clock(exit_time + inbound),
+    }
+
+
+def fill_schedules(workdays: List[Dict[str, Any]], resolver: CityResolver, **kwargs) -> int:
+    """Fill the empty minute and clock fields of the workdays in place, returns the rows computed"""
+    if not workdays:
+        return 0
+    schedule = compute_schedules(workdays, resolver, **kwargs)
+    rows = np.flatnonzero(schedule["valid"])
+    for i in rows:
+        workday = workdays[i]
+        for field in MINUTE_FIELDS:
+            if not workday.get(field):
+                workday[field] = int(schedule[field][i])
+        for field in CLOCK_FIELDS:
+            if not workday.get(field):
+                workday[field] = str(schedule[field][i])
+    return len(rows)
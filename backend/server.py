@@ -1,33 +1,204 @@
-from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File
+from fastapi import FastAPI, HTTPException, Depends, status, UploadFile, File, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, FileResponse, Response, StreamingResponse
 from pydantic import BaseModel, EmailStr, Field
 from typing import Optional, List
 from datetime import datetime, timedelta, timezone
 from passlib.context import CryptContext
 import jwt
 import os
-import uuid
-import io
+import asyncio
 import csv
+import io
+import itertools
+import json
+import calendar
+import hashlib
+import logging
+import time
+import uuid
 from dotenv import load_dotenv
 
-# Import Google Sheets database functions
-import db_sheets as db
+# Storage backend (STORAGE_BACKEND=sheets | sheets_async | sqlite, vedi storage.py)
+import storage as storage_backends
+from storage_executor import StorageExecutor, StorageBusyError
+from quota_scheduler import QuotaExceededError, BULK, priority as storage_priority
+from csv_import import import_csv_stream, format_row, CSV_COLUMNS
+from import_jobs import ImportJobManager
+import stats
+import workday_pages
+import schedule
+from city_resolver import CityResolver
+from pdf_report import PdfCache, render_monthly_pdf
+from bulk_pdf import BulkPdfRenderer, archive_name
 
 load_dotenv()
 
+db = storage_backends.load_backend()
+
+# Colonne dei workdays ammesse in fields= (ogni backend usa lo schema di db_sheets)
+WORKDAY_FIELDS = db.SHEETS_CONFIG["workdays"]
+
 # Configuration
 JWT_SECRET = os.getenv("JWT_SECRET", "your-secret-key-change-in-production")
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRATION_DAYS = 30
 
+# "lookup": ogni richiesta verifica l'utente sul foglio users (default)
+# "claims": si fida dei claims del JWT firmato, controllando solo il set in memoria
+#           degli utenti bloccati/eliminati, ricaricato in background
+AUTH_MODE = os.getenv("AUTH_MODE", "lookup")
+AUTH_REVOCATION_REFRESH_SECONDS = int(os.getenv("AUTH_REVOCATION_REFRESH_SECONDS", "60"))
+
+# Thread pool per le chiamate bloccanti a Google Sheets
+STORAGE_MAX_WORKERS = int(os.getenv("STORAGE_MAX_WORKERS", "8"))
+STORAGE_MAX_QUEUE = int(os.getenv("STORAGE_MAX_QUEUE", "64"))
+STORAGE_PER_TABLE_LIMIT = int(os.getenv("STORAGE_PER_TABLE_LIMIT", "4"))
+
+# Righe del CSV validate e salvate per ogni scrittura batch durante l'import
+CSV_IMPORT_CHUNK_SIZE = int(os.getenv("CSV_IMPORT_CHUNK_SIZE", "500"))
+
+# Import CSV in background: file e stato dei job su disco, job eseguiti insieme al massimo
+IMPORT_JOBS_DIR = os.getenv("IMPORT_JOBS_DIR", "import_jobs")
+IMPORT_JOBS_MAX_CONCURRENT = int(os.getenv("IMPORT_JOBS_MAX_CONCURRENT", "2"))
+
+# PDF mensili già generati, validi finché la versione dei dati del mese non cambia
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "pdf_cache")
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(100 * 1024 * 1024)))
+PDF_CACHE_TTL = float(os.getenv("PDF_CACHE_TTL", "86400"))
+
+# Pagine di GET /api/workdays: dimensione di default e massima (il limit viene ridotto a questa)
+WORKDAYS_PAGE_SIZE = int(os.getenv("WORKDAYS_PAGE_SIZE", "100"))
+WORKDAYS_PAGE_MAX_SIZE = int(os.getenv("WORKDAYS_PAGE_MAX_SIZE", "500"))
+
+# Righe lette dallo storage e scritte nella risposta per ogni blocco dell'export in streaming
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "500"))
+
+# Export PDF di tutti gli utenti: processi di rendering (0 = uno per core), limitati
+# a quanti ne stanno nella memoria della macchina tolta la quota del server
+PDF_BULK_MAX_WORKERS = int(os.getenv("PDF_BULK_MAX_WORKERS", "0"))
+PDF_BULK_WORKER_MB = int(os.getenv("PDF_BULK_WORKER_MB", "64"))
+PDF_BULK_RESERVED_MB = int(os.getenv("PDF_BULK_RESERVED_MB", "256"))
+
+logger = logging.getLogger(__name__)
+
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 security = HTTPBearer()
 
 app = FastAPI(title="Work Travel Manager API - Google Sheets Edition")
 
+storage = StorageExecutor(
+    max_workers=STORAGE_MAX_WORKERS,
+    max_queue=STORAGE_MAX_QUEUE,
+    per_table_limit=STORAGE_PER_TABLE_LIMIT,
+)
+
+async def run_db(table: str, fn, *args, **kwargs):
+    """Run a db_sheets function on the storage thread pool (async functions are awaited)"""
+    return await storage.run(table, fn, *args, **kwargs)
+
+async def run_db_bulk(table: str, fn, *args, **kwargs):
+    """Like run_db, but the Sheets calls wait behind interactive ones (imports, background jobs)"""
+    with storage_priority(BULK):
+        return await storage.run(table, fn, *args, **kwargs)
+
+async def load_city_resolver():
+    """Resolver for city names from requests and CSV rows (the storage rebuilds it only when cities change)"""
+    if hasattr(db, "city_resolver"):
+        return await run_db("cities", db.city_resolver)
+    return CityResolver(await run_db("cities", db.get_all_cities))
+
+async def run_import_job(job: dict, upload, start_chunk: int, on_chunk):
+    """Import the CSV of a background job, skipping the chunks it already committed"""
+    existing_workdays = await run_db_bulk("workdays", db.get_all_workdays, job["user_id"])
+    existing_dates = {wd.get('date') for wd in existing_workdays}
+    resolver = await load_city_resolver()
+    
+    async def save(workdays):
+        await run_db_bulk("workdays", db.create_workdays_batch, workdays)
+    
+    return await import_csv_stream(upload, job["user_id"], existing_dates, save, CSV_IMPORT_CHUNK_SIZE,
+                                   start_chunk=start_chunk, on_chunk=on_chunk, resolver=resolver)
+
+import_jobs = ImportJobManager(IMPORT_JOBS_DIR, IMPORT_JOBS_MAX_CONCURRENT, run_import_job)
+
+pdf_cache = PdfCache(PDF_CACHE_DIR, PDF_CACHE_MAX_BYTES, PDF_CACHE_TTL)
+bulk_pdf = BulkPdfRenderer(PDF_BULK_MAX_WORKERS, PDF_BULK_WORKER_MB, PDF_BULK_RESERVED_MB)
+
+async def list_etag(request: Request, table: str, scope: str = "*") -> Optional[str]:
+    """
+    Strong ETag of a list response from the table version, the query params and the
+    caller scope ("*" or a user id, whose own version is used). None if the backend has
+    no versions (sqlite): storage.load_backend logs it at startup.
+    """
+    if not hasattr(db, "table_version"):
+        return None
+    if hasattr(db, "refresh_version"):
+        # Rilegge la tabella solo se l'ultima lettura è vecchia: le modifiche a mano cambiano la versione
+        await run_db(table, db.refresh_version, table)
+    version = db.table_version(table, None if scope == "*" else scope)
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+    digest = hashlib.sha1(f"{table}|{version}|{scope}|{params}".encode()).hexdigest()
+    return f'"{digest}"'
+
+def conditional_response(request: Request, etag: Optional[str]) -> Optional[Response]:
+    """304 if the client's If-None-Match has the current ETag, None to build the full response"""
+    header = request.headers.get("if-none-match")
+    if not etag or not header:
+        return None
+    tags = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    if "*" in tags or etag in tags:
+        return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "private, no-cache"})
+    return None
+
+def with_etag(response: Response, etag: Optional[str]):
+    if etag:
+        response.headers["ETag"] = etag
+        # Il browser rivalida ogni volta, con If-None-Match
+        response.headers["Cache-Control"] = "private, no-cache"
+
+@app.exception_handler(StorageBusyError)
+async def storage_busy_handler(request, exc: StorageBusyError):
+    return JSONResponse(status_code=503, content={"detail": "Server occupato, riprova tra poco"}, headers={"Retry-After": "1"})
+
+@app.exception_handler(QuotaExceededError)
+async def quota_exceeded_handler(request, exc: QuotaExceededError):
+    return JSONResponse(status_code=503, content={"detail": "Quota Google Sheets esaurita, riprova tra poco"}, headers={"Retry-After": "10"})
+
+@app.on_event("startup")
+async def prefetch_storage():
+    if hasattr(db, "prefetch_tables"):
+        try:
+            await db.prefetch_tables()
+        except Exception:
+            logger.exception("Table prefetch failed")
+
+@app.on_event("startup")
+async def start_write_behind():
+    # Rilegge il journal lasciato da un arresto precedente e avvia il flush periodico
+    if getattr(db, "WRITE_BEHIND", False):
+        replayed = await run_db("write_behind", db.start_write_behind)
+        if replayed:
+            logger.info("Write-behind journal replayed: %d operations", replayed)
+
+@app.on_event("startup")
+async def resume_import_jobs():
+    # I job interrotti da un riavvio ripartono dall'ultimo blocco salvato
+    import_jobs.resume()
+
+@app.on_event("shutdown")
+async def shutdown_storage():
+    await import_jobs.shutdown()
+    if getattr(db, "WRITE_BEHIND", False):
+        await run_db("write_behind", db.stop_write_behind)
+    if hasattr(db, "close_versions"):
+        await run_db("workdays", db.close_versions)
+    storage.shutdown()
+    if hasattr(db, "close"):
+        await db.close()
+
 # CORS
 app.add_middleware(
     CORSMiddleware,
@@ -86,37 +257,92 @@ def create_token(user_id: str, role: str) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=JWT_ALGORITHM)
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def token_claims(credentials: HTTPAuthorizationCredentials = Depends(security)) -> dict:
+    """Id and role of a valid token, without reading the user: enough to answer a 304"""
     try:
         payload = jwt.decode(credentials.credentials, JWT_SECRET, algorithms=[JWT_ALGORITHM])
-        user_id = payload.get("user_id")
-        user = db.get_user_by_id(user_id)
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
+    return {"id": payload.get("user_id"), "role": payload.get("role")}
+
+async def load_user(claims: dict) -> dict:
+    """The token's user from the storage (claims mode: its current role), 401 if removed or revoked"""
+    if AUTH_MODE == "claims":
+        role = await run_db("users", db.check_token_claims, claims["id"])
+        if role is None:
+            raise HTTPException(status_code=401, detail="User not found")
+        return {"id": claims["id"], "role": role}
+    user = await run_db("users", db.get_user_by_id, claims["id"])
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
+async def get_current_user(claims: dict = Depends(token_claims)):
+    return await load_user(claims)
 
 async def require_admin(user: dict = Depends(get_current_user)):
     if user["role"] not in ["super_admin", "admin", "hr"]:
         raise HTTPException(status_code=403, detail="Admin access required")
     return user
 
+async def refresh_revocations_loop():
+    while True:
+        try:
+            await run_db_bulk("users", db.refresh_revocations)
+        except Exception:
+            logger.exception("Revocation refresh failed")
+        await asyncio.sleep(AUTH_REVOCATION_REFRESH_SECONDS)
+
+@app.on_event("startup")
+async def start_revocation_refresh():
+    if AUTH_MODE == "claims":
+        app.state.revocation_task = asyncio.create_task(refresh_revocations_loop())
+
+async def compact_tables_loop():
+    while True:
+        await asyncio.sleep(db.COMPACT_INTERVAL_SECONDS)
+        try:
+            await run_db_bulk("compaction", db.compact_tables)
+        except Exception:
+            logger.exception("Table compaction failed")
+
+@app.on_event("startup")
+async def start_compaction():
+    # Soft delete: le righe marcate vengono rimosse in blocco in background
+    if getattr(db, "SOFT_DELETE", False):
+        app.state.compaction_task = asyncio.create_task(compact_tables_loop())
+
 # Routes
 @app.get("/api/")
 async def root():
     return {"message": "Work Travel Manager API - Google Sheets Backend", "status": "running"}
 
+@app.get("/api/cache/stats")
+async def get_cache_stats(user: dict = Depends(require_admin)):
+    """Hit/miss counters of the Sheets table cache"""
+    return db.cache_stats()
+
+@app.get("/api/storage/stats")
+async def get_storage_stats(user: dict = Depends(require_admin)):
+    """Queue depth and timings of the storage thread pool (plus quota scheduler and import jobs)"""
+    stats = storage.stats()
+    stats["import_jobs"] = import_jobs.stats()
+    stats["pdf_cache"] = pdf_cache.stats()
+    stats["bulk_pdf"] = bulk_pdf.stats()
+    if hasattr(db, "quota_stats"):
+        stats["quota"] = db.quota_stats()
+    return stats
+
 @app.post("/api/auth/login")
 async def login(data: LoginRequest):
     # Check if it's admin login (username) or user login (email)
     if "@" in data.username:
-        user = db.get_user_by_email(data.username)
+        user = await run_db("users", db.get_user_by_email, data.username)
     else:
         # Admin login with username
-        user = db.get_user_by_username(data.username)
+        user = await run_db("users", db.get_user_by_username, data.username)
     
     if not user:
         raise HTTPException(status_code=400, detail="Credenziali non valide")
@@ -142,8 +368,17 @@ async def login(data: LoginRequest):
     }
 
 @app.get("/api/users")
-async def get_users(user: dict = Depends(require_admin)):
-    users = db.get_all_users()
+async def get_users(request: Request, response: Response, claims: dict = Depends(token_claims)):
+    # 304 con il solo token (ruolo compreso), il resto dopo la lettura dell'utente
+    await require_admin(claims)
+    etag = await list_etag(request, "users")
+    not_modified = conditional_response(request, etag)
+    if not_modified:
+        return not_modified
+    await require_admin(await load_user(claims))
+    with_etag(response, etag)
+    
+    users = await run_db("users", db.get_all_users)
     # Remove password_hash from response
     for u in users:
         u.pop("password_hash", None)
@@ -152,7 +387,7 @@ async def get_users(user: dict = Depends(require_admin)):
 @app.post("/api/users")
 async def create_user(data: UserCreate, user: dict = Depends(require_admin)):
     # Check if user exists
-    existing = db.get_user_by_email(data.email)
+    existing = await run_db("users", db.get_user_by_email, data.email)
     if existing:
         raise HTTPException(status_code=400, detail="Email già esistente")
     
@@ -170,7 +405,7 @@ async def create_user(data: UserCreate, user: dict = Depends(require_admin)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    db.create_user(new_user)
+    await run_db("users", db.create_user, new_user)
     new_user.pop("password_hash")
     return new_user
 
@@ -180,23 +415,27 @@ async def update_user(user_id: str, data: UserUpdate, user: dict = Depends(requi
     if not update_data:
         raise HTTPException(status_code=400, detail="No data to update")
     
-    success = db.update_user(user_id, update_data)
+    success = await run_db("users", db.update_user, user_id, update_data)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
     
-    updated_user = db.get_user_by_id(user_id)
+    updated_user = await run_db("users", db.get_user_by_id, user_id)
     updated_user.pop("password_hash", None)
     return updated_user
 
 @app.delete("/api/users/{user_id}")
 async def delete_user(user_id: str, user: dict = Depends(require_admin)):
-    success = db.delete_user(user_id)
+    success = await run_db("users", db.delete_user, user_id)
     if not success:
         raise HTTPException(status_code=404, detail="User not found")
     return {"message": "User deleted"}
 
 @app.get("/api/profile")
 async def get_profile(user: dict = Depends(get_current_user)):
+    if AUTH_MODE == "claims":
+        user = await run_db("users", db.get_user_by_id, user["id"])
+        if not user:
+            raise HTTPException(status_code=401, detail="User not found")
     user.pop("password_hash", None)
     return user
 
@@ -208,20 +447,27 @@ async def update_profile(data: dict, user: dict = Depends(get_current_user)):
     
     if "email" in update_data:
         # Check if email already exists
-        existing = db.get_user_by_email(update_data["email"])
+        existing = await run_db("users", db.get_user_by_email, update_data["email"])
         if existing and existing["id"] != user["id"]:
             raise HTTPException(status_code=400, detail="Email già in uso")
     
     if update_data:
-        db.update_user(user["id"], update_data)
+        await run_db("users", db.update_user, user["id"], update_data)
     
-    updated_user = db.get_user_by_id(user["id"])
+    updated_user = await run_db("users", db.get_user_by_id, user["id"])
     updated_user.pop("password_hash", None)
     return updated_user
 
 @app.get("/api/cities")
-async def get_cities(user: dict = Depends(get_current_user)):
-    cities = db.get_all_cities()
+async def get_cities(request: Request, response: Response, claims: dict = Depends(token_claims)):
+    etag = await list_etag(request, "cities")
+    not_modified = conditional_response(request, etag)
+    if not_modified:
+        return not_modified
+    await load_user(claims)
+    with_etag(response, etag)
+    
+    cities = await run_db("cities", db.get_all_cities)
     return cities
 
 @app.post("/api/cities")
@@ -230,6 +476,10 @@ async def create_city(data: CityCreate, user: dict = Depends(get_current_user)):
     if user["role"] not in ["super_admin", "admin", "hr", "user"]:
         raise HTTPException(status_code=403, detail="Non hai i permessi per aggiungere città")
     
+    resolver = await load_city_resolver()
+    if resolver.lookup(data.name):
+        raise HTTPException(status_code=400, detail="Città già esistente")
+    
     city_id = str(uuid.uuid4())
     new_city = {
         "id": city_id,
@@ -238,7 +488,7 @@ async def create_city(data: CityCreate, user: dict = Depends(get_current_user)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    db.create_city(new_city)
+    await run_db("cities", db.create_city, new_city)
     return new_city
 
 @app.patch("/api/cities/{city_id}")
@@ -247,23 +497,35 @@ async def update_city(city_id: str, data: CityCreate, user: dict = Depends(get_c
     if user["role"] not in ["super_admin", "admin", "hr", "user"]:
         raise HTTPException(status_code=403, detail="Non hai i permessi per modificare città")
     
-    success = db.update_city(city_id, data.dict())
+    resolver = await load_city_resolver()
+    same_name = resolver.lookup(data.name)
+    if same_name and same_name["id"] != city_id:
+        raise HTTPException(status_code=400, detail="Città già esistente")
+    
+    success = await run_db("cities", db.update_city, city_id, data.dict())
     if not success:
         raise HTTPException(status_code=404, detail="City not found")
     
-    updated_city = db.get_city_by_id(city_id)
+    updated_city = await run_db("cities", db.get_city_by_id, city_id)
     return updated_city
 
 @app.delete("/api/cities/{city_id}")
 async def delete_city(city_id: str, user: dict = Depends(require_admin)):
-    success = db.delete_city(city_id)
+    success = await run_db("cities", db.delete_city, city_id)
     if not success:
         raise HTTPException(status_code=404, detail="City not found")
     return {"message": "City deleted"}
 
 @app.get("/api/roles")
-async def get_roles(user: dict = Depends(get_current_user)):
-    roles = db.get_all_roles()
+async def get_roles(request: Request, response: Response, claims: dict = Depends(token_claims)):
+    etag = await list_etag(request, "roles")
+    not_modified = conditional_response(request, etag)
+    if not_modified:
+        return not_modified
+    await load_user(claims)
+    with_etag(response, etag)
+    
+    roles = await run_db("roles", db.get_all_roles)
     # Add default roles if none exist
     if not roles:
         default_roles = [
@@ -289,36 +551,127 @@ async def create_role(data: RoleCreate, user: dict = Depends(require_admin)):
         "created_at": datetime.now(timezone.utc).isoformat()
     }
     
-    db.create_role(new_role)
+    await run_db("roles", db.create_role, new_role)
     return new_role
 
+def workdays_owner(user: dict, user_id: Optional[str]) -> Optional[str]:
+    """Workdays a caller may read: admins anyone's (None = all), the others only their own"""
+    if user["role"] not in ["super_admin", "admin", "hr"]:
+        # Users see only their own workdays
+        if user_id and user_id != user["id"]:
+            raise HTTPException(status_code=403, detail="Admin access required")
+        return user["id"]
+    return user_id
+
+def date_range(month: Optional[str], year: Optional[str], date_from: Optional[str], date_to: Optional[str]) -> dict:
+    """date_from/date_to (YYYY-MM-DD) of a query, month/year become a range"""
+    if year and not (date_from or date_to):
+        try:
+            int(year)
+            if month:
+                last_day = calendar.monthrange(int(year), int(month))[1]
+                date_from, date_to = f"{year}-{month.zfill(2)}-01", f"{year}-{month.zfill(2)}-{last_day}"
+            else:
+                date_from, date_to = f"{year}-01-01", f"{year}-12-31"
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Mese o anno non validi")
+    return {
+        "date_from": workday_pages.iso_date(date_from) or None,
+        "date_to": workday_pages.iso_date(date_to) or None,
+    }
+
+def workday_date(value: str) -> str:
+    """YYYY-MM-DD of a workday date (DD/MM/YYYY is converted), 400 if it is not a valid date"""
+    date_iso = workday_pages.iso_date(value)
+    try:
+        datetime.strptime(date_iso, "%Y-%m-%d")
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Data non valida: {value}")
+    return date_iso
+
 @app.get("/api/workdays")
-async def get_workdays(user: dict = Depends(get_current_user), month: Optional[str] = None, year: Optional[str] = None):
-    # Users see only their own workdays
-    if user["role"] in ["super_admin", "admin", "hr"]:
-        workdays = db.get_all_workdays()
-    else:
-        workdays = db.get_all_workdays(user["id"])
+async def get_workdays(request: Request, response: Response, claims: dict = Depends(token_claims),
+                       month: Optional[str] = None, year: Optional[str] = None,
+                       user_id: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                       cursor: Optional[str] = None, limit: Optional[int] = None, fields: Optional[str] = None):
+    """
+    Workdays of the caller (admin: of everyone). Without paging params the whole list,
+    as before; with limit/cursor/fields/user_id/date_from/date_to a page ordered by
+    (date, user_id): {"items", "next_cursor", "limit"}.
+    """
+    # Admin: versione di tutti i workdays (o dell'utente richiesto), gli altri solo quella dei propri.
+    # Il 304 usa il ruolo del token; la risposta completa quello letto dallo storage
+    scope = workdays_owner(claims, user_id)
+    etag = await list_etag(request, "workdays", scope or "*")
+    not_modified = conditional_response(request, etag)
+    if not_modified:
+        return not_modified
+    user_id = workdays_owner(await load_user(claims), user_id)
+    if user_id != scope:
+        etag = await list_etag(request, "workdays", user_id or "*")
+    with_etag(response, etag)
+    
+    paged = {"user_id", "date_from", "date_to", "cursor", "limit", "fields"} & set(request.query_params)
+    if not paged:
+        # Filter by month/year if provided (the storage reads only that year's partition)
+        period = {"year": year, "month": month} if month and year else {}
+        return await run_db("workdays", db.get_all_workdays, user_id, **period)
+    
+    limit = max(1, min(limit or WORKDAYS_PAGE_SIZE, WORKDAYS_PAGE_MAX_SIZE))
+    projection = [f.strip() for f in fields.split(",") if f.strip()] if fields else None
+    unknown = [f for f in projection or [] if f not in WORKDAY_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Campi non validi: {', '.join(unknown)}")
+    try:
+        after = workday_pages.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Cursore non valido")
     
-    # Filter by month/year if provided
-    if month and year:
-        filtered = []
-        for wd in workdays:
-            date_str = wd.get('date', '')
-            if date_str:
-                # Date format: YYYY-MM-DD or DD/MM/YYYY
-                if '-' in date_str:
-                    year_wd, month_wd, _ = date_str.split('-')
-                elif '/' in date_str:
-                    day, month_wd, year_wd = date_str.split('/')
-                else:
-                    continue
-                
-                if str(month_wd).lstrip('0') == str(month).lstrip('0') and str(year_wd) == str(year):
-                    filtered.append(wd)
-        workdays = filtered
-    
-    return workdays
+    filters = {"user_id": user_id, **date_range(month, year, date_from, date_to), "after": after}
+    if hasattr(db, "get_workdays_page"):
+        items, next_cursor = await run_db("workdays", db.get_workdays_page, limit=limit, fields=projection, **filters)
+    else:
+        workdays = await run_db("workdays", db.get_all_workdays, user_id)
+        items, next_cursor = workday_pages.paginate(workdays, limit, projection, **filters)
+    return {"items": items, "next_cursor": next_cursor, "limit": limit}
+
+def workday_update(data: WorkdayCreate, resolver: CityResolver, stored: Optional[dict] = None) -> dict:
+    """
+    Fields written when a day is changed (POST on an existing date, PUT): canonical city name,
+    minutes and times recomputed for it from the stored row (its arrival time is kept)
+    """
+    update_data = {
+        "city": resolver.canonical_name(data.city) if data.city else data.city,
+        "is_custom_city": data.is_custom_city,
+        "custom_city_name": data.custom_city_name,
+        "custom_distance_km": data.custom_distance_km,
+        "custom_travel_minutes": data.custom_travel_minutes,
+        "actual_arrival_at_store": data.actual_arrival_at_store,
+        "actual_exit_from_store": data.actual_exit_from_store,
+        "actual_return_home": data.actual_return_home,
+        "status": data.status
+    }
+    minutes = {
+        "travel_minutes_outbound": data.travel_minutes_outbound,
+        "travel_minutes_return": data.travel_minutes_return,
+        "work_minutes": data.work_minutes,
+    }
+    # Riga salvata + modifica: resta l'arrivo registrato, il resto si ricalcola per la nuova città
+    computed = {
+        **(stored or {}),
+        **update_data,
+        **minutes,
+        "departure_home": "",
+        "exit_time": "",
+        "return_home": "",
+    }
+    if schedule.fill_schedules([computed], resolver):
+        update_data.update({field: computed[field] for field in schedule.MINUTE_FIELDS + schedule.CLOCK_FIELDS})
+    else:
+        # Giorno senza trasferta (riposo, ferie, ...): niente minuti di viaggio né orari del giorno prima
+        update_data.update(minutes)
+        update_data.update({field: "" for field in schedule.CLOCK_FIELDS})
+    return update_data
 
 @app.post("/api/workdays")
 async def create_workday(data: WorkdayCreate, user: dict = Depends(get_current_user)):
@@ -326,36 +679,23 @@ async def create_workday(data: WorkdayCreate, user: dict = Depends(get_current_u
     workday_id = str(uuid.uuid4())
     
     # Convert date DD/MM/YYYY -> YYYY-MM-DD for consistency
-    date_str = data.date
-    if '/' in date_str:
-        day, month, year = date_str.split('/')
-        date_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-    else:
-        date_iso = date_str
+    date_iso = workday_date(data.date)
     
     # Check if workday already exists for this date
-    existing = db.get_workday_by_date(user["id"], date_iso)
+    existing = await run_db("workdays", db.get_workday_by_date, user["id"], date_iso)
+    resolver = await load_city_resolver()
     if existing:
         # Update instead of create
-        update_data = {
-            "city": data.city,
-            "is_custom_city": data.is_custom_city,
-            "custom_city_name": data.custom_city_name,
-            "custom_distance_km": data.custom_distance_km,
-            "custom_travel_minutes": data.custom_travel_minutes,
-            "actual_arrival_at_store": data.actual_arrival_at_store,
-            "actual_exit_from_store": data.actual_exit_from_store,
-            "actual_return_home": data.actual_return_home,
-            "status": data.status
-        }
-        db.update_workday(user["id"], date_iso, update_data)
-        return db.get_workday_by_date(user["id"], date_iso)
+        update_data = workday_update(data, resolver, existing)
+        await run_db("workdays", db.update_workday, user["id"], date_iso, update_data)
+        return await run_db("workdays", db.get_workday_by_date, user["id"], date_iso)
     
     workday_data = {
         "id": workday_id,
         "user_id": user["id"],
         "date": date_iso,
-        "city": data.city,
+        # Stesso nome del foglio cities usato dall'import CSV ("VICENZA" -> "Padova/Vicenza")
+        "city": resolver.canonical_name(data.city) if data.city else data.city,
         "is_custom_city": data.is_custom_city,
         "custom_city_name": data.custom_city_name,
         "custom_distance_km": data.custom_distance_km,
@@ -373,150 +713,283 @@ async def create_workday(data: WorkdayCreate, user: dict = Depends(get_current_u
         "status": data.status,
         "created_at": datetime.now(timezone.utc).isoformat()
     }
+    # Minuti e orari calcolati dalla città (partenza, arrivo, uscita, rientro)
+    schedule.fill_schedules([workday_data], resolver)
     
-    db.create_workday(workday_data)
+    await run_db("workdays", db.create_workday, workday_data)
     return workday_data
 
 @app.put("/api/workdays/{date}")
 async def update_workday(date: str, data: WorkdayCreate, user: dict = Depends(get_current_user)):
     """Update existing workday"""
     # Convert date format if needed
-    date_str = date
-    if '/' in date_str:
-        day, month, year = date_str.split('/')
-        date_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-    else:
-        date_iso = date_str
+    date_iso = workday_date(date)
     
-    update_data = {
-        "city": data.city,
-        "is_custom_city": data.is_custom_city,
-        "custom_city_name": data.custom_city_name,
-        "custom_distance_km": data.custom_distance_km,
-        "custom_travel_minutes": data.custom_travel_minutes,
-        "actual_arrival_at_store": data.actual_arrival_at_store,
-        "actual_exit_from_store": data.actual_exit_from_store,
-        "actual_return_home": data.actual_return_home,
-        "status": data.status
-    }
+    existing = await run_db("workdays", db.get_workday_by_date, user["id"], date_iso)
+    if not existing:
+        raise HTTPException(status_code=404, detail="Workday not found")
+    update_data = workday_update(data, await load_city_resolver(), existing)
     
-    success = db.update_workday(user["id"], date_iso, update_data)
+    success = await run_db("workdays", db.update_workday, user["id"], date_iso, update_data)
     if not success:
         raise HTTPException(status_code=404, detail="Workday not found")
     
-    return db.get_workday_by_date(user["id"], date_iso)
+    return await run_db("workdays", db.get_workday_by_date, user["id"], date_iso)
 
 @app.delete("/api/workdays")
 async def delete_workday(date: str, user: dict = Depends(get_current_user)):
     """Delete workday by date (query param)"""
     # Convert date format if needed
-    date_str = date
-    if '/' in date_str:
-        day, month, year = date_str.split('/')
-        date_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-    else:
-        date_iso = date_str
+    date_iso = workday_date(date)
     
-    success = db.delete_workday(user["id"], date_iso)
+    success = await run_db("workdays", db.delete_workday, user["id"], date_iso)
     if not success:
         raise HTTPException(status_code=404, detail="Workday not found")
     
     return {"message": "Workday deleted"}
 
+@app.get("/api/stats/monthly")
+async def get_monthly_stats(year: str, month: Optional[str] = None, user_id: Optional[str] = None,
+                            user: dict = Depends(get_current_user)):
+    """Monthly totals (or the whole year without month), with a per user and month breakdown"""
+    # Admin: tutti gli utenti o quello richiesto; gli altri solo i propri
+    if user["role"] not in ["super_admin", "admin", "hr"]:
+        if user_id and user_id != user["id"]:
+            raise HTTPException(status_code=403, detail="Admin access required")
+        user_id = user["id"]
+    
+    if getattr(db, "MONTHLY_AGGREGATES", False):
+        # Totali già materializzati: una lookup invece di rileggere i workdays
+        groups = await run_db("workdays", db.get_monthly_aggregates, user_id, year, month)
+        return stats.summarize(groups, year, month)
+    
+    period = {"year": year, "month": month} if month else {"year": year}
+    workdays = await run_db("workdays", db.get_all_workdays, user_id, **period)
+    # Il calcolo pandas gira sul thread pool, non sull'event loop
+    return await run_db("stats", stats.monthly_stats, workdays, year, month)
+
+def report_versions(user_ids: List[Optional[str]], year: str, month: str) -> dict:
+    """PDF cache key versions of each user's report: the month's workdays, users and cities (names in the PDF)"""
+    shared = (db.table_version("users"), db.table_version("cities"))
+    return {user_id: (db.workdays_version(user_id, year, month), *shared) for user_id in user_ids}
+
+@app.get("/api/export/pdf")
+async def export_monthly_pdf(month: str, year: str, user_id: Optional[str] = None,
+                             user: dict = Depends(get_current_user)):
+    """Monthly PDF report, served from the disk cache while the month's data is unchanged"""
+    if user["role"] not in ["super_admin", "admin", "hr"]:
+        if user_id and user_id != user["id"]:
+            raise HTTPException(status_code=403, detail="Admin access required")
+        user_id = user["id"]
+    
+    filename = f"report_{month}_{year}.pdf"
+    path = None
+    if hasattr(db, "workdays_version"):
+        versions = await run_db("workdays", report_versions, [user_id], year, month)
+        path = pdf_cache.path(user_id or "all", month, year, *versions[user_id])
+        if pdf_cache.get(path):
+            return FileResponse(path, media_type="application/pdf", filename=filename)
+    
+    workdays = await run_db("workdays", db.get_all_workdays, user_id, year=year, month=month)
+    resolver = await load_city_resolver()
+    if user_id:
+        target = await run_db("users", db.get_user_by_id, user_id)
+        if not target:
+            raise HTTPException(status_code=404, detail="Utente non trovato")
+        user_name = target.get("username") or target.get("email")
+    else:
+        user_name = "Tutti gli utenti"
+    
+    summary = await run_db("stats", stats.monthly_stats, workdays, year, month)
+    city_names = resolver.names()
+    # Il rendering reportlab è CPU-bound: fuori dall'event loop
+    data = await asyncio.to_thread(render_monthly_pdf, workdays, summary, user_name, month, year, city_names)
+    
+    if path is None:
+        return Response(content=data, media_type="application/pdf",
+                        headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+    await asyncio.to_thread(pdf_cache.put, path, data)
+    return FileResponse(path, media_type="application/pdf", filename=filename)
+
+@app.get("/api/export/pdf/bulk")
+async def export_monthly_pdfs(month: str, year: str, user: dict = Depends(require_admin)):
+    """Every user's monthly PDF in a streamed ZIP, rendered in a process pool (manifest.json last)"""
+    # Il posto si prende subito: una seconda richiesta riceve 409 anche mentre questa carica i dati
+    if not bulk_pdf.acquire():
+        raise HTTPException(status_code=409, detail="Esportazione PDF già in corso, riprova tra poco")
+    
+    try:
+        # Un solo caricamento dei dati per tutti gli utenti
+        started = time.perf_counter()
+        workdays = await run_db_bulk("workdays", db.get_all_workdays, None, year=year, month=month)
+        users = await run_db_bulk("users", db.get_all_users)
+        resolver = await load_city_resolver()
+        summary = await run_db("stats", stats.monthly_stats, workdays, year, month)
+    
+        by_user = {}
+        for wd in workdays:
+            by_user.setdefault(wd.get("user_id"), []).append(wd)
+        user_stats = {row["user_id"]: row for row in summary["breakdown"]}
+        empty_stats = stats.summarize([], year, month)
+        city_names = resolver.names()
+    
+        versions = {}
+        if hasattr(db, "workdays_version"):
+            versions = await run_db("workdays", report_versions, [u["id"] for u in users], year, month)
+    
+        jobs = []
+        filenames = set()
+        for u in users:
+            user_name = u.get("username") or u.get("email")
+            filename = f"report_{month}_{year}_{archive_name(user_name or u['id'])}.pdf"
+            if filename in filenames:
+                filename = filename.replace(".pdf", f"_{u['id'][:8]}.pdf")
+            filenames.add(filename)
+            job = {"user_id": u["id"], "username": user_name, "filename": filename}
+            if u["id"] in versions:
+                job["cache_path"] = pdf_cache.path(u["id"], month, year, *versions[u["id"]])
+                job["data"] = await asyncio.to_thread(pdf_cache.read, job["cache_path"])
+            if job.get("data") is None:
+                job["args"] = {
+                    "workdays": by_user.get(u["id"], []),
+                    "stats": user_stats.get(u["id"], empty_stats),
+                    "user_name": user_name,
+                    "month": month,
+                    "year": year,
+                    "city_names": city_names,
+                }
+            jobs.append(job)
+    
+        async def cache_rendered(job, data):
+            if job.get("cache_path"):
+                await asyncio.to_thread(pdf_cache.put, job["cache_path"], data)
+    
+        stream = bulk_pdf.stream_zip(jobs, time.perf_counter() - started, cache_rendered)
+        # Generatore avviato: il suo finally rilascia il posto anche se il client non legge mai la risposta
+        first_chunk = await stream.__anext__()
+    except BaseException:
+        bulk_pdf.release()
+        raise
+    
+    async def body():
+        yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    
+    return StreamingResponse(
+        body(),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="report_{month}_{year}.zip"'},
+    )
+
+@app.get("/api/export/workdays")
+async def export_workdays(format: str = "ndjson", month: Optional[str] = None, year: Optional[str] = None,
+                          user_id: Optional[str] = None, date_from: Optional[str] = None, date_to: Optional[str] = None,
+                          user: dict = Depends(get_current_user)):
+    """
+    Stream the workdays as NDJSON (one object per line) or CSV (import_csv layout plus "Utente"),
+    same filters as GET /api/workdays. Google Sheets backends stream in sheet order within each
+    year partition (oldest first), the others ordered by (date, user_id)
+    """
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(status_code=400, detail="Formato non valido (ndjson o csv)")
+    filters = {"user_id": workdays_owner(user, user_id), **date_range(month, year, date_from, date_to)}
+    
+    if hasattr(db, "iter_workdays"):
+        # Il generatore legge blocchi di righe del foglio, sul thread pool dello storage
+        rows = db.iter_workdays(**filters)
+    else:
+        workdays = await run_db("workdays", db.get_all_workdays, filters["user_id"])
+        rows = iter(sorted((w for w in workdays if workday_pages.matches(w, **filters)), key=workday_pages.page_key))
+    
+    if format == "csv":
+        resolver = await load_city_resolver()
+        city_names = resolver.names()
+        users = await run_db("users", db.get_all_users)
+        usernames = {u["id"]: u.get("username") or u.get("email") for u in users}
+    
+    def encode(batch) -> str:
+        if format == "ndjson":
+            return "".join(json.dumps(w, ensure_ascii=False, default=str) + "\n" for w in batch)
+        out = io.StringIO()
+        writer = csv.writer(out, delimiter=";")
+        for w in batch:
+            writer.writerow(format_row(w, city_names) + [usernames.get(w.get("user_id"), w.get("user_id"))])
+        return out.getvalue()
+    
+    async def next_batch() -> list:
+        if not hasattr(rows, "__anext__"):
+            return await run_db_bulk("workdays", lambda: list(itertools.islice(rows, EXPORT_BATCH_SIZE)))
+        # Backend asincrono: il generatore fa le sue richieste sul loop, con priorità bulk
+        batch = []
+        with storage_priority(BULK):
+            async for w in rows:
+                batch.append(w)
+                if len(batch) >= EXPORT_BATCH_SIZE:
+                    break
+        return batch
+    
+    async def stream():
+        if format == "csv":
+            yield "\ufeff" + ";".join(CSV_COLUMNS + ["Utente"]) + "\r\n"
+        while True:
+            # Un blocco alla volta: il successivo si legge solo dopo che il client ha ricevuto questo
+            batch = await next_batch()
+            if not batch:
+                break
+            yield encode(batch)
+    
+    name = "_".join(["workdays", *(part for part in (year, month and month.zfill(2)) if part)])
+    media_type = "application/x-ndjson" if format == "ndjson" else "text/csv; charset=utf-8"
+    return StreamingResponse(stream(), media_type=media_type,
+                             headers={"Content-Disposition": f'attachment; filename="{name}.{format}"'})
+
 @app.post("/api/workdays/import-csv")
 async def import_csv(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
-    """Import workdays from CSV file (optimized batch)"""
+    """Import workdays from CSV file (streamed, one batch write per chunk)"""
     if not file.filename.endswith('.csv'):
         raise HTTPException(status_code=400, detail="File deve essere CSV")
     
-    content = await file.read()
-    # Remove BOM if present
-    text = content.decode('utf-8-sig')
-    
-    # Detect delimiter
-    delimiter = ';' if ';' in text.split('\n')[0] else ','
-    
-    # Parse CSV
-    reader = csv.DictReader(io.StringIO(text), delimiter=delimiter)
-    
-    rows_read = 0
-    workdays_to_create = []
-    errors = []
-    
     # Get existing workdays once
-    existing_workdays = db.get_all_workdays(user["id"])
+    existing_workdays = await run_db_bulk("workdays", db.get_all_workdays, user["id"])
     existing_dates = {wd.get('date') for wd in existing_workdays}
+    resolver = await load_city_resolver()
     
-    for row in reader:
-        rows_read += 1
-        try:
-            # Clean and validate row
-            date_str = row.get('Giorno', '').strip()
-            city = row.get('Città', '').strip()
-            
-            if not date_str:
-                continue
-            
-            # Parse date (format: DD/MM/YYYY)
-            day, month, year = date_str.split('/')
-            date_iso = f"{year}-{month.zfill(2)}-{day.zfill(2)}"
-            
-            # Skip if already exists
-            if date_iso in existing_dates:
-                continue
-            
-            # Skip special status days without times
-            status = row.get('Stato Giornata', '').strip()
-            
-            # Check for special statuses in city field
-            if city and any(keyword in city for keyword in ['Riposo', 'Festivo', 'Compleanno', 'Riunione', 'Ferie', 'Malattia']):
-                status = city
-                city = ''
-            
-            workday_data = {
-                "id": str(uuid.uuid4()),
-                "user_id": user["id"],
-                "date": date_iso,
-                "city": city,
-                "is_custom_city": False,
-                "custom_city_name": "",
-                "custom_distance_km": "",
-                "custom_travel_minutes": "",
-                "travel_minutes_outbound": int(row.get('Minuti andata', 0) or 0),
-                "travel_minutes_return": int(row.get('Minuti ritorno', 0) or 0),
-                "work_minutes": int(row.get('Minuti lavoro in VIS', 0) or 0),
-                "arrival_time": row.get('Arrivo VIS', '').strip(),
-                "departure_home": row.get('Partenza da casa', '').strip(),
-                "exit_time": row.get('Uscita VIS', '').strip(),
-                "return_home": row.get('Rientro a casa', '').strip(),
-                "actual_arrival_at_store": "",
-                "actual_exit_from_store": "",
-                "actual_return_home": "",
-                "status": status,
-                "created_at": datetime.now(timezone.utc).isoformat()
-            }
-            
-            workdays_to_create.append(workday_data)
-            
-        except Exception as e:
-            errors.append(f"Riga {rows_read}: {str(e)}")
-    
-    # Batch insert (single API call)
-    rows_saved = 0
-    if workdays_to_create:
-        try:
-            db.create_workdays_batch(workdays_to_create)
-            rows_saved = len(workdays_to_create)
-        except Exception as e:
-            errors.append(f"Errore batch insert: {str(e)}")
+    async def save(workdays):
+        await run_db_bulk("workdays", db.create_workdays_batch, workdays)
+    
+    result = await import_csv_stream(file.file, user["id"], existing_dates, save, CSV_IMPORT_CHUNK_SIZE,
+                                     resolver=resolver)
     
     return {
         "message": "Import completato",
-        "rows_read": rows_read,
-        "rows_saved": rows_saved,
-        "errors": errors[:10]  # Limit to first 10 errors
+        "rows_read": result["rows_read"],
+        "rows_saved": result["rows_saved"],
+        "errors": result["errors"],  # First 10 errors only
+        "chunks": result["chunks"]
     }
 
+@app.post("/api/workdays/import-jobs")
+async def create_import_job(file: UploadFile = File(...), user: dict = Depends(get_current_user)):
+    """Queue a CSV import in background, returns the job to poll"""
+    if not file.filename.endswith('.csv'):
+        raise HTTPException(status_code=400, detail="File deve essere CSV")
+    
+    return await import_jobs.submit(user["id"], file.filename, file.file)
+
+@app.get("/api/workdays/import-jobs")
+async def get_import_jobs(user: dict = Depends(get_current_user)):
+    """Import jobs of the current user, newest first"""
+    return import_jobs.list_jobs(user["id"])
+
+@app.get("/api/workdays/import-jobs/{job_id}")
+async def get_import_job(job_id: str, user: dict = Depends(get_current_user)):
+    """Progress of an import job: rows read/saved, errors, throughput"""
+    job = import_jobs.get(job_id)
+    if job is None or (job["user_id"] != user["id"] and user["role"] not in ["super_admin", "admin", "hr"]):
+        raise HTTPException(status_code=404, detail="Import non trovato")
+    return job
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8001)
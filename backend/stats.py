@@ -0,0 +1,159 @@
+"""
+Monthly statistics on workdays (pandas)
+
+Le colonne dei workdays vengono caricate una sola volta in un DataFrame e i
+totali per (utente, anno, mese) sono calcolati con group-by vettoriali:
+giorni lavorativi, giorni di riposo per stato, minuti di viaggio e in
+negozio, km e carburante.
+
+I km sono noti solo per le città personalizzate (custom_distance_km, andata
+e ritorno): il foglio cities non ha la distanza. Consumo, prezzo benzina e
+rimborso forfettario hanno i default di server_old.get_settings().
+
+Un gruppo è un dict piatto: le SUM_COLUMNS più una colonna rest_<stato> per
+ogni stato di riposo. Gli stessi gruppi sono mantenuti incrementalmente in
+monthly_aggregates.py (contributions() dà il delta di un insieme di righe).
+"""
+
+import os
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+
+FUEL_PRICE_PER_LITER = float(os.environ.get("FUEL_PRICE_PER_LITER", "1.75"))
+CAR_CONSUMPTION_PER_100KM = float(os.environ.get("CAR_CONSUMPTION_PER_100KM", "4.5"))
+MONTHLY_ALLOWANCE = float(os.environ.get("MONTHLY_ALLOWANCE", "250.0"))
+
+GROUP_KEYS = ["user_id", "year", "month"]
+
+# Colonne sommate per gruppo (i nomi sono quelli di MonthlyStats in server_old)
+SUM_COLUMNS = [
+    "work_days",
+    "rest_days",
+    "total_travel_time_minutes",
+    "total_time_at_store_minutes",
+    "total_km",
+]
+
+# "YYYY-MM-DD" oppure "DD/MM/YYYY"
+_ISO_DATE = r"^(?P<year>\d{4})-(?P<month>\d{1,2})-\d{1,2}$"
+_IT_DATE = r"^\d{1,2}/(?P<month>\d{1,2})/(?P<year>\d{4})$"
+
+
+def _numbers(column: pd.Series) -> np.ndarray:
+    """Sheet cells ("", "60", 60) as floats, blanks and garbage as 0"""
+    return pd.to_numeric(column, errors="coerce").fillna(0).to_numpy(dtype=float)
+
+
+def workdays_frame(workdays: Iterable[Dict[str, Any]]) -> pd.DataFrame:
+    """One row per workday with the columns the statistics need"""
+    raw = pd.DataFrame.from_records(list(workdays), columns=[
+        "user_id", "date", "city", "is_custom_city", "custom_distance_km", "custom_travel_minutes",
+        "travel_minutes_outbound", "travel_minutes_return", "work_minutes", "status",
+    ])
+
+    dates = raw["date"].fillna("").astype(str).str.strip()
+    period = dates.str.extract(_ISO_DATE)
+    italian = dates.str.extract(_IT_DATE)
+    year = period["year"].fillna(italian["year"])
+    month = period["month"].fillna(italian["month"]).str.lstrip("0")
+
+    city = raw["city"].fillna("").astype(str).str.strip()
+    status = raw["status"].fillna("").astype(str).str.strip()
+    custom = raw["is_custom_city"].astype(str).str.lower().to_numpy() == "true"
+    work = (city != "").to_numpy() | custom
+    rest = ~work & (status != "").to_numpy()
+
+    travel = _numbers(raw["travel_minutes_outbound"]) + _numbers(raw["travel_minutes_return"])
+    # Città personalizzata senza minuti calcolati: andata e ritorno da custom_travel_minutes
+    travel = np.where((travel == 0) & custom, 2 * _numbers(raw["custom_travel_minutes"]), travel)
+
+    frame = pd.DataFrame({
+        "user_id": raw["user_id"].fillna("").astype(str),
+        "year": year,
+        "month": month,
+        "status": np.where(rest, status, ""),
+        "work_days": work.astype(int),
+        "rest_days": rest.astype(int),
+        "total_travel_time_minutes": np.where(work, travel, 0.0),
+        "total_time_at_store_minutes": np.where(work, _numbers(raw["work_minutes"]), 0.0),
+        "total_km": np.where(work & custom, 2 * _numbers(raw["custom_distance_km"]), 0.0),
+    })
+    return frame[frame["year"].notna()]
+
+
+def aggregate(frame: pd.DataFrame, keys: Sequence[str] = GROUP_KEYS) -> pd.DataFrame:
+    """Sum the statistics per group, with one rest_<status> column per rest-day status"""
+    keys = list(keys)
+    if frame.empty:
+        return pd.DataFrame(columns=keys + SUM_COLUMNS)
+
+    totals = frame.groupby(keys, sort=True)[SUM_COLUMNS].sum()
+    rest = frame[frame["rest_days"] > 0]
+    if not rest.empty:
+        by_status = rest.groupby(keys + ["status"]).size().unstack("status", fill_value=0)
+        by_status.columns = [f"rest_{status}" for status in by_status.columns]
+        totals = totals.join(by_status)
+    return totals.fillna(0).reset_index()
+
+
+def contributions(workdays: Iterable[Dict[str, Any]]) -> Dict[Tuple[str, str, str], Dict[str, float]]:
+    """(user_id, year, month) -> group totals of these workdays"""
+    result = {}
+    for row in aggregate(workdays_frame(workdays)).to_dict("records"):
+        key = (row.pop("user_id"), row.pop("year"), row.pop("month"))
+        result[key] = {name: float(value) for name, value in row.items()}
+    return result
+
+
+def _stats_record(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Totals of one group in the MonthlyStats shape (fuel from km)"""
+    km = float(row.get("total_km", 0))
+    liters = km / 100 * CAR_CONSUMPTION_PER_100KM
+    return {
+        "work_days": int(row.get("work_days", 0)),
+        "rest_days": int(row.get("rest_days", 0)),
+        "rest_days_by_status": {
+            name[len("rest_"):]: int(count) for name, count in row.items()
+            if name.startswith("rest_") and name != "rest_days" and count
+        },
+        "total_time_at_store_minutes": int(row.get("total_time_at_store_minutes", 0)),
+        "total_travel_time_minutes": int(row.get("total_travel_time_minutes", 0)),
+        "total_km": round(km, 1),
+        "total_fuel_liters": round(liters, 2),
+        "total_fuel_cost": round(liters * FUEL_PRICE_PER_LITER, 2),
+        "km_allowance": MONTHLY_ALLOWANCE,
+    }
+
+
+def summarize(groups: Iterable[Dict[str, Any]], year: str, month: Optional[str] = None) -> Dict[str, Any]:
+    """Response of /api/stats/monthly from (user_id, year, month) groups: totals plus breakdown"""
+    total: Dict[str, float] = {}
+    breakdown: List[Dict[str, Any]] = []
+    for group in groups:
+        for name, value in group.items():
+            if name not in GROUP_KEYS:
+                total[name] = total.get(name, 0) + value
+        breakdown.append({
+            "user_id": group["user_id"],
+            "year": group["year"],
+            "month": group["month"],
+            **_stats_record(group),
+        })
+    breakdown.sort(key=lambda r: (r["user_id"], int(r["year"]), int(r["month"])))
+
+    label = f"{str(month).zfill(2)}/{year}" if month else str(year)
+    return {"month": label, **_stats_record(total), "breakdown": breakdown}
+
+
+def monthly_stats(workdays: Iterable[Dict[str, Any]], year: str, month: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Totals for the period (a month, or the whole year) plus the per (user, month)
+    breakdown; `workdays` should already be filtered by user.
+    """
+    frame = workdays_frame(workdays)
+    frame = frame[frame["year"] == str(year)]
+    if month:
+        frame = frame[frame["month"] == str(month).lstrip("0")]
+    return summarize(aggregate(frame).to_dict("records"), year, month)
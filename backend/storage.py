@@ -0,0 +1,108 @@
+"""
+Storage backends
+
+Ogni backend è un modulo che espone le stesse funzioni (get_all_*, create_*,
+update_*, delete_* ...). Quello attivo si sceglie con STORAGE_BACKEND:
+
+  sheets        db_sheets        Google Sheets via gspread (default)
+  sheets_async  db_sheets_async  Google Sheets via REST asincrona
+  sqlite        db_sqlite        file SQLite locale (WAL)
+
+Per compatibilità SHEETS_CLIENT=async equivale a STORAGE_BACKEND=sheets_async.
+
+Funzionalità per backend (OPTIONAL_FUNCTIONS, BACKEND_SETTINGS):
+
+                                         sheets  sheets_async  sqlite
+  ETag, chiave cache PDF (versioni)        sì        sì          no
+  resolver città in cache                  sì        sì          sì
+  pagine di workdays nello storage         sì        sì          no
+  export in streaming a blocchi            sì        sì          no
+  quota token bucket, priorità, retry      sì        sì          -
+  SHEETS_WORKDAYS_PARTITIONED              sì        no          no
+  SHEETS_SOFT_DELETE                       sì        no          no
+  SHEETS_WRITE_BEHIND                      sì        no          no
+  SHEETS_MONTHLY_AGGREGATES                sì        no          no
+
+Senza una funzione opzionale il server usa un percorso più lento (avviso nel
+log all'avvio); un'impostazione attiva non supportata blocca l'avvio.
+"""
+
+import os
+import importlib
+import logging
+from types import ModuleType
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+BACKENDS = {
+    "sheets": "db_sheets",
+    "sheets_async": "db_sheets_async",
+    "sqlite": "db_sqlite",
+}
+
+# Funzioni che ogni backend deve esporre (sincrone oppure coroutine)
+STORAGE_FUNCTIONS = (
+    # users
+    "get_all_users", "get_user_by_id", "get_user_by_email", "get_user_by_username",
+    "create_user", "update_user", "delete_user",
+    # auth
+    "refresh_revocations", "check_token_claims",
+    # cities
+    "get_all_cities", "get_city_by_id", "create_city", "update_city", "delete_city",
+    # workdays
+    "get_all_workdays", "get_workday_by_date", "create_workday", "create_workdays_batch",
+    "update_workday", "delete_workday",
+    # roles
+    "get_all_roles", "create_role",
+    # setup / metrics
+    "initialize_sheets", "cache_stats",
+)
+
+# Funzioni opzionali -> cosa fa il server senza
+OPTIONAL_FUNCTIONS = {
+    "table_version": "no ETag/304 on list endpoints",
+    "workdays_version": "PDF cache disabled",
+    "city_resolver": "city resolver rebuilt on every request",
+    "get_workdays_page": "GET /api/workdays pages filtered in the server",
+    "iter_workdays": "export reads every workday before streaming",
+}
+
+# Impostazioni di db_sheets -> backend che le supportano
+BACKEND_SETTINGS = {
+    "SHEETS_WORKDAYS_PARTITIONED": ("sheets",),
+    "SHEETS_SOFT_DELETE": ("sheets",),
+    "SHEETS_WRITE_BEHIND": ("sheets",),
+    "SHEETS_MONTHLY_AGGREGATES": ("sheets",),
+}
+
+
+def backend_name() -> str:
+    """Name of the configured backend"""
+    name = os.getenv("STORAGE_BACKEND")
+    if not name:
+        name = "sheets_async" if os.getenv("SHEETS_CLIENT", "gspread") == "async" else "sheets"
+    return name
+
+
+def load_backend(name: Optional[str] = None) -> ModuleType:
+    """Import the backend module and check it implements the storage interface"""
+    name = name or backend_name()
+    if name not in BACKENDS:
+        raise RuntimeError(f"Unknown STORAGE_BACKEND '{name}' (use one of: {', '.join(BACKENDS)})")
+    unsupported = [
+        setting for setting, backends in BACKEND_SETTINGS.items()
+        if name not in backends and os.environ.get(setting, "false").lower() == "true"
+    ]
+    if unsupported:
+        raise RuntimeError(f"Storage backend '{name}' does not support {', '.join(unsupported)} "
+                           f"(only: {', '.join(sorted({b for s in unsupported for b in BACKEND_SETTINGS[s]}))})")
+
+    module = importlib.import_module(BACKENDS[name])
+    missing = [fn for fn in STORAGE_FUNCTIONS if not callable(getattr(module, fn, None))]
+    if missing:
+        raise RuntimeError(f"Storage backend '{name}' is missing: {', '.join(missing)}")
+    for fn, effect in OPTIONAL_FUNCTIONS.items():
+        if not callable(getattr(module, fn, None)):
+            logger.warning("Storage backend '%s' has no %s: %s", name, fn, effect)
+    return module
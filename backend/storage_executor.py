@@ -0,0 +1,98 @@
+"""
+Storage execution layer
+
+Le funzioni di db_sheets sono bloccanti (gspread): qui vengono eseguite su un
+thread pool dedicato e dimensionabile, così l'event loop di uvicorn resta libero.
+Ogni worksheet ha un limite di concorrenza proprio e la coda ha una profondità
+massima: oltre quel limite le richieste falliscono subito (503) invece di accumularsi.
+
+Le funzioni già asincrone (db_sheets_async) vengono attese direttamente
+sull'event loop, con gli stessi limiti di concorrenza e la stessa misura dei tempi.
+"""
+
+import asyncio
+import contextvars
+import functools
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+logger = logging.getLogger(__name__)
+
+
+class StorageBusyError(Exception):
+    """Raised when the storage queue is full"""
+
+
+class StorageExecutor:
+    """Run blocking storage calls on a bounded thread pool with backpressure"""
+
+    def __init__(self, max_workers: int, max_queue: int, per_table_limit: int):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.per_table_limit = per_table_limit
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="storage")
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._pending = 0
+        self.jobs = 0
+        self.rejected = 0
+        self.total_wait_ms = 0.0
+        self.total_run_ms = 0.0
+        self.max_run_ms = 0.0
+
+    def _semaphore(self, table: str) -> asyncio.Semaphore:
+        sem = self._semaphores.get(table)
+        if sem is None:
+            sem = asyncio.Semaphore(self.per_table_limit)
+            self._semaphores[table] = sem
+        return sem
+
+    async def run(self, table: str, fn: Callable[..., Any], *args, **kwargs) -> Any:
+        """Run fn(*args, **kwargs) on the pool (or await it if async), at most per_table_limit at a time per table"""
+        if self._pending >= self.max_queue:
+            self.rejected += 1
+            logger.warning("Storage queue full (%d jobs), rejecting %s", self._pending, fn.__name__)
+            raise StorageBusyError(f"Storage busy ({self._pending} pending jobs)")
+
+        self._pending += 1
+        queued_at = time.perf_counter()
+        try:
+            async with self._semaphore(table):
+                started_at = time.perf_counter()
+                if asyncio.iscoroutinefunction(fn):
+                    result = await fn(*args, **kwargs)
+                else:
+                    # Il contesto (es. la priorità quota) segue la chiamata nel thread
+                    loop = asyncio.get_running_loop()
+                    context = contextvars.copy_context()
+                    result = await loop.run_in_executor(self._pool, functools.partial(context.run, fn, *args, **kwargs))
+        finally:
+            self._pending -= 1
+
+        finished_at = time.perf_counter()
+        wait_ms = (started_at - queued_at) * 1000
+        run_ms = (finished_at - started_at) * 1000
+        self.jobs += 1
+        self.total_wait_ms += wait_ms
+        self.total_run_ms += run_ms
+        self.max_run_ms = max(self.max_run_ms, run_ms)
+        logger.info("%s [%s]: waited %.1f ms, ran %.1f ms", fn.__name__, table, wait_ms, run_ms)
+        return result
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and timing counters"""
+        return {
+            "max_workers": self.max_workers,
+            "max_queue": self.max_queue,
+            "per_table_limit": self.per_table_limit,
+            "pending": self._pending,
+            "jobs": self.jobs,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self.total_wait_ms / self.jobs, 1) if self.jobs else 0.0,
+            "avg_run_ms": round(self.total_run_ms / self.jobs, 1) if self.jobs else 0.0,
+            "max_run_ms": round(self.max_run_ms, 1),
+        }
+
+    def shutdown(self):
+        self._pool.shutdown(wait=True)
@@ -0,0 +1,299 @@
+"""
+In-memory cache for small Google Sheets tables (users, cities, roles)
+
+Le tabelle sono tenute in memoria nell'ordine del foglio, aggiornate in place
+dalle funzioni di scrittura di db_sheets (write-through) e ricaricate dopo il TTL.
+La memoria totale è limitata da un budget in byte con eviction LRU.
+
+Per ogni tabella si possono dichiarare indici hash (campo -> posizione) così le
+ricerche per chiave sono O(1) e restituiscono anche il numero di riga del foglio
+(posizione + 2, la riga 1 è l'header).
+
+Le righe cancellate in modo soft restano nella tabella come record vuoti ({}),
+così le posizioni continuano a corrispondere alle righe del foglio; get() li salta.
+
+Il caricamento (una chiamata remota) avviene fuori dal lock globale: un lock per
+tabella fa sì che parta un solo caricamento alla volta per tabella, mentre le
+letture delle altre tabelle continuano. I record restituiti sono copie shallow
+(i valori sono scalari letti dal foglio).
+"""
+
+import json
+import threading
+import time
+import logging
+from collections import Counter, OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Normalizzatore di chiave per un indice (None = valore così com'è)
+KeyFunc = Optional[Callable[[Any], Any]]
+
+# Prima riga dati del foglio (la riga 1 contiene gli header)
+FIRST_DATA_ROW = 2
+
+
+def _sizeof(value: Any) -> int:
+    """Approximate memory footprint of a record (serialized JSON length)"""
+    return len(json.dumps(value, default=str))
+
+
+def _index_key(key_func: KeyFunc, value: Any) -> Any:
+    if value is None or value == "":
+        return None
+    return key_func(value) if key_func else value
+
+
+class TableCache:
+    """Thread-safe TTL + LRU cache of whole tables, with a global byte budget"""
+
+    def __init__(self, ttl_seconds: float, max_bytes: int,
+                 indexes: Optional[Dict[str, Dict[str, KeyFunc]]] = None):
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.indexes = indexes or {}
+        self._tables: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        # Scritture/invalidazioni per tabella: un caricamento concorrente non va messo in cache
+        self._writes: Counter = Counter()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ---------- read ----------
+
+    def get(self, name: str, loader: Callable[[], List[Dict[str, Any]]]) -> List[Dict[str, Any]]:
+        """Return a copy of the table (without tombstone placeholders), loading it on miss or expiry"""
+        entry = self._entry(name, loader)
+        with self._lock:
+            return [dict(r) for r in entry["records"] if r]
+
+    def lookup(self, name: str, field: str, value: Any,
+               loader: Callable[[], List[Dict[str, Any]]]) -> Optional[Tuple[int, Dict[str, Any]]]:
+        """Find a record by key, returning (sheet row, record copy)"""
+        entry = self._entry(name, loader)
+        with self._lock:
+            pos = self._position(name, entry, field, value)
+            if pos is None:
+                return None
+            return pos + FIRST_DATA_ROW, dict(entry["records"][pos])
+
+    def contains(self, name: str, margin: float = 1.0) -> bool:
+        """True if the table is cached and stays fresh for at least `margin` seconds"""
+        with self._lock:
+            entry = self._tables.get(name)
+            return entry is not None and time.monotonic() - entry["loaded_at"] < self.ttl_seconds - margin
+
+    def put(self, name: str, records: List[Dict[str, Any]]):
+        """Store a table loaded by the caller (used by the asyncio client, counts as a miss)"""
+        with self._lock:
+            self.misses += 1
+            self._store(name, [dict(r) for r in records])
+
+    def _cached(self, name: str) -> Optional[Dict[str, Any]]:
+        """The fresh entry of a table (counted as a hit), None if missing or expired"""
+        entry = self._tables.get(name)
+        if entry is not None and time.monotonic() - entry["loaded_at"] > self.ttl_seconds:
+            self._drop(name)
+            entry = None
+        if entry is not None:
+            self.hits += 1
+            self._tables.move_to_end(name)
+        return entry
+
+    def _entry(self, name: str, loader: Callable[[], List[Dict[str, Any]]]) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._cached(name)
+            if entry is not None:
+                return entry
+            load_lock = self._load_locks.setdefault(name, threading.Lock())
+
+        # Un solo caricamento per tabella; il lock globale resta libero durante la chiamata remota
+        with load_lock:
+            with self._lock:
+                entry = self._cached(name)
+                if entry is not None:
+                    return entry
+                self.misses += 1
+                writes = self._writes[name]
+
+            records = loader()
+
+            with self._lock:
+                if self._writes[name] != writes:
+                    # Scrittura arrivata durante il caricamento: i dati letti possono non contenerla
+                    logger.info("Table %s changed while loading, not cached", name)
+                    return self._new_entry(name, records)
+                return self._store(name, records)
+
+    def _new_entry(self, name: str, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        entry = {
+            "records": records,
+            "loaded_at": time.monotonic(),
+            "size": sum(_sizeof(r) for r in records),
+        }
+        self._reindex(name, entry)
+        return entry
+
+    def _store(self, name: str, records: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Cache a freshly loaded table; the entry is returned even if it is over budget"""
+        self._drop(name)
+        entry = self._new_entry(name, records)
+        if entry["size"] > self.max_bytes:
+            logger.warning("Table %s (%d bytes) exceeds cache budget, not cached", name, entry["size"])
+            return entry
+        self._tables[name] = entry
+        self._bytes += entry["size"]
+        self._evict()
+        return entry
+
+    def _drop(self, name: str):
+        entry = self._tables.pop(name, None)
+        if entry is not None:
+            self._bytes -= entry["size"]
+
+    def _evict(self):
+        # Rimuove le tabelle usate meno di recente finché si rientra nel budget
+        while self._bytes > self.max_bytes and len(self._tables) > 1:
+            name, entry = self._tables.popitem(last=False)
+            self._bytes -= entry["size"]
+            self.evictions += 1
+            logger.info("Evicted table %s from cache (%d bytes)", name, entry["size"])
+
+    # ---------- indexes ----------
+
+    def _reindex(self, name: str, entry: Dict[str, Any]):
+        """Rebuild every hash index of a table (first occurrence wins, like a linear scan)"""
+        entry["index"] = {}
+        for field, key_func in self.indexes.get(name, {}).items():
+            index: Dict[Any, int] = {}
+            for pos, record in enumerate(entry["records"]):
+                key = _index_key(key_func, record.get(field))
+                if key is not None:
+                    index.setdefault(key, pos)
+            entry["index"][field] = index
+
+    def _position(self, name: str, entry: Dict[str, Any], field: str, value: Any) -> Optional[int]:
+        index = entry["index"].get(field)
+        if index is None:
+            return self._scan(name, entry["records"], field, value)
+        key = _index_key(self.indexes[name][field], value)
+        return index.get(key) if key is not None else None
+
+    def _scan(self, name: str, records: List[Dict[str, Any]], field: str, value: Any) -> Optional[int]:
+        key_func = self.indexes.get(name, {}).get(field)
+        key = _index_key(key_func, value)
+        for pos, record in enumerate(records):
+            if key is not None and _index_key(key_func, record.get(field)) == key:
+                return pos
+        return None
+
+    # ---------- write-through ----------
+
+    def append(self, name: str, record: Dict[str, Any]):
+        """Append a record to a cached table (no-op if the table is not cached)"""
+        with self._lock:
+            self._writes[name] += 1
+            entry = self._tables.get(name)
+            if entry is None:
+                return
+            record = dict(record)
+            pos = len(entry["records"])
+            entry["records"].append(record)
+            for field, index in entry["index"].items():
+                key = _index_key(self.indexes[name][field], record.get(field))
+                if key is not None:
+                    index.setdefault(key, pos)
+            self._resize(entry, _sizeof(record))
+
+    def update(self, name: str, field: str, value: Any, changes: Dict[str, Any]) -> bool:
+        """Apply `changes` to the cached record where record[field] == value"""
+        with self._lock:
+            self._writes[name] += 1
+            entry = self._tables.get(name)
+            if entry is None:
+                return False
+            pos = self._position(name, entry, field, value)
+            if pos is None:
+                return False
+            # Nuovo dict: le copie shallow già restituite non cambiano
+            record = entry["records"][pos] = dict(entry["records"][pos])
+            before = _sizeof(record)
+            for key, new_value in changes.items():
+                if key in record:
+                    record[key] = new_value
+            if any(key in entry["index"] for key in changes):
+                self._reindex(name, entry)
+            self._resize(entry, _sizeof(record) - before)
+            return True
+
+    def remove(self, name: str, field: str, value: Any) -> bool:
+        """Remove the cached record where record[field] == value (later rows shift up)"""
+        with self._lock:
+            self._writes[name] += 1
+            entry = self._tables.get(name)
+            if entry is None:
+                return False
+            pos = self._position(name, entry, field, value)
+            if pos is None:
+                return False
+            record = entry["records"].pop(pos)
+            self._reindex(name, entry)
+            self._resize(entry, -_sizeof(record))
+            return True
+
+    def tombstone(self, name: str, field: str, value: Any) -> bool:
+        """Replace the cached record with an empty placeholder, so later rows keep their sheet row"""
+        with self._lock:
+            self._writes[name] += 1
+            entry = self._tables.get(name)
+            if entry is None:
+                return False
+            pos = self._position(name, entry, field, value)
+            if pos is None:
+                return False
+            record = entry["records"][pos]
+            entry["records"][pos] = {}
+            self._reindex(name, entry)
+            self._resize(entry, _sizeof({}) - _sizeof(record))
+            return True
+
+    def _resize(self, entry: Dict[str, Any], delta: int):
+        entry["size"] += delta
+        self._bytes += delta
+        self._evict()
+
+    def invalidate(self, name: Optional[str] = None):
+        """Forget one table (or all of them), forcing a reload on next read"""
+        with self._lock:
+            if name is None:
+                for table in set(self._tables) | set(self._load_locks):
+                    self._writes[table] += 1
+                self._tables.clear()
+                self._bytes = 0
+            else:
+                self._writes[name] += 1
+                self._drop(name)
+
+    # ---------- metrics ----------
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit/miss counters and memory usage"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 3) if lookups else 0.0,
+                "evictions": self.evictions,
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl_seconds,
+                "tables": {
+                    name: {"rows": len(entry["records"]), "bytes": entry["size"]}
+                    for name, entry in self._tables.items()
+                },
+            }
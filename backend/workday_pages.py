@@ -0,0 +1,83 @@
+"""
+Keyset pagination of workdays
+
+Le pagine di GET /api/workdays sono ordinate per (date, user_id), che è
+unico per ogni workday. Il cursore è la chiave dell'ultima riga restituita,
+codificata in base64: la pagina successiva prende le righe con chiave
+maggiore, quindi non serve un offset e una riga aggiunta nel frattempo non
+sposta le pagine già lette.
+
+Di ogni insieme di righe si tengono solo le `limit + 1` più piccole (heap),
+così la memoria dipende dalla pagina e non da quante righe ci sono; la riga
+in più dice se esiste una pagina successiva.
+"""
+
+import base64
+import heapq
+import json
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+Key = Tuple[str, str]
+
+
+def iso_date(date: Any) -> str:
+    """YYYY-MM-DD from either sheet date format (DD/MM/YYYY is converted)"""
+    date = str(date or "").strip()
+    if "/" in date:
+        parts = date.split("/")
+        if len(parts) == 3:
+            return f"{parts[2]}-{parts[1].zfill(2)}-{parts[0].zfill(2)}"
+    return date
+
+
+def page_key(record: Dict[str, Any]) -> Key:
+    return iso_date(record.get("date")), str(record.get("user_id", ""))
+
+
+def encode_cursor(key: Key) -> str:
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Key:
+    """Key of a cursor from encode_cursor(), ValueError if malformed"""
+    try:
+        date, user_id = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except Exception:
+        raise ValueError("invalid cursor")
+    return str(date), str(user_id)
+
+
+def matches(record: Dict[str, Any], user_id: Optional[str] = None, date_from: Optional[str] = None,
+            date_to: Optional[str] = None, after: Optional[Key] = None) -> bool:
+    """Filters of a page query (dates are inclusive, `after` is the cursor key)"""
+    if user_id and record.get("user_id") != user_id:
+        return False
+    key = page_key(record)
+    if date_from and key[0] < date_from:
+        return False
+    if date_to and key[0] > date_to:
+        return False
+    return after is None or key > after
+
+
+def select_page(records: Iterable[Dict[str, Any]], limit: int) -> List[Dict[str, Any]]:
+    """The `limit + 1` smallest records by (date, user_id), sorted"""
+    return heapq.nsmallest(limit + 1, records, key=page_key)
+
+
+def project(record: Dict[str, Any], fields: Optional[Sequence[str]]) -> Dict[str, Any]:
+    return {field: record.get(field) for field in fields} if fields else record
+
+
+def finish_page(candidates: List[Dict[str, Any]], limit: int,
+                fields: Optional[Sequence[str]] = None) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """(page items projected on `fields`, cursor of the next page or None) from select_page() output"""
+    items = candidates[:limit]
+    next_cursor = encode_cursor(page_key(items[-1])) if len(candidates) > limit and items else None
+    return [project(record, fields) for record in items], next_cursor
+
+
+def paginate(records: Iterable[Dict[str, Any]], limit: int, fields: Optional[Sequence[str]] = None,
+             **filters) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """One page over any iterable of workdays (storage backends without get_workdays_page)"""
+    return finish_page(select_page((r for r in records if matches(r, **filters)), limit), limit, fields)
@@ -0,0 +1,299 @@
+"""
+Write-behind queue for Google Sheets mutations
+
+Le create/update non vengono scritte subito sul foglio: finiscono in una coda
+in memoria, registrata in un journal locale (una riga JSON per operazione,
+fsync a ogni scrittura), e vengono inviate in blocco da un thread in
+background ogni `flush_interval` secondi o appena si superano `max_ops`
+operazioni in attesa.
+
+Le operazioni sulla stessa riga (stessa chiave) vengono unite: più update
+diventano un solo update, un update su una riga ancora da creare modifica
+direttamente la create. Le letture vedono lo stato in attesa tramite overlay().
+
+All'avvio replay() ricarica il journal, così un arresto della macchina non
+perde nulla; dopo ogni flush riuscito il journal viene riscritto con le sole
+operazioni ancora in attesa.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# table -> key -> record (create) o modifiche (update), in ordine di arrivo
+Pending = Dict[str, "OrderedDict[Hashable, Dict[str, Any]]"]
+
+
+def _key_to_json(key: Hashable) -> Any:
+    return list(key) if isinstance(key, tuple) else key
+
+
+def _key_from_json(key: Any) -> Hashable:
+    return tuple(key) if isinstance(key, list) else key
+
+
+class WriteBehindQueue:
+    """Coalescing, journaled queue of pending creates and updates"""
+
+    def __init__(self, journal_path: str, flush_interval: float, max_ops: int):
+        self.journal_path = journal_path
+        self.flush_interval = flush_interval
+        self.max_ops = max_ops
+        self._creates: Pending = {}
+        self._updates: Pending = {}
+        # Operazioni prese da take() e non ancora confermate da done()
+        self._inflight_creates: Pending = {}
+        self._inflight_updates: Pending = {}
+        self._ops = 0
+        self._lock = threading.RLock()
+        self._wakeup = threading.Condition(self._lock)
+        self._journal = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = False
+        self.enqueued = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.flushed_ops = 0
+        self.failures = 0
+        self.last_flush_ms = 0.0
+
+    # ---------- journal ----------
+
+    def _open_journal(self):
+        if self._journal is None:
+            self._journal = open(self.journal_path, "a", encoding="utf-8")
+        return self._journal
+
+    def _log(self, op: str, table: str, key: Hashable, data: Dict[str, Any]):
+        journal = self._open_journal()
+        journal.write(json.dumps({"op": op, "table": table, "key": _key_to_json(key), "data": data}, default=str) + "\n")
+        journal.flush()
+        os.fsync(journal.fileno())
+
+    def _rewrite_journal(self):
+        """Replace the journal with the operations still pending (in-flight ones included)"""
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for op, pending in (("create", self._inflight_creates), ("create", self._creates),
+                                ("update", self._inflight_updates), ("update", self._updates)):
+                for table, rows in pending.items():
+                    for key, data in rows.items():
+                        f.write(json.dumps({"op": op, "table": table, "key": _key_to_json(key), "data": data},
+                                           default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        os.replace(tmp_path, self.journal_path)
+
+    def replay(self) -> int:
+        """Load the journal left by a previous process, returns the number of operations"""
+        if not os.path.exists(self.journal_path):
+            return 0
+        count = 0
+        with self._lock, open(self.journal_path, encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # Ultima riga troncata da un arresto durante la scrittura
+                    logger.warning("Skipping corrupt write-behind journal line")
+                    continue
+                key = _key_from_json(entry["key"])
+                if entry["op"] == "create":
+                    self._add_create(entry["table"], key, entry["data"])
+                else:
+                    self._add_update(entry["table"], key, entry["data"])
+                count += 1
+        if count:
+            logger.info("Replayed %d write-behind operations from %s", count, self.journal_path)
+        return count
+
+    # ---------- enqueue ----------
+
+    def _add_create(self, table: str, key: Hashable, record: Dict[str, Any]):
+        self._creates.setdefault(table, OrderedDict())[key] = dict(record)
+        self._ops += 1
+
+    def _add_update(self, table: str, key: Hashable, changes: Dict[str, Any]):
+        pending_create = self._creates.get(table, {}).get(key)
+        if pending_create is not None:
+            pending_create.update(changes)
+            self.coalesced += 1
+            return
+        rows = self._updates.setdefault(table, OrderedDict())
+        if key in rows:
+            rows[key].update(changes)
+            self.coalesced += 1
+        else:
+            rows[key] = dict(changes)
+            self._ops += 1
+
+    def create(self, table: str, key: Hashable, record: Dict[str, Any]):
+        with self._lock:
+            self._log("create", table, key, record)
+            self._add_create(table, key, record)
+            self.enqueued += 1
+            if self._ops >= self.max_ops:
+                self._wakeup.notify()
+
+    def update(self, table: str, key: Hashable, changes: Dict[str, Any]):
+        with self._lock:
+            self._log("update", table, key, changes)
+            self._add_update(table, key, changes)
+            self.enqueued += 1
+            if self._ops >= self.max_ops:
+                self._wakeup.notify()
+
+    # ---------- read overlay ----------
+
+    def pending_create(self, table: str, key: Hashable) -> Optional[Dict[str, Any]]:
+        """Record waiting to be created (with later updates applied), or None"""
+        with self._lock:
+            for creates, updates in ((self._creates, self._updates), (self._inflight_creates, self._updates)):
+                record = creates.get(table, {}).get(key)
+                if record is not None:
+                    record = dict(record)
+                    record.update(updates.get(table, {}).get(key, {}))
+                    return record
+            return None
+
+    def pending_changes(self, table: str, key: Hashable) -> Dict[str, Any]:
+        """Updates waiting for an existing row (in-flight first, then newer ones)"""
+        with self._lock:
+            changes = dict(self._inflight_updates.get(table, {}).get(key, {}))
+            changes.update(self._updates.get(table, {}).get(key, {}))
+            return changes
+
+    def has_pending(self, table: str, key: Hashable) -> bool:
+        with self._lock:
+            return any(key in pending.get(table, {}) for pending in
+                       (self._creates, self._updates, self._inflight_creates, self._inflight_updates))
+
+    def overlay(self, table: str, records: List[Dict[str, Any]], key_func: Callable[[Dict[str, Any]], Hashable],
+                match: Optional[Callable[[Dict[str, Any]], bool]] = None) -> List[Dict[str, Any]]:
+        """
+        Apply pending updates to `records` and append pending creates not already
+        present (a create may land on the sheet before the journal is trimmed).
+        `match` filters the appended creates (e.g. by user or period).
+        """
+        with self._lock:
+            keys = set()
+            for record in records:
+                if not record:
+                    continue
+                key = key_func(record)
+                keys.add(key)
+                changes = self.pending_changes(table, key)
+                for field, value in changes.items():
+                    if field in record:
+                        record[field] = value
+            for creates in (self._inflight_creates, self._creates):
+                for key in creates.get(table, {}):
+                    if key in keys:
+                        continue
+                    record = self.pending_create(table, key)
+                    if match is None or match(record):
+                        records.append(record)
+                        keys.add(key)
+            return records
+
+    # ---------- flush ----------
+
+    def take(self) -> Tuple[Pending, Pending]:
+        """Move every pending operation in flight and return (creates, updates)"""
+        with self._lock:
+            if self._inflight_creates or self._inflight_updates:
+                return {}, {}
+            self._inflight_creates, self._creates = self._creates, {}
+            self._inflight_updates, self._updates = self._updates, {}
+            self._ops = 0
+            return self._inflight_creates, self._inflight_updates
+
+    def done(self, success: bool):
+        """Confirm (or give back) the operations returned by take()"""
+        with self._lock:
+            if success:
+                flushed = sum(len(r) for p in (self._inflight_creates, self._inflight_updates) for r in p.values())
+                self._inflight_creates, self._inflight_updates = {}, {}
+                if flushed:
+                    self.flushed_ops += flushed
+                    self._rewrite_journal()
+                return
+
+            # Rimette le operazioni in testa alla coda, unendo quelle arrivate nel frattempo
+            creates, updates = self._inflight_creates, self._inflight_updates
+            newer_creates, newer_updates = self._creates, self._updates
+            self._inflight_creates, self._inflight_updates = {}, {}
+            self._creates, self._updates, self._ops = {}, {}, 0
+            for pending, add in ((creates, self._add_create), (updates, self._add_update),
+                                 (newer_creates, self._add_create), (newer_updates, self._add_update)):
+                for table, rows in pending.items():
+                    for key, data in rows.items():
+                        add(table, key, data)
+            self.failures += 1
+
+    def pending_ops(self) -> int:
+        with self._lock:
+            return self._ops
+
+    # ---------- background flusher ----------
+
+    def start(self, flush: Callable[[], Any]):
+        """Run `flush` every flush_interval seconds (or when max_ops is reached) in a daemon thread"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, args=(flush,), name="write-behind", daemon=True)
+            self._thread.start()
+
+    def _run(self, flush: Callable[[], Any]):
+        while True:
+            with self._lock:
+                if self._ops < self.max_ops and not self._stopping:
+                    self._wakeup.wait(self.flush_interval)
+                if self._stopping:
+                    return
+                if not self._ops:
+                    continue
+            started = time.perf_counter()
+            try:
+                flush()
+                self.flushes += 1
+            except Exception:
+                logger.exception("Write-behind flush failed, will retry")
+                time.sleep(self.flush_interval)
+            self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def stop(self):
+        """Stop the background thread (the caller flushes what is left)"""
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            thread.join()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "pending_ops": self._ops,
+                "in_flight": bool(self._inflight_creates or self._inflight_updates),
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "flushes": self.flushes,
+                "flushed_ops": self.flushed_ops,
+                "failures": self.failures,
+                "last_flush_ms": round(self.last_flush_ms, 1),
+            }
@@ -255,16 +255,30 @@ function AdminDashboard() {
     formData.append('file', csvFile);
 
     try {
-      const response = await axios.post('/workdays/import-csv', formData, {
+      // L'import gira in background: il server risponde subito con il job da interrogare
+      const response = await axios.post('/workdays/import-jobs', formData, {
         headers: { 'Content-Type': 'multipart/form-data' }
       });
       setImportResult(response.data);
       setCsvFile(null);
+      pollImportJob(response.data.id);
     } catch (error) {
       alert(error.response?.data?.detail || 'Errore import CSV');
     }
   };
 
+  const pollImportJob = async (jobId) => {
+    try {
+      const response = await axios.get(`/workdays/import-jobs/${jobId}`);
+      setImportResult(response.data);
+      if (response.data.status === 'queued' || response.data.status === 'running') {
+        setTimeout(() => pollImportJob(jobId), 1000);
+      }
+    } catch (error) {
+      alert(error.response?.data?.detail || 'Errore stato import CSV');
+    }
+  };
+
   const user = JSON.parse(localStorage.getItem('user') || '{}');
 
   return (
@@ -623,6 +637,14 @@ function AdminDashboard() {
                   <div className="bg-blue-50 border border-blue-200 rounded-lg p-6">
                     <h3 className="font-bold text-lg mb-3">Risultato Import</h3>
                     <div className="space-y-2 text-sm">
+                      {importResult.status && (
+                        <p>
+                          {importResult.status === 'completed' ? '✅ Completato'
+                            : importResult.status === 'failed' ? '❌ Interrotto'
+                            : '⏳ In corso...'}
+                          {importResult.rows_per_second > 0 && ` (${importResult.rows_per_second} righe/s)`}
+                        </p>
+                      )}
                       <p>✅ Righe lette: <strong>{importResult.rows_read}</strong></p>
                       <p>💾 Righe salvate: <strong>{importResult.rows_saved}</strong></p>
                       {importResult.errors.length > 0 && (
@@ -0,0 +1,57 @@
+"""
+Shared fixtures: the backend modules are imported from backend/ and every
+db_sheets test runs against fake_sheets.FakeSpreadsheet (no credentials, no
+network). u3 is the admin; helpers.auth() signs a token for a user.
+"""
+
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend")
+sys.path.insert(0, BACKEND_DIR)
+
+# Il fake non ha quote: i token bucket non devono rallentare i test
+os.environ.setdefault("SHEETS_READ_QUOTA", "100000")
+os.environ.setdefault("SHEETS_WRITE_QUOTA", "100000")
+
+import db_sheets  # noqa: E402
+import fake_sheets  # noqa: E402
+
+from .helpers import USER_ID, make_workday  # noqa: E402
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    """Fake spreadsheet with 10 workdays of USER_ID (2025-01-01 .. 2025-01-10), plain mode"""
+    for flag in ("SOFT_DELETE", "WRITE_BEHIND", "WORKDAYS_PARTITIONED", "MONTHLY_AGGREGATES"):
+        monkeypatch.setattr(db_sheets, flag, False)
+    spreadsheet = fake_sheets.FakeSpreadsheet()
+    config = db_sheets.SHEETS_CONFIG
+    spreadsheet.load("users", config["users"], [
+        db_sheets._user_row({"id": f"u{i}", "username": f"user{i}", "email": f"user{i}@example.com",
+                             "role": "admin" if i == 3 else "user"})
+        for i in range(1, 4)
+    ])
+    spreadsheet.load("cities", config["cities"], [
+        db_sheets._city_row({"id": f"c{i}", "name": name, "travel_minutes": 10 * i})
+        for i, name in enumerate(["Milano", "Como", "Lecco"], start=1)
+    ])
+    spreadsheet.load("workdays", config["workdays"], [
+        db_sheets._workday_row(make_workday(f"2025-01-{day:02d}")) for day in range(1, 11)
+    ])
+    spreadsheet.load("roles", config["roles"], [])
+    db_sheets.use_spreadsheet(spreadsheet)
+    yield spreadsheet
+    db_sheets.reset_client()
+    db_sheets.invalidate_cache()
+
+
+@pytest.fixture
+def client(fake):
+    """TestClient of the API server on the fake spreadsheet (startup hooks not run)"""
+    from fastapi.testclient import TestClient
+    import server
+
+    return TestClient(server.app)
@@ -0,0 +1,24 @@
+"""Record builders and sheet readers shared by the tests"""
+
+import fake_sheets
+
+USER_ID = "u1"
+ADMIN_ID = "u3"
+
+
+def make_workday(date: str, user_id: str = USER_ID, **fields) -> dict:
+    return {"id": f"{user_id}-{date}", "user_id": user_id, "date": date, "city": "Milano", **fields}
+
+
+def sheet_rows(fake: fake_sheets.FakeSpreadsheet, title: str = "workdays") -> list:
+    """Data rows of a fake worksheet as records (header row excluded)"""
+    rows = fake._sheets[title]._rows
+    return [dict(zip(rows[0], values)) for values in rows[1:]]
+
+
+def auth(user_id: str = USER_ID) -> dict:
+    """Authorization header with a token of the API server for this user"""
+    import server
+
+    token = server.create_token(user_id, "admin" if user_id == ADMIN_ID else "user")
+    return {"Authorization": f"Bearer {token}"}
@@ -0,0 +1,72 @@
+"""GET /api/export/pdf/bulk: one export at a time, the slot is held until the ZIP is streamed"""
+
+import asyncio
+import io
+import json
+import zipfile
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from .helpers import ADMIN_ID, auth
+
+
+@pytest.fixture
+def cached(client, monkeypatch):
+    """Every report already in the PDF cache: no process pool in the tests"""
+    monkeypatch.setattr(server.pdf_cache, "read", lambda path: b"%PDF-cached")
+    yield client
+    server.bulk_pdf.release()
+
+
+def admin():
+    return {"id": ADMIN_ID, "role": "admin"}
+
+
+def test_zip_with_every_user_and_the_manifest(cached):
+    response = cached.get("/api/export/pdf/bulk", params={"month": "1", "year": "2025"}, headers=auth(ADMIN_ID))
+    assert response.status_code == 200
+    archive = zipfile.ZipFile(io.BytesIO(response.content))
+    manifest = json.loads(archive.read("manifest.json"))
+    assert (manifest["users"], manifest["cached"], manifest["rendered"]) == (3, 3, 0)
+    assert not server.bulk_pdf.busy()
+
+
+def test_second_request_gets_409_until_the_stream_ends(cached):
+    async def scenario():
+        response = await server.export_monthly_pdfs("1", "2025", user=admin())
+        # Risposta restituita ma ZIP non ancora letto: il posto è ancora occupato
+        assert server.bulk_pdf.busy()
+        with pytest.raises(HTTPException) as error:
+            await server.export_monthly_pdfs("1", "2025", user=admin())
+        assert error.value.status_code == 409
+        chunks = [chunk async for chunk in response.body_iterator]
+        return b"".join(chunks)
+
+    data = asyncio.run(scenario())
+    assert "manifest.json" in zipfile.ZipFile(io.BytesIO(data)).namelist()
+    assert not server.bulk_pdf.busy()
+
+
+def test_concurrent_requests_while_loading(cached):
+    async def scenario():
+        return await asyncio.gather(
+            server.export_monthly_pdfs("1", "2025", user=admin()),
+            server.export_monthly_pdfs("1", "2025", user=admin()),
+            return_exceptions=True,
+        )
+
+    first, second = asyncio.run(scenario())
+    assert first.status_code == 200
+    assert isinstance(second, HTTPException) and second.status_code == 409
+
+
+def test_failed_load_releases_the_slot(cached, monkeypatch):
+    def broken(*args, **kwargs):
+        raise RuntimeError("sheet unavailable")
+
+    monkeypatch.setattr(server.db, "get_all_users", broken)
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.export_monthly_pdfs("1", "2025", user=admin()))
+    assert not server.bulk_pdf.busy()
@@ -0,0 +1,103 @@
+"""CityResolver lookups and the resolver cached by the storage backends"""
+
+import threading
+
+import pytest
+
+import city_resolver
+import db_sheets
+import db_sqlite
+from city_resolver import CityResolver, edit_distance
+
+CITIES = [
+    {"id": "c1", "name": "Reggio Emilia", "travel_minutes": 40},
+    {"id": "c2", "name": "Padova/Vicenza", "travel_minutes": 90},
+    {"id": "c3", "name": "Modena", "travel_minutes": 30},
+    {"id": "c4", "name": "Roma", "travel_minutes": 300},
+    {"id": "c5", "name": "Forlì-Cesena", "travel_minutes": 120},
+    {"id": "c6", "name": "Reggio Calabria", "travel_minutes": 600},
+]
+
+
+@pytest.fixture
+def resolver():
+    return CityResolver(CITIES)
+
+
+@pytest.mark.parametrize("spelling, expected", [
+    ("REGGIO EMILIA", "Reggio Emilia"),
+    ("reggio-emilia", "Reggio Emilia"),
+    ("  forli cesena ", "Forlì-Cesena"),
+    ("Vicenza", "Padova/Vicenza"),
+    ("c3", "Modena"),
+    ("reggio em", "Reggio Emilia"),
+    ("mode", "Modena"),
+    ("modenaa", "Modena"),
+    ("Regio Emilia", "Reggio Emilia"),
+    ("reggio emlia", "Reggio Emilia"),
+])
+def test_spellings_of_a_city(resolver, spelling, expected):
+    assert resolver.canonical_name(spelling) == expected
+
+
+@pytest.mark.parametrize("name", ["Roma Nord", "Padova Est", "Modena Sud", "Reggio", "Rom", "Milano"])
+def test_distinct_or_ambiguous_names_are_not_rewritten(resolver, name):
+    assert resolver.resolve(name) is None
+    assert resolver.canonical_name(name) == name
+
+
+def test_typos_must_point_to_a_single_city():
+    resolver = CityResolver([{"id": "a", "name": "Ceva"}, {"id": "b", "name": "Cena"}])
+    assert resolver.resolve("Ceea") is None
+    assert resolver.resolve("Cevaa")["id"] == "a"
+
+
+def test_edit_distance_is_bounded():
+    assert edit_distance("modena", "modenaa", 2) == 1
+    assert edit_distance("regio emilia", "reggio emilia", 2) == 1
+    assert edit_distance("roma nord", "roma", 2) == 3
+
+
+def test_memo_keeps_only_the_latest_names(resolver, monkeypatch):
+    monkeypatch.setattr(city_resolver, "MEMO_SIZE", 3)
+    for name in ["Modena", "Roma", "Vicenza", "Modena", "c1"]:
+        resolver.resolve(name)
+    # "Roma" era il meno recente: è uscito, "Modena" è stato riusato
+    assert list(resolver._memo) == ["Vicenza", "Modena", "c1"]
+    assert (resolver.hits, resolver.misses) == (1, 4)
+
+
+def test_travel_minutes(resolver):
+    assert resolver.travel_minutes(["Modena", "vicenza", "Atlantide"])[:2].tolist() == [30.0, 90.0]
+
+
+def test_sheets_resolver_is_rebuilt_only_when_cities_change(fake):
+    first = db_sheets.city_resolver()
+    assert db_sheets.city_resolver() is first
+    db_sheets.update_city("c2", {"name": "Como/Cantù"})
+    second = db_sheets.city_resolver()
+    assert second is not first
+    assert second.canonical_name("cantu") == "Como/Cantù"
+
+
+@pytest.fixture
+def sqlite_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(db_sqlite, "SQLITE_PATH", str(tmp_path / "travel.db"))
+    monkeypatch.setattr(db_sqlite, "_local", threading.local())
+    monkeypatch.setattr(db_sqlite, "_schema_ready", False)
+    monkeypatch.setattr(db_sqlite, "_city_resolver", None)
+    yield db_sqlite
+    db_sqlite._local.conn.close()
+
+
+def test_sqlite_resolver_is_cached(sqlite_db):
+    sqlite_db.create_city({"id": "c1", "name": "Modena", "travel_minutes": 30})
+    first = sqlite_db.city_resolver()
+    assert sqlite_db.city_resolver() is first
+    assert first.canonical_name("MODENA") == "Modena"
+
+    sqlite_db.create_city({"id": "c2", "name": "Parma", "travel_minutes": 45})
+    second = sqlite_db.city_resolver()
+    assert second is not first and second.canonical_name("parma") == "Parma"
+    assert sqlite_db.delete_city("c2")
+    assert sqlite_db.city_resolver().resolve("parma") is None
@@ -0,0 +1,115 @@
+"""Data version counters and the PDF cache keyed by them"""
+
+import json
+import os
+import time
+
+import pytest
+
+import server
+from data_versions import DataVersions
+from pdf_report import PdfCache
+from .helpers import USER_ID, auth
+
+
+def test_bump_changes_only_the_given_keys():
+    versions = DataVersions()
+    january, february = ("workdays", USER_ID, "2025", "1"), ("workdays", USER_ID, "2025", "2")
+    before = versions.get(january), versions.get(february)
+    versions.bump([january, january])
+    assert versions.get(january) == before[0] + 1
+    assert versions.get(february) == before[1]
+    assert versions.stats() == {"keys": 1, "bumps": 1, "saves": 0}
+
+
+def test_clean_close_keeps_the_versions(tmp_path):
+    path = str(tmp_path / "versions.json")
+    versions = DataVersions(path, save_delay=60)
+    versions.bump(["cities"])
+    # Il primo incremento segna subito il file come non chiuso
+    with open(path) as f:
+        assert json.load(f)["clean"] is False
+    versions.bump(["cities"])
+    expected = versions.get("cities")
+    versions.close()
+
+    reopened = DataVersions(path)
+    assert reopened.get("cities") == expected
+
+
+def test_unclean_shutdown_starts_from_a_new_base(tmp_path):
+    path = str(tmp_path / "versions.json")
+    versions = DataVersions(path, save_delay=60)
+    versions.bump(["cities"])
+    versions.bump(["cities"])
+    used = versions.get("cities")
+    # Il processo si ferma prima del salvataggio in sospeso
+    versions._timer.cancel()
+
+    reopened = DataVersions(path)
+    assert reopened.get("cities") > used
+    assert reopened.get("users") > used
+
+
+def test_bumps_are_saved_once_per_delay(tmp_path):
+    path = str(tmp_path / "versions.json")
+    versions = DataVersions(path, save_delay=0.05)
+    for _ in range(5):
+        versions.bump(["users"])
+    time.sleep(0.3)
+    # Uno per segnare il file come aperto, uno per tutti gli incrementi successivi
+    assert versions.saves == 2
+    with open(path) as f:
+        assert json.load(f)["versions"] == {"users": 5}
+    versions.close()
+
+
+def test_pdf_cache_path_ttl_and_eviction(tmp_path):
+    cache = PdfCache(str(tmp_path), max_bytes=25, ttl_seconds=60)
+    path = cache.path(USER_ID, "01", "2025", 1, 2, 3)
+    assert path == cache.path(USER_ID, "1", "2025", 1, 2, 3)
+    assert path != cache.path(USER_ID, "1", "2025", 2, 2, 3)
+    assert cache.get(path) is None
+
+    cache.put(path, b"x" * 10)
+    assert cache.read(path) == b"x" * 10
+    os.utime(path, (time.time() - 120, time.time() - 120))
+    assert cache.get(path) is None
+
+    os.utime(path, None)
+    time.sleep(0.01)
+    other = cache.path("u2", "1", "2025", 1)
+    cache.put(other, b"y" * 20)
+    # Il file scritto per primo esce per restare sotto max_bytes
+    assert not os.path.exists(path) and os.path.exists(other)
+    assert cache.stats()["evictions"] == 1
+
+
+@pytest.fixture
+def rendered(client, tmp_path, monkeypatch):
+    """PDF cache in tmp_path and a counter of the reports rendered"""
+    monkeypatch.setattr(server, "pdf_cache", PdfCache(str(tmp_path), 10 ** 6, 3600))
+    calls = []
+
+    def render(workdays, *args):
+        calls.append(len(workdays))
+        return b"%PDF-" + str(len(calls)).encode()
+
+    monkeypatch.setattr(server, "render_monthly_pdf", render)
+    return calls
+
+
+def test_pdf_is_served_from_cache_until_the_month_changes(client, rendered):
+    params = {"month": "1", "year": "2025"}
+    first = client.get("/api/export/pdf", params=params, headers=auth())
+    second = client.get("/api/export/pdf", params=params, headers=auth())
+    assert first.content == second.content == b"%PDF-1"
+    assert rendered == [10]
+
+    # Un altro mese non invalida il report di gennaio
+    assert client.post("/api/workdays", json={"date": "2025-02-03", "city": "Como"}, headers=auth()).status_code == 200
+    assert client.get("/api/export/pdf", params=params, headers=auth()).content == b"%PDF-1"
+
+    assert client.delete("/api/workdays", params={"date": "2025-01-04"}, headers=auth()).status_code == 200
+    assert client.get("/api/export/pdf", params=params, headers=auth()).content == b"%PDF-2"
+    assert rendered == [10, 9]
@@ -0,0 +1,229 @@
+"""db_sheets_async against fake_sheets.FakeSheetsAPI: REST paths, retries and quota, row index, versions, pages and export"""
+
+import asyncio
+
+import pytest
+
+import db_sheets_async as db
+import fake_sheets
+import storage
+from quota_scheduler import QuotaExceededError
+from .helpers import USER_ID, make_workday, sheet_rows
+
+
+@pytest.fixture
+def api(fake, monkeypatch):
+    """The fake spreadsheet served as Sheets v4 REST API, retries without waiting"""
+    server = fake_sheets.FakeSheetsAPI(fake)
+    db.use_transport(server.transport())
+    delays = []
+
+    async def no_sleep(delay):
+        delays.append(delay)
+
+    monkeypatch.setattr(db.asyncio, "sleep", no_sleep)
+    server.delays = delays
+    yield server
+    asyncio.run(db.close())
+    db.use_transport(None)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_reads_users_cities_and_workdays(api):
+    async def scenario():
+        users, cities, workdays = await asyncio.gather(
+            db.get_all_users(), db.get_all_cities(), db.get_all_workdays(USER_ID, "2025", "01"),
+        )
+        return users, cities, workdays, await db.get_user_by_email("USER2@example.com")
+
+    users, cities, workdays, user2 = run(scenario())
+    assert [u["id"] for u in users] == ["u1", "u2", "u3"]
+    assert [c["name"] for c in cities] == ["Milano", "Como", "Lecco"]
+    assert cities[2]["travel_minutes"] == 30
+    assert sorted(w["date"] for w in workdays) == [f"2025-01-{day:02d}" for day in range(1, 11)]
+    assert user2["id"] == "u2"
+
+
+def test_append_paths(api):
+    async def scenario():
+        await db.create_workday(make_workday("2025-02-01"))
+        await db.create_workdays_batch([make_workday("2025-02-02"), make_workday("2025-02-03", user_id="u2")])
+        await db.create_city({"id": "c4", "name": "Bergamo", "travel_minutes": 50})
+        return await db.get_workday_by_date("u2", "2025-02-03"), await db.get_city_by_id("c4")
+
+    workday, city = run(scenario())
+    assert [r["date"] for r in sheet_rows(api.spreadsheet)][-3:] == ["2025-02-01", "2025-02-02", "2025-02-03"]
+    assert api.requests["values_append"] == 3
+    assert workday["user_id"] == "u2"
+    assert city["name"] == "Bergamo"
+
+
+def test_batch_update_writes_only_changed_cells(api):
+    async def scenario():
+        assert await db.update_workday(USER_ID, "2025-01-05", {"city": "Como", "work_minutes": 400, "status": ""})
+        assert await db.update_user("u3", {"username": "renamed"})
+        assert not await db.update_workday(USER_ID, "2024-12-31", {"city": "Como"})
+
+    run(scenario())
+    rows = {r["date"]: r for r in sheet_rows(api.spreadsheet)}
+    assert rows["2025-01-05"]["city"] == "Como"
+    assert rows["2025-01-05"]["work_minutes"] == "400"
+    assert rows["2025-01-04"]["city"] == "Milano"
+    assert [r["username"] for r in sheet_rows(api.spreadsheet, "users")] == ["user1", "user2", "renamed"]
+    assert api.requests["values_batch_update"] == 2
+
+
+def test_lookups_go_through_the_row_index(api):
+    async def scenario():
+        await db.load_workday_index()
+        api.reset_requests()
+        assert await db.delete_workday(USER_ID, "2025-01-04")
+        for day in range(5, 11):
+            date = f"2025-01-{day:02d}"
+            assert (await db.get_workday_by_date(USER_ID, date))["date"] == date
+        assert await db.get_workday_by_date(USER_ID, "2025-01-04") is None
+        assert await db.update_workday(USER_ID, "2025-01-09", {"city": "Lecco"})
+
+    run(scenario())
+    # Nessuna lettura dell'intero foglio né ricostruzione dell'indice: una riga per lookup
+    assert "get_all_values" not in api.spreadsheet.calls
+    assert "values_batch_get" not in api.requests
+    assert api.spreadsheet.calls["get"] == 8
+    rows = {r["date"]: r for r in sheet_rows(api.spreadsheet)}
+    assert "2025-01-04" not in rows
+    assert rows["2025-01-09"]["city"] == "Lecco"
+    assert rows["2025-01-08"]["city"] == "Milano"
+
+
+def test_stale_index_is_rebuilt_and_retried(api):
+    async def scenario():
+        index = await db.load_workday_index()
+        rebuilds = index.rebuilds
+        # Righe cancellate da un altro client
+        del api.spreadsheet._sheets["workdays"]._rows[1:3]
+        workday = await db.get_workday_by_date(USER_ID, "2025-01-06")
+        return workday, index.rebuilds - rebuilds, await db.get_workday_by_date(USER_ID, "2025-01-01")
+
+    workday, rebuilt, missing = run(scenario())
+    assert workday["date"] == "2025-01-06"
+    assert rebuilt == 1
+    assert missing is None
+
+
+def test_429_is_retried_with_backoff(api):
+    api.fail(429, 429)
+    calls = db.quota_stats()
+
+    users = run(db.get_all_users())
+    assert len(users) == 3
+    assert api.requests["error_429"] == 2
+    assert len(api.delays) == 2
+    assert db.quota_stats()["throttled"] - calls["throttled"] == 2
+
+    async def append():
+        await db.create_workday(make_workday("2025-02-01"))
+
+    # Anche l'append: con 429 la richiesta non è stata eseguita
+    api.fail(429)
+    run(append())
+    assert [r["date"] for r in sheet_rows(api.spreadsheet)].count("2025-02-01") == 1
+
+
+def test_5xx_is_retried_only_when_idempotent(api):
+    api.fail(503)
+    assert run(db.get_city_by_id("c2"))["name"] == "Como"
+
+    async def append():
+        await db.create_workday(make_workday("2025-02-01"))
+
+    api.fail(503)
+    with pytest.raises(db.SheetsAPIError) as error:
+        run(append())
+    assert error.value.status_code == 503
+    assert len(sheet_rows(api.spreadsheet)) == 10
+
+
+def test_gives_up_after_max_retries(api, monkeypatch):
+    monkeypatch.setattr(db.base, "QUOTA_MAX_RETRIES", 2)
+    api.fail(429, 429, 429)
+    with pytest.raises(QuotaExceededError) as error:
+        run(db.get_all_cities())
+    assert error.value.__cause__.status_code == 429
+    assert len(api.delays) == 2
+
+
+def test_requests_take_tokens_from_the_shared_buckets(api):
+    acquired = db.base.quota.buckets["read"].stats()["acquired"].get("interactive", 0)
+    run(db.get_all_users())
+    assert db.base.quota.buckets["read"].stats()["acquired"]["interactive"] == acquired + 2
+
+
+def test_initialize_creates_missing_sheets(api):
+    del api.spreadsheet._sheets["roles"]
+    run(db.initialize_sheets())
+    assert api.spreadsheet._sheets["roles"]._rows == [db.SHEETS_CONFIG["roles"]]
+
+
+def test_writes_bump_data_versions(api):
+    before = (db.table_version("cities"), db.workdays_version(USER_ID, "2025", "01"),
+              db.workdays_version(USER_ID, "2025", "02"))
+
+    async def scenario():
+        await db.update_city("c2", {"travel_minutes": 25})
+        await db.update_workday(USER_ID, "2025-01-03", {"city": "Como"})
+
+    run(scenario())
+    assert db.table_version("cities") != before[0]
+    assert db.workdays_version(USER_ID, "2025", "01") != before[1]
+    assert db.workdays_version(USER_ID, "2025", "02") == before[2]
+
+
+def test_city_resolver_is_rebuilt_only_when_cities_change(api):
+    async def scenario():
+        first = await db.city_resolver()
+        assert await db.city_resolver() is first
+        await db.create_city({"id": "c4", "name": "Bergamo", "travel_minutes": 50})
+        second = await db.city_resolver()
+        return first, second
+
+    first, second = run(scenario())
+    assert second is not first
+    assert second.canonical_name("bergamo") == "Bergamo"
+
+
+def test_workdays_page(api):
+    async def scenario():
+        await db.create_workday(make_workday("2025-01-02", user_id="u2"))
+        return await db.get_workdays_page(date_from="2025-01-02", limit=3, fields=["date", "user_id"])
+
+    items, cursor = run(scenario())
+    assert items == [{"date": "2025-01-02", "user_id": "u1"}, {"date": "2025-01-02", "user_id": "u2"},
+                     {"date": "2025-01-03", "user_id": "u1"}]
+    assert cursor is not None
+
+
+def test_iter_workdays_reads_fixed_row_ranges(api, monkeypatch):
+    monkeypatch.setattr(db.base, "EXPORT_CHUNK_ROWS", 4)
+
+    async def scenario():
+        await db.get_column_map("workdays")
+        api.reset_requests()
+        return [w["date"] async for w in db.iter_workdays(USER_ID, date_from="2025-01-03")]
+
+    dates = run(scenario())
+    assert dates == [f"2025-01-{day:02d}" for day in range(3, 11)]
+    # 10 righe a blocchi di 4: tre letture, mai l'intero foglio
+    assert api.requests["values_get"] == 3
+    assert "get_all_values" not in api.spreadsheet.calls
+
+
+def test_load_backend_rejects_unsupported_settings(monkeypatch):
+    monkeypatch.setenv("SHEETS_SOFT_DELETE", "true")
+    with pytest.raises(RuntimeError, match="SHEETS_SOFT_DELETE"):
+        storage.load_backend("sheets_async")
+    with pytest.raises(RuntimeError, match="SHEETS_SOFT_DELETE"):
+        storage.load_backend("sqlite")
+    assert storage.load_backend("sheets") is db.base
@@ -0,0 +1,82 @@
+"""Row-number dependent writes of db_sheets through the (user_id, date) row index"""
+
+import db_sheets
+from .helpers import USER_ID, make_workday, sheet_rows
+
+
+def dates(fake, title="workdays"):
+    return [r["date"] for r in sheet_rows(fake, title)]
+
+
+def test_lookup_reads_one_row_through_the_index(fake):
+    db_sheets.load_workday_index()
+    fake.reset_calls()
+    workday = db_sheets.get_workday_by_date(USER_ID, "2025-01-07")
+    assert workday["id"] == f"{USER_ID}-2025-01-07"
+    assert "get_all_records" not in fake.calls
+    assert fake.calls["row_values"] == 1
+
+
+def test_delete_in_the_middle_shifts_later_rows(fake):
+    assert db_sheets.delete_workday(USER_ID, "2025-01-04")
+    assert "2025-01-04" not in dates(fake)
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-04") is None
+
+    fake.reset_calls()
+    for day in range(5, 11):
+        date = f"2025-01-{day:02d}"
+        assert db_sheets.get_workday_by_date(USER_ID, date)["date"] == date
+    # Nessuna ricostruzione: l'indice è stato spostato in place
+    assert "batch_get" not in fake.calls
+
+
+def test_update_after_delete_writes_the_right_row(fake):
+    db_sheets.delete_workday(USER_ID, "2025-01-02")
+    db_sheets.delete_workday(USER_ID, "2025-01-05")
+    assert db_sheets.update_workday(USER_ID, "2025-01-08", {"city": "Como", "work_minutes": 400})
+
+    rows = {r["date"]: r for r in sheet_rows(fake)}
+    assert rows["2025-01-08"]["city"] == "Como"
+    assert rows["2025-01-08"]["work_minutes"] == "400"
+    assert all(r["city"] == "Milano" for date, r in rows.items() if date != "2025-01-08")
+
+
+def test_update_and_delete_of_a_missing_day(fake):
+    assert not db_sheets.update_workday(USER_ID, "2024-12-31", {"city": "Como"})
+    assert not db_sheets.delete_workday("u2", "2025-01-01")
+    assert len(sheet_rows(fake)) == 10
+
+
+def test_date_change_rekeys_the_row(fake):
+    assert db_sheets.update_workday(USER_ID, "2025-01-03", {"date": "2025-02-03"})
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-03") is None
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-02-03")["id"] == f"{USER_ID}-2025-01-03"
+
+
+def test_appended_rows_are_found(fake):
+    db_sheets.load_workday_index()
+    db_sheets.create_workdays_batch([make_workday("2025-03-01"), make_workday("2025-03-02", user_id="u2")])
+    db_sheets.delete_workday(USER_ID, "2025-01-01")
+    assert db_sheets.get_workday_by_date("u2", "2025-03-02")["user_id"] == "u2"
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-03-01")["date"] == "2025-03-01"
+
+
+def test_stale_index_is_rebuilt_and_retried(fake):
+    index = db_sheets.load_workday_index()
+    rebuilds = index.rebuilds
+    # Righe cancellate a mano sul foglio: l'indice punta a righe sbagliate
+    del fake._sheets["workdays"]._rows[1:3]
+
+    workday = db_sheets.get_workday_by_date(USER_ID, "2025-01-06")
+    assert workday["date"] == "2025-01-06"
+    assert index.rebuilds == rebuilds + 1
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-01") is None
+    assert db_sheets.update_workday(USER_ID, "2025-01-09", {"city": "Lecco"})
+    assert {r["date"]: r["city"] for r in sheet_rows(fake)}["2025-01-09"] == "Lecco"
+
+
+def test_index_of_an_empty_sheet(fake):
+    fake.load("workdays", [], [])
+    db_sheets.use_spreadsheet(fake)
+    assert db_sheets.load_workday_index().find((USER_ID, "2025-01-01")) is None
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-01") is None
@@ -0,0 +1,101 @@
+"""Conditional GETs of the list endpoints: ETags from the data versions, 304 from the token alone"""
+
+import db_sheets
+import server
+from .helpers import ADMIN_ID, USER_ID, auth, make_workday
+
+
+def get(client, path, etag=None, as_user=USER_ID, **params):
+    headers = auth(as_user)
+    if etag:
+        headers["If-None-Match"] = etag
+    return client.get(path, params=params, headers=headers)
+
+
+def test_unchanged_list_answers_304(client):
+    first = get(client, "/api/cities")
+    assert first.status_code == 200
+    etag = first.headers["ETag"]
+    assert first.headers["Cache-Control"] == "private, no-cache"
+
+    again = get(client, "/api/cities", etag)
+    assert again.status_code == 304
+    assert again.headers["ETag"] == etag
+    assert get(client, "/api/cities", f'W/{etag}, "other"').status_code == 304
+
+
+def test_writes_change_the_etag(client):
+    etag = get(client, "/api/workdays").headers["ETag"]
+    other = get(client, "/api/workdays", as_user="u2").headers["ETag"]
+    client.post("/api/workdays", json={"date": "2025-02-03", "city": "Como"}, headers=auth())
+
+    assert get(client, "/api/workdays", etag).status_code == 200
+    # I workdays di un altro utente non cambiano
+    assert get(client, "/api/workdays", other, as_user="u2").status_code == 304
+
+
+def test_query_params_and_scope_are_part_of_the_etag(client):
+    etags = {
+        get(client, "/api/workdays").headers["ETag"],
+        get(client, "/api/workdays", month="1", year="2025").headers["ETag"],
+        get(client, "/api/workdays", as_user=ADMIN_ID).headers["ETag"],
+    }
+    assert len(etags) == 3
+
+
+def test_304_does_not_read_the_user(client, monkeypatch):
+    etag = get(client, "/api/cities").headers["ETag"]
+    reads = []
+    monkeypatch.setattr(db_sheets, "get_user_by_id", lambda user_id: reads.append(user_id))
+    assert get(client, "/api/cities", etag).status_code == 304
+    assert reads == []
+    # Senza ETag valido l'utente viene letto (e qui non esiste più)
+    assert get(client, "/api/cities", '"stale"').status_code == 401
+    assert reads == [USER_ID]
+
+
+def test_admin_lists_check_the_token_role_first(client):
+    etag = get(client, "/api/users", as_user=ADMIN_ID).headers["ETag"]
+    assert get(client, "/api/users", etag, as_user=ADMIN_ID).status_code == 304
+    assert get(client, "/api/users", etag).status_code == 403
+    assert get(client, "/api/workdays", user_id="u2").status_code == 403
+
+
+def test_manual_sheet_edits_change_the_etag(client, fake, monkeypatch):
+    monkeypatch.setattr(db_sheets._cache, "ttl_seconds", 0)
+    monkeypatch.setattr(db_sheets, "VERSION_REFRESH_SECONDS", 0)
+    cities = get(client, "/api/cities").headers["ETag"]
+    workdays = get(client, "/api/workdays").headers["ETag"]
+    assert get(client, "/api/cities", cities).status_code == 304
+    assert get(client, "/api/workdays", workdays).status_code == 304
+
+    fake._sheets["cities"]._rows[1][1] = "Milano Centrale"
+    fake._sheets["workdays"]._rows.append(db_sheets._workday_row(make_workday("2025-01-20")))
+    fresh = get(client, "/api/cities", cities)
+    assert fresh.status_code == 200
+    assert fresh.json()[0]["name"] == "Milano Centrale"
+    assert get(client, "/api/workdays", workdays).status_code == 200
+
+
+def test_own_writes_are_not_taken_for_manual_edits(fake):
+    db_sheets.get_all_workdays()
+    db_sheets.create_workday(make_workday("2025-02-03"))
+    before = db_sheets.workdays_version("u2", "2025", "1")
+    db_sheets.get_all_workdays()
+    assert db_sheets.workdays_version("u2", "2025", "1") == before
+
+
+class NoVersions:
+    """db_sheets seen as a backend without data versions (like sqlite)"""
+
+    def __getattr__(self, name):
+        if name in ("table_version", "refresh_version"):
+            raise AttributeError(name)
+        return getattr(db_sheets, name)
+
+
+def test_no_etag_without_versions(client, monkeypatch):
+    monkeypatch.setattr(server, "db", NoVersions())
+    response = get(client, "/api/cities", '"anything"')
+    assert response.status_code == 200
+    assert "ETag" not in response.headers
@@ -0,0 +1,72 @@
+"""Streaming export of workdays: fixed row ranges per read, sheet order, GET /api/export/workdays"""
+
+import csv
+import io
+import json
+
+import pytest
+
+import db_sheets
+from .helpers import ADMIN_ID, USER_ID, auth, make_workday
+
+
+@pytest.fixture
+def chunks(fake, monkeypatch):
+    """Exports read 4 rows per call"""
+    monkeypatch.setattr(db_sheets, "EXPORT_CHUNK_ROWS", 4)
+    return fake
+
+
+def test_reads_fixed_row_ranges(chunks):
+    db_sheets.get_column_map("workdays")
+    chunks.reset_calls()
+    dates = [w["date"] for w in db_sheets.iter_workdays(USER_ID, date_from="2025-01-03")]
+    assert dates == [f"2025-01-{day:02d}" for day in range(3, 11)]
+    # 10 righe a blocchi di 4: tre letture, mai l'intero foglio
+    assert chunks.calls["get"] == 3
+    assert "get_all_records" not in chunks.calls
+    assert "get_all_values" not in chunks.calls
+
+
+def test_rows_are_read_only_when_consumed(chunks):
+    db_sheets.get_column_map("workdays")
+    chunks.reset_calls()
+    rows = db_sheets.iter_workdays()
+    assert [next(rows)["date"] for _ in range(4)] == [f"2025-01-{day:02d}" for day in range(1, 5)]
+    assert chunks.calls["get"] == 1
+
+
+def test_sheet_order_within_year_partitions(chunks, monkeypatch):
+    monkeypatch.setattr(db_sheets, "WORKDAYS_PARTITIONED", True)
+    config = db_sheets.SHEETS_CONFIG["workdays"]
+    chunks.load("workdays_2025", config, [db_sheets._workday_row(make_workday(d))
+                                          for d in ("2025-03-01", "2025-01-05", "2025-02-01")])
+    chunks.load("workdays_2024", config, [db_sheets._workday_row(make_workday("2024-06-01", work_minutes=480))])
+    db_sheets.use_spreadsheet(chunks)
+    workdays = list(db_sheets.iter_workdays())
+    assert [w["date"] for w in workdays] == ["2024-06-01", "2025-03-01", "2025-01-05", "2025-02-01"]
+    assert workdays[0]["work_minutes"] == 480
+
+
+def test_tombstones_are_skipped(chunks, monkeypatch):
+    monkeypatch.setattr(db_sheets, "SOFT_DELETE", True)
+    assert db_sheets.delete_workday(USER_ID, "2025-01-02")
+    assert "2025-01-02" not in [w["date"] for w in db_sheets.iter_workdays(USER_ID)]
+    assert len(list(db_sheets.iter_workdays(USER_ID))) == 9
+
+
+def test_api_streams_ndjson_and_csv(client, chunks):
+    client.post("/api/workdays", json={"date": "2025-01-04", "city": "Como"}, headers=auth("u2"))
+    response = client.get("/api/export/workdays", params={"date_to": "2025-01-04"}, headers=auth(ADMIN_ID))
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [(w["date"], w["user_id"]) for w in lines] == [
+        ("2025-01-01", "u1"), ("2025-01-02", "u1"), ("2025-01-03", "u1"), ("2025-01-04", "u1"), ("2025-01-04", "u2"),
+    ]
+
+    response = client.get("/api/export/workdays", params={"format": "csv", "month": "1", "year": "2025"},
+                          headers=auth())
+    header, *rows = csv.reader(io.StringIO(response.text), delimiter=";")
+    assert header[0].lstrip("\ufeff") == "Giorno"
+    assert len(rows) == 10
+    assert rows[0][:2] == ["01/01/2025", "Milano"]
+    assert rows[0][-1] == "user1"
@@ -0,0 +1,147 @@
+"""Background CSV import jobs: state on disk, progress and resume after a restart"""
+
+import asyncio
+import io
+import json
+import threading
+from datetime import datetime, timedelta, timezone
+
+from import_jobs import ImportJobManager, COMPLETED, FAILED, QUEUED
+from .helpers import USER_ID, sheet_rows
+
+
+def job_file(manager, job):
+    with open(manager._path(job["id"], "json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+async def wait_for(manager, job_id):
+    await asyncio.gather(*manager._tasks.values())
+    return manager.get(job_id)
+
+
+def chunked_runner(chunks):
+    """Runner reporting `chunks` chunks of 10 rows, starting after start_chunk"""
+    async def runner(job, upload, start_chunk, on_chunk):
+        for chunk in range(start_chunk + 1, chunks + 1):
+            await on_chunk({"chunk": chunk, "rows": 10, "saved": 10, "error": None}, [])
+    return runner
+
+
+def test_state_is_written_off_the_event_loop(tmp_path, monkeypatch):
+    writers = []
+    manager = ImportJobManager(str(tmp_path), 1, chunked_runner(3))
+    write = manager._write
+
+    def recording_write(job_id, data):
+        writers.append(threading.current_thread() is threading.main_thread())
+        write(job_id, data)
+
+    monkeypatch.setattr(manager, "_write", recording_write)
+
+    async def scenario():
+        job = await manager.submit("u1", "days.csv", io.BytesIO(b"Giorno;Citta\n"))
+        return await wait_for(manager, job["id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == COMPLETED
+    # submit, running, 3 blocchi, fine: nessuna scrittura sul thread del loop
+    assert writers == [False] * 6
+    assert job_file(manager, job)["rows_saved"] == 30
+
+
+def test_job_imports_the_csv_chunk_by_chunk(fake, tmp_path, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "CSV_IMPORT_CHUNK_SIZE", 2)
+    manager = ImportJobManager(str(tmp_path), 1, server.run_import_job)
+    csv = "\n".join([
+        "Giorno;Città;Minuti andata;Minuti ritorno;Minuti lavoro in VIS",
+        "01/01/2025;Milano;10;10;480",  # già sul foglio
+        "03/02/2025;como;20;20;480",
+        "04/02/2025;Ferie;0;0;0",
+        "05/02;Lecco;30;30;480",  # data senza anno
+        "06/02/2025;Lecco;30;30;480",
+    ]).encode()
+
+    async def scenario():
+        job = await manager.submit(USER_ID, "days.csv", io.BytesIO(csv))
+        return await wait_for(manager, job["id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == COMPLETED
+    assert (job["chunks_done"], job["rows_read"], job["rows_saved"], job["error_count"]) == (3, 5, 3, 1)
+    assert job["errors"][0].startswith("Riga 4")
+    rows = {r["date"]: r for r in sheet_rows(fake)}
+    assert rows["2025-02-03"]["city"] == "Como"
+    assert rows["2025-02-04"]["status"] == "Ferie"
+    assert "2025-02-06" in rows
+    # Il file caricato non serve più, lo stato resta per il polling
+    assert not (tmp_path / f"{job['id']}.csv").exists()
+    assert job_file(manager, job)["status"] == COMPLETED
+
+
+def test_restart_resumes_after_the_last_chunk(tmp_path):
+    started = []
+
+    def runner(chunks):
+        inner = chunked_runner(chunks)
+
+        async def run(job, upload, start_chunk, on_chunk):
+            started.append(start_chunk)
+            await inner(job, upload, start_chunk, on_chunk)
+        return run
+
+    first = ImportJobManager(str(tmp_path), 1, runner(4))
+    job = {**asyncio.run(submit_only(first)), "status": "running", "chunks_done": 2, "rows_read": 20}
+    first._save(job)
+
+    async def restart():
+        manager = ImportJobManager(str(tmp_path), 1, runner(4))
+        assert manager.resume() == 1
+        assert manager.get(job["id"])["status"] == QUEUED
+        return await wait_for(manager, job["id"])
+
+    resumed = asyncio.run(restart())
+    assert started == [2]
+    assert resumed["status"] == COMPLETED
+    assert (resumed["chunks_done"], resumed["rows_read"], resumed["resumed"]) == (4, 40, 1)
+
+
+async def submit_only(manager):
+    """Submit a job whose task is cancelled at once (a crash before it ran)"""
+    job = await manager.submit(USER_ID, "days.csv", io.BytesIO(b"Giorno\n"))
+    await manager.shutdown()
+    return dict(job)
+
+
+def test_failing_runner_marks_the_job_failed(tmp_path):
+    async def runner(job, upload, start_chunk, on_chunk):
+        await on_chunk({"chunk": 1, "rows": 10, "saved": 0, "error": "quota"}, ["Errore batch insert"])
+        raise RuntimeError("storage down")
+
+    manager = ImportJobManager(str(tmp_path), 1, runner)
+
+    async def scenario():
+        job = await manager.submit(USER_ID, "days.csv", io.BytesIO(b"Giorno\n"))
+        return await wait_for(manager, job["id"])
+
+    job = asyncio.run(scenario())
+    assert job["status"] == FAILED
+    assert job["chunks_failed"] == 1
+    assert job["errors"] == ["Errore batch insert", "Import interrotto: storage down"]
+
+
+def test_resume_drops_expired_jobs_and_fails_lost_uploads(tmp_path):
+    manager = ImportJobManager(str(tmp_path), 1, chunked_runner(1), retention_days=7)
+    old = (datetime.now(timezone.utc) - timedelta(days=8)).isoformat()
+    base = {"user_id": USER_ID, "errors": [], "resumed": 0, "chunks_done": 0, "finished_at": None}
+    manager._save({**base, "id": "old", "status": COMPLETED, "created_at": old, "finished_at": old})
+    manager._save({**base, "id": "lost", "status": "running", "created_at": old})
+
+    assert manager.resume() == 0
+    assert manager.get("old") is None
+    assert not (tmp_path / "old.json").exists()
+    assert manager.get("lost")["status"] == FAILED
+    assert [job["id"] for job in manager.list_jobs(USER_ID)] == ["lost"]
+    assert manager.list_jobs("u2") == []
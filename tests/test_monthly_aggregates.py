@@ -0,0 +1,88 @@
+"""Materialized monthly totals: delta updates, the monthly_stats sheet and verify/fix"""
+
+import pytest
+
+import db_sheets
+import stats
+from monthly_aggregates import MonthlyAggregates
+from .helpers import USER_ID, make_workday, sheet_rows
+
+
+@pytest.fixture
+def aggregates(fake, monkeypatch):
+    monkeypatch.setattr(db_sheets, "MONTHLY_AGGREGATES", True)
+    db_sheets._aggregates.reset()
+    yield fake
+    db_sheets._aggregates.reset()
+
+
+def recomputed(user_id, year, month=None):
+    period = {"year": year, "month": month} if month else {"year": year}
+    return stats.monthly_stats(db_sheets.get_all_workdays(user_id, **period), year, month)
+
+
+def test_first_use_builds_the_sheet_from_the_workdays(aggregates):
+    groups = db_sheets.get_monthly_aggregates(USER_ID, "2025", "1")
+    assert stats.summarize(groups, "2025", "1") == recomputed(USER_ID, "2025", "1")
+    rows = sheet_rows(aggregates, db_sheets.AGGREGATES_SHEET)
+    assert [(r["user_id"], r["year"], r["month"], float(r["work_days"])) for r in rows] == [(USER_ID, "2025", "1", 10)]
+
+
+def test_writes_update_the_totals_by_delta(aggregates):
+    db_sheets.get_monthly_aggregates(USER_ID, "2025")
+    aggregates.reset_calls()
+    db_sheets.create_workday(make_workday("2025-02-03", work_minutes=300))
+    db_sheets.update_workday(USER_ID, "2025-01-02", {"city": "", "status": "Ferie"})
+    db_sheets.delete_workday(USER_ID, "2025-01-03")
+    # I totali si aggiornano senza rileggere i workdays
+    assert "get_all_values" not in aggregates.calls
+    assert "get_all_records" not in aggregates.calls
+
+    for month in ("1", "2"):
+        assert stats.summarize(db_sheets.get_monthly_aggregates(USER_ID, "2025", month), "2025", month) \
+            == recomputed(USER_ID, "2025", month)
+    january = stats.summarize(db_sheets.get_monthly_aggregates(USER_ID, "2025", "1"), "2025", "1")
+    assert (january["work_days"], january["rest_days_by_status"]) == (8, {"Ferie": 1})
+    # Un gruppo nuovo aggiunge una riga, quello esistente viene riscritto
+    assert len(sheet_rows(aggregates, db_sheets.AGGREGATES_SHEET)) == 2
+
+
+def test_saved_groups_are_loaded_back(aggregates):
+    db_sheets.create_workday(make_workday("2025-02-03"))
+    expected = db_sheets.get_monthly_aggregates(USER_ID, "2025")
+    db_sheets._aggregates.reset()
+    aggregates.reset_calls()
+    assert db_sheets.get_monthly_aggregates(USER_ID, "2025") == expected
+    assert aggregates.calls["get_all_records"] == 1
+
+
+def test_verify_detects_and_fixes_a_stale_sheet(aggregates):
+    db_sheets.get_monthly_aggregates(USER_ID, "2025")
+    # Workday scritto da un altro client: il foglio dei totali resta indietro
+    aggregates._sheets["workdays"]._rows.append(db_sheets._workday_row(make_workday("2025-01-20")))
+    db_sheets.invalidate_cache()
+
+    report = db_sheets.verify_monthly_aggregates()
+    assert (report["groups"], report["fixed"]) == (1, False)
+    assert [m["month"] for m in report["mismatches"]] == ["1"]
+
+    assert db_sheets.verify_monthly_aggregates(fix=True)["fixed"]
+    assert db_sheets.verify_monthly_aggregates()["mismatches"] == []
+    totals = stats.summarize(db_sheets.get_monthly_aggregates(USER_ID, "2025", "1"), "2025", "1")
+    assert totals["work_days"] == 11
+
+
+def test_pending_and_saved_track_sheet_rows():
+    groups = MonthlyAggregates()
+    groups.load([], first_row=2)
+    groups.apply(added=[make_workday("2025-03-01"), make_workday("2025-04-01", user_id="u2")])
+    updates, appends = groups.pending()
+    assert updates == [] and [key for key, _ in appends] == [(USER_ID, "2025", "3"), ("u2", "2025", "4")]
+    groups.saved([], [key for key, _ in appends])
+
+    groups.apply(removed=[make_workday("2025-03-01")])
+    updates, appends = groups.pending()
+    assert [row for row, _ in updates] == [2] and appends == []
+    # Un gruppo svuotato resta sul foglio ma non viene più restituito
+    assert groups.get(USER_ID, "2025") == []
+    assert [g["user_id"] for g in groups.get(None, "2025")] == ["u2"]
@@ -0,0 +1,61 @@
+"""Year-partitioned workday worksheets: routing of reads and writes, malformed dates"""
+
+import pytest
+
+import db_sheets
+from .helpers import USER_ID, auth, make_workday, sheet_rows
+
+
+@pytest.fixture
+def partitioned(fake, monkeypatch):
+    """Workdays of 2024 and 2025 in workdays_2024 / workdays_2025"""
+    monkeypatch.setattr(db_sheets, "WORKDAYS_PARTITIONED", True)
+    config = db_sheets.SHEETS_CONFIG["workdays"]
+    fake.load("workdays_2024", config, [db_sheets._workday_row(make_workday(f"2024-12-{d}")) for d in (30, 31)])
+    fake.load("workdays_2025", config, [db_sheets._workday_row(make_workday(f"2025-01-0{d}")) for d in (1, 2, 3)])
+    db_sheets.use_spreadsheet(fake)
+    return fake
+
+
+def dates(fake, title):
+    return [r["date"] for r in sheet_rows(fake, title)]
+
+
+def test_writes_go_to_the_year_partition(partitioned):
+    db_sheets.create_workdays_batch([make_workday("2024-11-05"), make_workday("2026-02-01")])
+    assert dates(partitioned, "workdays_2024")[-1] == "2024-11-05"
+    assert dates(partitioned, "workdays_2026") == ["2026-02-01"]
+
+    assert db_sheets.update_workday(USER_ID, "2025-01-02", {"city": "Como"})
+    assert db_sheets.delete_workday(USER_ID, "2024-12-30")
+    assert {r["date"]: r["city"] for r in sheet_rows(partitioned, "workdays_2025")}["2025-01-02"] == "Como"
+    assert dates(partitioned, "workdays_2024") == ["2024-12-31", "2024-11-05"]
+
+
+def test_reads_only_the_year_partition(partitioned):
+    partitioned.reset_calls()
+    assert [w["date"] for w in db_sheets.get_all_workdays(USER_ID, "2024")] == ["2024-12-30", "2024-12-31"]
+    assert partitioned.calls["get_all_records"] == 1
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-03")["date"] == "2025-01-03"
+    assert len(db_sheets.get_all_workdays(USER_ID)) == 5
+
+
+def test_date_change_moves_the_row_between_partitions(partitioned):
+    assert db_sheets.update_workday(USER_ID, "2025-01-01", {"date": "2024-12-29"})
+    assert dates(partitioned, "workdays_2025") == ["2025-01-02", "2025-01-03"]
+    assert db_sheets.get_workday_by_date(USER_ID, "2024-12-29")["id"] == f"{USER_ID}-2025-01-01"
+
+
+def test_malformed_date_is_not_found(partitioned):
+    assert db_sheets.get_workday_by_date(USER_ID, "not-a-date") is None
+    assert not db_sheets.update_workday(USER_ID, "31/12", {"city": "Como"})
+    assert not db_sheets.delete_workday(USER_ID, "")
+
+
+def test_api_rejects_malformed_dates(partitioned, client):
+    response = client.put("/api/workdays/2025-13-45", json={"date": "2025-13-45", "city": "Como"}, headers=auth())
+    assert response.status_code == 400
+    assert client.delete("/api/workdays", params={"date": "1/2"}, headers=auth()).status_code == 400
+    assert client.post("/api/workdays", json={"date": "yesterday"}, headers=auth()).status_code == 400
+    assert client.delete("/api/workdays", params={"date": "02/01/2025"}, headers=auth()).status_code == 200
+    assert dates(partitioned, "workdays_2025") == ["2025-01-01", "2025-01-03"]
@@ -0,0 +1,118 @@
+"""QuotaScheduler: token buckets, priority order and retry/backoff of Sheets calls"""
+
+import json
+import threading
+import time
+
+import gspread
+import pytest
+import requests
+
+import quota_scheduler
+from fake_sheets import quota_error
+from quota_scheduler import BULK, INTERACTIVE, QuotaExceededError, QuotaScheduler, TokenBucket, priority
+
+
+def api_error(status: int) -> gspread.exceptions.APIError:
+    response = requests.Response()
+    response.status_code = status
+    response._content = json.dumps({"error": {"code": status, "message": "backend error"}}).encode()
+    return gspread.exceptions.APIError(response)
+
+
+def failing(*errors, result="ok"):
+    """Callable raising the given errors in turn, then returning result"""
+    errors = list(errors)
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if errors:
+            raise errors.pop(0)
+        return result
+
+    fn.calls = calls
+    return fn
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    delays = []
+    monkeypatch.setattr(quota_scheduler.time, "sleep", delays.append)
+    return delays
+
+
+def test_bucket_allows_a_burst_then_times_out():
+    bucket = TokenBucket("read", per_minute=60, burst=2)
+    assert bucket.acquire(INTERACTIVE, timeout=1) < 0.1
+    bucket.acquire(INTERACTIVE, timeout=1)
+    with pytest.raises(QuotaExceededError):
+        bucket.acquire(INTERACTIVE, timeout=0.05)
+    stats = bucket.stats()
+    assert stats["acquired"]["interactive"] == 2
+    assert stats["timeouts"] == 1
+    assert stats["waiting"] == 0
+
+
+def test_interactive_callers_are_served_before_bulk():
+    bucket = TokenBucket("write", per_minute=1200, burst=1)  # un token ogni 50 ms
+    bucket.acquire(INTERACTIVE, timeout=1)
+    order = []
+
+    def take(level, name):
+        bucket.acquire(level, timeout=5)
+        order.append(name)
+
+    threads = [threading.Thread(target=take, args=(BULK, "bulk-1")),
+               threading.Thread(target=take, args=(BULK, "bulk-2")),
+               threading.Thread(target=take, args=(INTERACTIVE, "interactive"))]
+    for t in threads:
+        t.start()
+        time.sleep(0.01)
+    for t in threads:
+        t.join(5)
+    assert order == ["interactive", "bulk-1", "bulk-2"]
+    assert bucket.stats()["acquired"] == {"interactive": 2, "bulk": 2}
+
+
+def test_429_is_retried_and_drains_the_bucket(sleeps):
+    scheduler = QuotaScheduler(read_per_minute=6000, write_per_minute=6000, max_retries=3)
+    fn = failing(quota_error(), quota_error())
+    assert scheduler.call("read", fn) == "ok"
+    assert len(fn.calls) == 3
+    assert len(sleeps) == 2
+    assert all(0 <= delay <= scheduler.backoff_max for delay in sleeps)
+    stats = scheduler.stats()
+    assert (stats["calls"], stats["retries"], stats["throttled"]) == (3, 2, 2)
+    assert stats["read"]["tokens"] < 10
+
+
+def test_persistent_429_raises_quota_exceeded(sleeps):
+    scheduler = QuotaScheduler(read_per_minute=6000, write_per_minute=6000, max_retries=2)
+    fn = failing(*(quota_error() for _ in range(5)))
+    with pytest.raises(QuotaExceededError):
+        scheduler.call("write", fn, idempotent=False)
+    assert len(fn.calls) == 3
+    assert scheduler.stats()["failures"] == 1
+
+
+def test_5xx_is_retried_only_for_idempotent_calls(sleeps):
+    scheduler = QuotaScheduler(read_per_minute=6000, write_per_minute=6000)
+    assert scheduler.call("read", failing(api_error(503))) == "ok"
+
+    append = failing(api_error(503))
+    with pytest.raises(gspread.exceptions.APIError):
+        scheduler.call("write", append, idempotent=False)
+    assert len(append.calls) == 1
+
+    with pytest.raises(gspread.exceptions.APIError):
+        scheduler.call("read", failing(api_error(400)))
+    assert scheduler.stats()["server_errors"] == 2
+
+
+def test_priority_context_applies_to_enclosed_calls():
+    scheduler = QuotaScheduler(read_per_minute=6000, write_per_minute=6000)
+    with priority(BULK):
+        scheduler.call("read", lambda: None)
+    scheduler.call("read", lambda: None)
+    assert scheduler.stats()["read"]["acquired"] == {"interactive": 1, "bulk": 1}
@@ -0,0 +1,54 @@
+from row_index import RowIndex
+from table_cache import FIRST_DATA_ROW
+
+
+def loaded(keys):
+    index = RowIndex(ttl_seconds=60)
+    assert index.load(keys)
+    return index
+
+
+def test_load_skips_blank_rows():
+    index = loaded(["a", None, "b"])
+    assert index.find("a") == FIRST_DATA_ROW
+    assert index.find("b") == FIRST_DATA_ROW + 2
+    assert index.find("missing") is None
+
+
+def test_remove_row_shifts_rows_below():
+    index = loaded(["a", "b", "c", "d"])
+    index.remove_row(FIRST_DATA_ROW + 1)
+    assert index.find("a") == FIRST_DATA_ROW
+    assert index.find("b") is None
+    assert index.find("c") == FIRST_DATA_ROW + 1
+    assert index.find("d") == FIRST_DATA_ROW + 2
+    # Le righe aggiunte dopo prendono il numero liberato in fondo
+    index.append(["e"])
+    assert index.find("e") == FIRST_DATA_ROW + 3
+
+
+def test_rekey_keeps_position():
+    index = loaded(["a", "b"])
+    index.rekey(FIRST_DATA_ROW + 1, "b", "z")
+    assert index.find("b") is None
+    assert index.find("z") == FIRST_DATA_ROW + 1
+    # Tombstone: la riga resta ma non ha più chiave
+    index.rekey(FIRST_DATA_ROW, "a", None)
+    assert index.find("a") is None
+
+
+def test_load_discards_keys_read_before_a_write():
+    index = loaded(["a"])
+    version = index.version
+    index.append(["b"])
+    # Lettura iniziata prima dell'append: non contiene "b"
+    assert not index.load(["a"], version=version)
+    assert index.find("b") == FIRST_DATA_ROW + 1
+
+
+def test_not_loaded_index_ignores_changes():
+    index = RowIndex(ttl_seconds=60)
+    index.append(["a"])
+    index.remove_row(FIRST_DATA_ROW)
+    assert not index.fresh()
+    assert index.find("a") is None
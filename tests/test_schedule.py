@@ -0,0 +1,88 @@
+"""Batch schedule calculator and the schedule written by POST/PUT of an existing day"""
+
+import numpy as np
+import pandas as pd
+
+import schedule
+from city_resolver import CityResolver
+from .helpers import auth, make_workday, sheet_rows
+
+RESOLVER = CityResolver([
+    {"id": "c1", "name": "Milano", "travel_minutes": 10},
+    {"id": "c2", "name": "Brescia", "travel_minutes": 60},
+])
+
+
+def blank(date, **fields):
+    workday = make_workday(date, **fields)
+    for field in schedule.MINUTE_FIELDS:
+        workday[field] = fields.get(field, 0)
+    for field in schedule.CLOCK_FIELDS:
+        workday[field] = fields.get(field, "")
+    return workday
+
+
+def test_work_day_from_the_city_travel_time():
+    workdays = [blank("2025-01-02", city="Brescia")]
+    assert schedule.fill_schedules(workdays, RESOLVER) == 1
+    day = workdays[0]
+    # 60 + 60 minuti di viaggio, 30 + 30 pagati: presenza 540 - 60 + 15
+    assert (day["travel_minutes_outbound"], day["travel_minutes_return"], day["work_minutes"]) == (60, 60, 435)
+    assert [day[f] for f in schedule.CLOCK_FIELDS] == ["09:00", "10:00", "18:15", "19:15"]
+
+
+def test_rest_day_is_left_alone():
+    workdays = [blank("2025-01-03", city="", status="Ferie"), blank("2025-01-04", city="Atlantide")]
+    assert schedule.fill_schedules(workdays, RESOLVER) == 0
+    assert all(w[f] == "" for w in workdays for f in schedule.CLOCK_FIELDS)
+    assert not schedule.compute_schedules(workdays, RESOLVER)["valid"].any()
+
+
+def test_custom_arrival_and_recorded_values_are_kept():
+    workdays = [
+        blank("2025-01-06", city="Milano", arrival_time="08:30"),
+        blank("2025-01-07", city="Milano", travel_minutes_outbound=45, exit_time="23:50"),
+        blank("2025-01-08", is_custom_city="TRUE", city="", custom_travel_minutes="40"),
+    ]
+    schedule.fill_schedules(workdays, RESOLVER, default_arrival="09:00")
+    first, second, custom = workdays
+    assert [first[f] for f in schedule.CLOCK_FIELDS] == ["08:20", "08:30", "17:45", "17:55"]
+    assert (second["travel_minutes_outbound"], second["departure_home"]) == (45, "08:15")
+    # Il rientro passa la mezzanotte
+    assert (second["exit_time"], second["return_home"]) == ("23:50", "00:00")
+    assert (custom["travel_minutes_outbound"], custom["work_minutes"]) == (40, 475)
+
+
+def test_clock_parsing():
+    parsed = schedule.parse_clock(pd.Series(["9:05", "24:00", "", None, "10:60"]))
+    assert parsed.tolist() == [545, -1, -1, -1, -1]
+    assert schedule.format_clock(np.array([-10, 1445])).tolist() == ["23:50", "00:05"]
+
+
+def stored(fake, date):
+    return next(r for r in sheet_rows(fake) if r["date"] == date)
+
+
+def test_update_keeps_the_stored_arrival_time(client, fake):
+    row = next(i for i, r in enumerate(sheet_rows(fake), start=2) if r["date"] == "2025-01-05")
+    header = fake._sheets["workdays"]._rows[0]
+    fake._sheets["workdays"]._rows[row - 1][header.index("arrival_time")] = "08:00"
+
+    response = client.put("/api/workdays/2025-01-05", json={"date": "2025-01-05", "city": "Lecco"}, headers=auth())
+    assert response.status_code == 200
+    day = stored(fake, "2025-01-05")
+    assert (day["city"], day["travel_minutes_outbound"]) == ("Lecco", "30")
+    assert [day[f] for f in schedule.CLOCK_FIELDS] == ["07:30", "08:00", "17:15", "17:45"]
+
+
+def test_rest_day_clears_the_old_schedule(client, fake):
+    client.put("/api/workdays/2025-01-06", json={"date": "2025-01-06", "city": "Como"}, headers=auth())
+    assert stored(fake, "2025-01-06")["exit_time"]
+
+    response = client.post("/api/workdays", json={"date": "2025-01-06", "status": "Ferie"}, headers=auth())
+    assert response.status_code == 200
+    day = stored(fake, "2025-01-06")
+    assert (day["status"], day["city"]) == ("Ferie", "")
+    assert all(day[f] in ("", "0") for f in schedule.MINUTE_FIELDS + schedule.CLOCK_FIELDS)
+    assert client.put("/api/workdays/2024-12-31", json={"date": "2024-12-31", "city": "Como"},
+                      headers=auth()).status_code == 404
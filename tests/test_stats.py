@@ -0,0 +1,63 @@
+"""Vectorized monthly statistics and GET /api/stats/monthly"""
+
+import pytest
+
+import stats
+from .helpers import ADMIN_ID, USER_ID, auth, make_workday
+
+WORKDAYS = [
+    make_workday("2025-03-03", travel_minutes_outbound=30, travel_minutes_return="40", work_minutes=480),
+    make_workday("04/03/2025", travel_minutes_outbound="", work_minutes="420"),
+    make_workday("2025-03-05", city="", status="Ferie"),
+    make_workday("2025-03-06", city="", status="Ferie"),
+    make_workday("2025-03-07", city="", status="Malattia"),
+    make_workday("2025-03-10", city="", is_custom_city="TRUE", custom_city_name="Verona",
+                 custom_distance_km="100", custom_travel_minutes="90", work_minutes=300),
+    make_workday("2025-04-01", work_minutes=480),
+    make_workday("2025-03-11", user_id="u2", work_minutes=100),
+    make_workday("garbage", work_minutes=999),
+]
+
+
+def test_month_totals():
+    result = stats.monthly_stats([w for w in WORKDAYS if w["user_id"] == USER_ID], "2025", "3")
+    assert result["month"] == "03/2025"
+    assert (result["work_days"], result["rest_days"]) == (3, 3)
+    assert result["rest_days_by_status"] == {"Ferie": 2, "Malattia": 1}
+    # 30 + 40, più 2 * 90 della città personalizzata senza minuti
+    assert result["total_travel_time_minutes"] == 250
+    assert result["total_time_at_store_minutes"] == 1200
+    assert result["total_km"] == 200.0
+    assert result["total_fuel_liters"] == pytest.approx(200 / 100 * stats.CAR_CONSUMPTION_PER_100KM)
+    assert len(result["breakdown"]) == 1
+
+
+def test_year_breakdown_per_user_and_month():
+    result = stats.monthly_stats(WORKDAYS, "2025")
+    assert result["month"] == "2025"
+    assert [(r["user_id"], r["month"]) for r in result["breakdown"]] == [(USER_ID, "3"), (USER_ID, "4"), ("u2", "3")]
+    assert result["work_days"] == 5
+    assert result["total_time_at_store_minutes"] == 1200 + 480 + 100
+
+
+def test_contributions_match_the_full_aggregate():
+    parts = stats.contributions(WORKDAYS)
+    assert set(parts) == {(USER_ID, "2025", "3"), (USER_ID, "2025", "4"), ("u2", "2025", "3")}
+    assert parts[(USER_ID, "2025", "3")]["rest_Ferie"] == 2
+    groups = [{"user_id": u, "year": y, "month": m, **values} for (u, y, m), values in parts.items()]
+    assert stats.summarize(groups, "2025") == stats.monthly_stats(WORKDAYS, "2025")
+
+
+def test_empty_period():
+    result = stats.monthly_stats([], "2024", "1")
+    assert (result["work_days"], result["rest_days"], result["breakdown"]) == (0, 0, [])
+
+
+def test_endpoint_scopes_users(client):
+    own = client.get("/api/stats/monthly", params={"year": "2025", "month": "1"}, headers=auth())
+    assert own.status_code == 200
+    assert own.json()["work_days"] == 10
+    assert client.get("/api/stats/monthly", params={"year": "2025", "user_id": "u2"}, headers=auth()).status_code == 403
+
+    admin = client.get("/api/stats/monthly", params={"year": "2025", "user_id": "u2"}, headers=auth(ADMIN_ID))
+    assert admin.json()["work_days"] == 0
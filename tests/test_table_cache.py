@@ -0,0 +1,82 @@
+"""TableCache: loads outside the global lock, one load per table, shallow copies"""
+
+import threading
+
+from table_cache import TableCache, FIRST_DATA_ROW
+
+USERS = [{"id": "u1", "email": "A@example.com"}, {"id": "u2", "email": "b@example.com"}]
+
+
+def make_cache(**kwargs):
+    return TableCache(ttl_seconds=60, max_bytes=1 << 20, indexes={"users": {"id": None, "email": str.lower}}, **kwargs)
+
+
+def test_lookup_returns_row_and_copy():
+    cache = make_cache()
+    row, user = cache.lookup("users", "email", "a@EXAMPLE.com", lambda: USERS)
+    assert (row, user["id"]) == (FIRST_DATA_ROW, "u1")
+    user["id"] = "changed"
+    cache.get("users", lambda: USERS)[1]["id"] = "changed"
+    assert [u["id"] for u in cache.get("users", lambda: USERS)] == ["u1", "u2"]
+    assert cache.stats()["misses"] == 1
+
+
+def test_update_does_not_change_copies_already_returned():
+    cache = make_cache()
+    before = cache.get("users", lambda: USERS)
+    assert cache.update("users", "id", "u2", {"email": "new@example.com"})
+    assert before[1]["email"] == "b@example.com"
+    assert cache.lookup("users", "email", "NEW@example.com", lambda: USERS)[1]["id"] == "u2"
+
+
+def test_cold_load_does_not_block_other_tables():
+    cache = make_cache()
+    cache.get("cities", lambda: [{"id": "c1"}])
+    started, release = threading.Event(), threading.Event()
+
+    def slow_users():
+        started.set()
+        release.wait(5)
+        return USERS
+
+    loading = threading.Thread(target=cache.get, args=("users", slow_users))
+    loading.start()
+    assert started.wait(5)
+    # Con la chiamata remota in corso le altre tabelle restano leggibili
+    assert cache.get("cities", lambda: []) == [{"id": "c1"}]
+    cache.invalidate("roles")
+    release.set()
+    loading.join(5)
+    assert cache.stats()["tables"]["users"]["rows"] == 2
+
+
+def test_concurrent_misses_load_once():
+    cache = make_cache()
+    calls = []
+    release = threading.Event()
+
+    def loader():
+        calls.append(1)
+        release.wait(5)
+        return USERS
+
+    threads = [threading.Thread(target=cache.get, args=("users", loader)) for _ in range(4)]
+    for t in threads:
+        t.start()
+    release.set()
+    for t in threads:
+        t.join(5)
+    assert len(calls) == 1
+
+
+def test_write_during_load_is_not_cached():
+    cache = make_cache()
+
+    def loader():
+        # Un'altra richiesta scrive mentre la lettura è in volo
+        cache.append("users", {"id": "u3"})
+        return USERS
+
+    assert len(cache.get("users", loader)) == 2
+    assert "users" not in cache.stats()["tables"]
+    assert len(cache.get("users", lambda: USERS + [{"id": "u3"}])) == 3
@@ -0,0 +1,59 @@
+"""Tombstone deletes (SHEETS_SOFT_DELETE) and batched compaction of the marked rows"""
+
+import db_sheets
+from .helpers import USER_ID, make_workday, sheet_rows
+
+
+def dates(fake, title="workdays"):
+    return [r["date"] for r in sheet_rows(fake, title)]
+
+
+def test_row_runs_are_bottom_up():
+    assert db_sheets._row_runs([3, 4, 7, 9, 10, 11]) == [(9, 11), (7, 7), (3, 4)]
+    assert db_sheets._row_runs([]) == []
+
+
+def test_soft_delete_then_compaction(fake, monkeypatch):
+    monkeypatch.setattr(db_sheets, "SOFT_DELETE", True)
+    for date in ("2025-01-03", "2025-01-04", "2025-01-08"):
+        assert db_sheets.delete_workday(USER_ID, date)
+    assert db_sheets.delete_user("u2")
+    assert db_sheets.delete_city("c1")
+
+    # Tombstone: una sola cella scritta, nessuna riga spostata
+    assert len(sheet_rows(fake)) == 10
+    assert [r["date"] for r in sheet_rows(fake) if r.get("deleted") == "TRUE"] == ["2025-01-03", "2025-01-04", "2025-01-08"]
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-04") is None
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-09")["date"] == "2025-01-09"
+    assert len(db_sheets.get_all_workdays(USER_ID)) == 7
+    assert db_sheets.get_user_by_id("u2") is None
+    assert db_sheets.get_user_by_id("u3")["username"] == "user3"
+
+    fake.reset_calls()
+    removed = db_sheets.compact_tables()
+    assert removed == {"users": 1, "cities": 1, "workdays": 3}
+    # Tutte le tabelle con una lettura e una batch_update
+    assert fake.calls["values_batch_get"] == 1
+    assert fake.calls["spreadsheet_batch_update"] == 1
+
+    assert dates(fake) == [f"2025-01-{day:02d}" for day in (1, 2, 5, 6, 7, 9, 10)]
+    assert not any(r.get("deleted") for r in sheet_rows(fake))
+    assert [r["id"] for r in sheet_rows(fake, "users")] == ["u1", "u3"]
+    assert [r["id"] for r in sheet_rows(fake, "cities")] == ["c2", "c3"]
+    for date in dates(fake):
+        assert db_sheets.get_workday_by_date(USER_ID, date)["date"] == date
+    assert db_sheets.update_workday(USER_ID, "2025-01-10", {"city": "Como"})
+    assert sheet_rows(fake)[-1]["city"] == "Como"
+    assert db_sheets.get_user_by_id("u3")["username"] == "user3"
+    assert db_sheets.compact_tables() == {}
+
+
+def test_day_can_be_created_again_after_a_tombstone(fake, monkeypatch):
+    monkeypatch.setattr(db_sheets, "SOFT_DELETE", True)
+    assert db_sheets.delete_workday(USER_ID, "2025-01-05")
+    db_sheets.create_workday(make_workday("2025-01-05", city="Lecco"))
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-05")["city"] == "Lecco"
+
+    assert db_sheets.compact_tables() == {"workdays": 1}
+    assert dates(fake).count("2025-01-05") == 1
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-05")["city"] == "Lecco"
@@ -0,0 +1,116 @@
+"""Keyset pages of workdays: cursors, page selection, the sheets partitions and GET /api/workdays"""
+
+import pytest
+
+import db_sheets
+import server
+import workday_pages
+from .helpers import ADMIN_ID, USER_ID, auth, make_workday
+
+RECORDS = [
+    make_workday("2025-01-02", user_id="u2"),
+    make_workday("03/01/2025"),
+    make_workday("2025-01-02"),
+    make_workday("2025-01-01", user_id="u2"),
+    make_workday("2024-12-31"),
+]
+
+
+def test_cursor_round_trip():
+    key = ("2025-01-02", "u2")
+    assert workday_pages.decode_cursor(workday_pages.encode_cursor(key)) == key
+    for cursor in ("%%%", "bm90IGpzb24", workday_pages.encode_cursor(("only-one",))[:-2]):
+        with pytest.raises(ValueError):
+            workday_pages.decode_cursor(cursor)
+
+
+def test_pages_follow_the_date_and_user_order():
+    keys, cursor = [], None
+    while True:
+        after = workday_pages.decode_cursor(cursor) if cursor else None
+        items, cursor = workday_pages.paginate(RECORDS, 2, after=after)
+        keys.extend(workday_pages.page_key(r) for r in items)
+        if cursor is None:
+            break
+    assert keys == [("2024-12-31", "u1"), ("2025-01-01", "u2"), ("2025-01-02", "u1"),
+                    ("2025-01-02", "u2"), ("2025-01-03", "u1")]
+
+
+def test_filters_and_projection():
+    items, cursor = workday_pages.paginate(RECORDS, 10, ["date"], user_id=USER_ID,
+                                           date_from="2025-01-01", date_to="2025-01-02")
+    assert items == [{"date": "2025-01-02"}] and cursor is None
+    # Pagina piena ma nessuna riga dopo: nessun cursore
+    assert workday_pages.paginate(RECORDS, 5)[1] is None
+    assert workday_pages.paginate([], 5) == ([], None)
+
+
+@pytest.fixture
+def partitioned(fake, monkeypatch):
+    monkeypatch.setattr(db_sheets, "WORKDAYS_PARTITIONED", True)
+    config = db_sheets.SHEETS_CONFIG["workdays"]
+    for year, days in (("2023", ["2023-06-01"]), ("2024", ["2024-12-30", "2024-12-31"]),
+                       ("2025", ["2025-01-02", "2025-01-01"])):
+        fake.load(f"workdays_{year}", config, [db_sheets._workday_row(make_workday(d)) for d in days])
+    db_sheets.use_spreadsheet(fake)
+    return fake
+
+
+def test_page_reads_only_the_partitions_it_needs(partitioned):
+    partitioned.reset_calls()
+    items, cursor = db_sheets.get_workdays_page(date_from="2024-01-01", limit=1)
+    assert [w["date"] for w in items] == ["2024-12-30"]
+    # La pagina è piena già dal 2024: né il 2023 (prima di date_from) né il 2025
+    assert partitioned.calls["get_all_records"] == 1
+
+    partitioned.reset_calls()
+    items, cursor = db_sheets.get_workdays_page(after=workday_pages.decode_cursor(cursor), limit=2)
+    assert [w["date"] for w in items] == ["2024-12-31", "2025-01-01"]
+    assert partitioned.calls["get_all_records"] == 2
+    items, cursor = db_sheets.get_workdays_page(after=workday_pages.decode_cursor(cursor), limit=2)
+    assert [w["date"] for w in items] == ["2025-01-02"] and cursor is None
+
+
+def all_pages(client, user_id=USER_ID, **params):
+    dates, cursor = [], None
+    while True:
+        query = {**params, **({"cursor": cursor} if cursor else {})}
+        body = client.get("/api/workdays", params=query, headers=auth(user_id)).json()
+        dates.extend(w["date"] for w in body["items"])
+        cursor = body["next_cursor"]
+        if cursor is None:
+            return dates
+
+
+def test_api_pages(client):
+    client.post("/api/workdays", json={"date": "2025-01-04", "city": "Como"}, headers=auth("u2"))
+    assert all_pages(client, limit=3) == [f"2025-01-{day:02d}" for day in range(1, 11)]
+    assert all_pages(client, ADMIN_ID, limit=4, date_from="2025-01-03", date_to="2025-01-05") == \
+        ["2025-01-03", "2025-01-04", "2025-01-04", "2025-01-05"]
+
+    page = client.get("/api/workdays", params={"limit": 2, "fields": "date,city"}, headers=auth()).json()
+    assert page["items"] == [{"date": "2025-01-01", "city": "Milano"}, {"date": "2025-01-02", "city": "Milano"}]
+    # limit ridotto al massimo configurato
+    assert client.get("/api/workdays", params={"limit": 10 ** 6}, headers=auth()).json()["limit"] == \
+        server.WORKDAYS_PAGE_MAX_SIZE
+
+
+@pytest.mark.parametrize("params", [{"cursor": "%%%"}, {"fields": "date,password_hash"}])
+def test_api_rejects_bad_page_params(client, params):
+    assert client.get("/api/workdays", params=params, headers=auth()).status_code == 400
+
+
+class NoPages:
+    """db_sheets seen as a backend without get_workdays_page (the server pages the full list)"""
+
+    def __getattr__(self, name):
+        if name == "get_workdays_page":
+            raise AttributeError(name)
+        return getattr(db_sheets, name)
+
+
+def test_server_side_pages_match_the_storage_ones(client, monkeypatch):
+    expected = all_pages(client, limit=4, date_from="2025-01-02")
+    monkeypatch.setattr(server, "db", NoPages())
+    assert all_pages(client, limit=4, date_from="2025-01-02") == expected == \
+        [f"2025-01-{day:02d}" for day in range(2, 11)]
@@ -0,0 +1,167 @@
+"""Write-behind queue: coalescing, flush through db_sheets and journal replay after a crash"""
+
+import gspread
+import pytest
+import requests
+
+import db_sheets
+from write_behind import WriteBehindQueue
+from .helpers import USER_ID, make_workday, sheet_rows
+
+KEY = (USER_ID, "2025-02-01")
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return WriteBehindQueue(journal_path=str(tmp_path / "journal.jsonl"), flush_interval=60, max_ops=1000)
+
+
+@pytest.fixture
+def write_behind(fake, queue, monkeypatch):
+    """db_sheets in WRITE_BEHIND mode on a journal in tmp_path (no background thread)"""
+    monkeypatch.setattr(db_sheets, "WRITE_BEHIND", True)
+    monkeypatch.setattr(db_sheets, "_write_behind", queue)
+    return queue
+
+
+def restart(queue):
+    """A new process on the same journal"""
+    return WriteBehindQueue(journal_path=queue.journal_path, flush_interval=60, max_ops=1000)
+
+
+def test_update_is_merged_into_the_pending_create(queue):
+    queue.create("workdays", KEY, make_workday(KEY[1]))
+    queue.update("workdays", KEY, {"city": "Como"})
+    queue.update("workdays", KEY, {"work_minutes": 400})
+
+    assert queue.pending_create("workdays", KEY)["city"] == "Como"
+    creates, updates = queue.take()
+    assert creates["workdays"][KEY]["city"] == "Como"
+    assert creates["workdays"][KEY]["work_minutes"] == 400
+    assert updates == {}
+    assert queue.coalesced == 2
+
+
+def test_updates_of_one_row_are_coalesced(queue):
+    queue.update("workdays", KEY, {"city": "Como"})
+    queue.update("workdays", KEY, {"city": "Lecco", "status": "Ferie"})
+    assert queue.pending_ops() == 1
+    assert queue.pending_changes("workdays", KEY) == {"city": "Lecco", "status": "Ferie"}
+
+
+def test_failed_flush_keeps_operations_in_order(queue):
+    queue.create("workdays", KEY, make_workday(KEY[1]))
+    queue.take()
+    # Arrivato durante il flush fallito: va unito alla create rimessa in coda
+    queue.update("workdays", KEY, {"city": "Como"})
+    queue.done(False)
+
+    creates, updates = queue.take()
+    assert creates["workdays"][KEY]["city"] == "Como"
+    assert updates == {}
+    assert queue.failures == 1
+
+
+def test_journal_survives_a_restart(queue):
+    queue.create("workdays", KEY, make_workday(KEY[1]))
+    queue.update("workdays", KEY, {"city": "Como"})
+    queue.update("workdays", (USER_ID, "2025-01-01"), {"status": "Ferie"})
+    with open(queue.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"op": "create", "table": "work')  # riga troncata da un arresto
+
+    replayed = restart(queue)
+    assert replayed.replay() == 3
+    assert replayed.pending_create("workdays", KEY)["city"] == "Como"
+    assert replayed.pending_changes("workdays", (USER_ID, "2025-01-01")) == {"status": "Ferie"}
+
+
+def test_pending_writes_are_visible_before_the_flush(fake, write_behind):
+    db_sheets.create_workday(make_workday("2025-02-01"))
+    assert db_sheets.update_workday(USER_ID, "2025-02-01", {"city": "Como"})
+    assert db_sheets.update_workday(USER_ID, "2025-01-05", {"city": "Lecco"})
+    assert not db_sheets.update_workday(USER_ID, "2024-12-31", {"city": "Lecco"})
+
+    assert len(sheet_rows(fake)) == 10
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-02-01")["city"] == "Como"
+    assert db_sheets.get_workday_by_date(USER_ID, "2025-01-05")["city"] == "Lecco"
+    cities = {w["date"]: w["city"] for w in db_sheets.get_all_workdays(USER_ID)}
+    assert len(cities) == 11
+    assert cities["2025-02-01"] == "Como"
+    assert cities["2025-01-05"] == "Lecco"
+
+
+def test_flush_writes_one_append_and_one_batch_update(fake, write_behind):
+    db_sheets.create_workday(make_workday("2025-02-01"))
+    db_sheets.create_workday(make_workday("2025-02-02"))
+    db_sheets.update_workday(USER_ID, "2025-02-01", {"city": "Como"})
+    db_sheets.update_workday(USER_ID, "2025-01-03", {"city": "Lecco"})
+    db_sheets.update_workday(USER_ID, "2025-01-09", {"status": "Ferie"})
+
+    fake.reset_calls()
+    assert db_sheets.flush_writes() == 4
+    assert fake.calls["append_rows"] == 1
+    assert fake.calls["batch_update"] == 1
+
+    rows = {r["date"]: r for r in sheet_rows(fake)}
+    assert len(rows) == 12
+    assert rows["2025-02-01"]["city"] == "Como"
+    assert rows["2025-01-03"]["city"] == "Lecco"
+    assert rows["2025-01-09"]["status"] == "Ferie"
+    # Journal svuotato dopo il flush riuscito
+    assert restart(write_behind).replay() == 0
+
+
+def test_delete_flushes_the_queue_first(fake, write_behind):
+    db_sheets.create_workday(make_workday("2025-02-01"))
+    assert db_sheets.delete_workday(USER_ID, "2025-01-02")
+    assert db_sheets.delete_workday(USER_ID, "2025-02-01")
+    assert [r["date"] for r in sheet_rows(fake)][-1] == "2025-01-10"
+    assert len(sheet_rows(fake)) == 9
+
+
+def test_replay_skips_creates_already_on_the_sheet(fake, write_behind, monkeypatch):
+    written = make_workday("2025-02-01")
+    db_sheets.create_workday(written)
+    db_sheets.create_workday(make_workday("2025-02-02"))
+    db_sheets.update_workday(USER_ID, "2025-01-04", {"city": "Como"})
+    # Arresto dopo che la create era arrivata sul foglio ma prima di riscrivere il journal
+    fake._sheets["workdays"]._rows.append([str(v) for v in db_sheets._workday_row(written)])
+
+    replayed = restart(write_behind)
+    monkeypatch.setattr(db_sheets, "_write_behind", replayed)
+    db_sheets.use_spreadsheet(fake)
+    assert db_sheets.start_write_behind() == 3
+    db_sheets.stop_write_behind()
+
+    dates = [r["date"] for r in sheet_rows(fake)]
+    assert dates.count("2025-02-01") == 1
+    assert dates.count("2025-02-02") == 1
+    assert {r["date"]: r["city"] for r in sheet_rows(fake)}["2025-01-04"] == "Como"
+    assert replayed.pending_ops() == 0
+    assert restart(replayed).replay() == 0
+
+
+def test_failed_flush_keeps_the_journal(fake, write_behind, monkeypatch):
+    db_sheets.create_workday(make_workday("2025-02-01"))
+
+    response = requests.Response()
+    response.status_code = 400
+    response._content = b'{"error": {"code": 400, "message": "bad request"}}'
+
+    def rejected(*args, **kwargs):
+        raise gspread.exceptions.APIError(response)
+
+    monkeypatch.setattr(fake._sheets["workdays"], "append_row", rejected)
+    with pytest.raises(gspread.exceptions.APIError):
+        db_sheets.flush_writes()
+    assert write_behind.pending_create("workdays", KEY) is not None
+    assert restart(write_behind).replay() == 1
+
+
+def test_date_change_flushes_and_writes_at_once(fake, write_behind):
+    db_sheets.update_workday(USER_ID, "2025-01-02", {"city": "Como"})
+    assert db_sheets.update_workday(USER_ID, "2025-01-03", {"date": "2025-03-03"})
+    assert write_behind.pending_ops() == 0
+    rows = {r["date"]: r for r in sheet_rows(fake)}
+    assert rows["2025-01-02"]["city"] == "Como"
+    assert "2025-03-03" in rows and "2025-01-03" not in rows